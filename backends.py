@@ -0,0 +1,634 @@
+import os
+import re
+import time
+import random
+import asyncio
+import logging
+from collections import deque
+from streaming import iter_sse_json
+from history import estimate_tokens
+from ratelimit import QueueFull, RateLimited
+from metrics import error_kind
+from logs import sampled
+
+# Routing settings
+ROUTER_ATTEMPT_TIMEOUT = float(os.getenv('ROUTER_ATTEMPT_TIMEOUT', '30'))
+# The configured order holds unless a backend is this many times slower than a measured alternative...
+ROUTE_SLOWDOWN_FACTOR = float(os.getenv('ROUTE_SLOWDOWN_FACTOR', '3.0'))
+# ...or its recent error rate (EWMA) is above this share
+ROUTE_ERROR_THRESHOLD = float(os.getenv('ROUTE_ERROR_THRESHOLD', '0.3'))
+EWMA_ALPHA = 0.2
+BREAKER_FAILURES = int(os.getenv('ROUTER_BREAKER_FAILURES', '3'))
+BREAKER_COOLDOWN = float(os.getenv('ROUTER_BREAKER_COOLDOWN', '30'))
+
+# Hedged requests: if the primary has not answered by its latency percentile, ask the next backend too
+HEDGE_REQUESTS = os.getenv('HEDGE_REQUESTS', '0').lower() in ('1', 'true', 'yes', 'on')
+HEDGE_PERCENTILE = float(os.getenv('HEDGE_PERCENTILE', '95'))
+HEDGE_MIN_SAMPLES = int(os.getenv('HEDGE_MIN_SAMPLES', '20'))
+HEDGE_DEFAULT_DELAY = float(os.getenv('HEDGE_DEFAULT_DELAY', '8'))  # used until enough samples are collected
+HEDGE_MIN_DELAY = float(os.getenv('HEDGE_MIN_DELAY', '1'))
+LATENCY_SAMPLES = 200
+
+# Output budget charged against token-per-minute limits when an adapter has no max_tokens
+EXPECTED_OUTPUT_TOKENS = 1000
+
+# Anthropic and OpenAI only cache prompt prefixes of at least about 1024 tokens. The personality prompts
+# are about 250-600 tokens, so at current sizes prefix caching stays inactive and cached_tokens stays 0;
+# the Anthropic breakpoint is only sent once a system prompt reaches this size
+CACHE_MIN_PREFIX_TOKENS = int(os.getenv('CACHE_MIN_PREFIX_TOKENS', '1024'))
+
+# Role -> ordered list of backends; the first one is the preferred provider
+DEFAULT_ROUTES = {
+    'CMO': ['xai', 'openai'],
+    'CFO': ['gemini', 'openai'],
+    'CTO': ['anthropic', 'openai'],
+}
+DEFAULT_ROUTE = ['openai', 'anthropic']
+
+logger = logging.getLogger(__name__)
+
+
+class BackendError(Exception):
+    """Raised when a provider answers with an error payload"""
+
+
+def _strip_bold(text):
+    return re.sub(r'\*\*', '', text)
+
+
+def _check_rate_limit(response):
+    """Turns an HTTP 429 into RateLimited carrying the provider's Retry-After"""
+    if response.status_code == 429:
+        try:
+            retry_after = float(response.headers.get('retry-after'))
+        except (TypeError, ValueError):
+            retry_after = None
+        raise RateLimited(f"HTTP 429 from {response.url.host}", retry_after)
+
+
+def request_tokens(system_prompt, messages, prompt, context=''):
+    """Estimated prompt size of one request, for token-per-minute limits"""
+    texts = [system_prompt, context, prompt] + [str(message.get('content', '')) for message in messages]
+    return sum(estimate_tokens(text) for text in texts if text)
+
+
+def _field(value, *path):
+    """Reads a nested usage field from an SDK object or a plain dict; missing fields count as 0"""
+    for key in path:
+        if value is None:
+            return 0
+        value = value.get(key) if isinstance(value, dict) else getattr(value, key, None)
+    return value or 0
+
+
+class Backend:
+    """Base provider adapter: builds the provider request and parses its response.
+
+    The request is laid out so the system prompt, which is stable per (role, language), always comes
+    first and byte-identical; per-call text such as the team list is passed separately as `context`
+    and placed after it, so providers can reuse their cached prefix once it is long enough to be
+    cached at all (see CACHE_MIN_PREFIX_TOKENS).
+    """
+
+    name = 'backend'
+    usage_listener = None  # callable(name, prompt_tokens, cached_tokens, cache_writes, completion_tokens), set by the router
+
+    def report_usage(self, prompt_tokens, cached_tokens=0, cache_writes=0, completion_tokens=0):
+        if self.usage_listener is not None:
+            self.usage_listener(self.name, prompt_tokens, cached_tokens, cache_writes, completion_tokens)
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.7, lang='ru', context='', on_delta=None):
+        raise NotImplementedError
+
+
+class XAIBackend(Backend):
+    name = 'xai'
+
+    def __init__(self, providers, model="grok-2-vision-1212"):
+        self.providers = providers
+        self.model = model
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.9, lang='ru', context='', on_delta=None):
+        payload = {
+            "messages": [
+                {"role": "system", "content": system_prompt},
+                *([{"role": "system", "content": context}] if context else []),
+                *messages,
+                {"role": "user", "content": prompt}
+            ],
+            "model": self.model,
+            "stream": on_delta is not None,
+            "temperature": temperature
+        }
+        usage = None
+        if on_delta is not None:
+            payload["stream_options"] = {"include_usage": True}
+            content = ""
+            async with self.providers.xai.stream("POST", "/chat/completions", json=payload) as response:
+                _check_rate_limit(response)
+                response.raise_for_status()
+                async for chunk in iter_sse_json(response):
+                    for choice in chunk.get('choices', []):
+                        content += choice.get('delta', {}).get('content') or ''
+                    usage = chunk.get('usage') or usage
+                    on_delta(_strip_bold(content))
+        else:
+            response = await self.providers.xai.post("/chat/completions", json=payload)
+            _check_rate_limit(response)
+            response_data = response.json()
+            if sampled(logger):
+                logger.debug("%s response: %s", self.name, response_data)
+            if 'error' in response_data:
+                raise BackendError(str(response_data['error']))
+            content = response_data['choices'][0]['message']['content']
+            usage = response_data.get('usage')
+        if usage:
+            self.report_usage(_field(usage, 'prompt_tokens'), _field(usage, 'prompt_tokens_details', 'cached_tokens'),
+                              completion_tokens=_field(usage, 'completion_tokens'))
+        # Strip bold markers
+        return _strip_bold(content)
+
+
+class GeminiBackend(Backend):
+    name = 'gemini'
+
+    def __init__(self, providers, model="gemini-1.5-flash"):
+        self.providers = providers
+        self.model = model
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.3, lang='ru', context='', on_delta=None):
+        payload = {
+            "contents": [{
+                "parts": [
+                    {"text": system_prompt},
+                    *([{"text": context}] if context else []),
+                    *[{"text": msg['content']} for msg in messages],
+                    {"text": prompt}
+                ]
+            }]
+        }
+        usage = None
+        if on_delta is not None:
+            content = ""
+            async with self.providers.gemini.stream(
+                "POST",
+                f"/models/{self.model}:streamGenerateContent",
+                params={"alt": "sse"},
+                json=payload
+            ) as response:
+                _check_rate_limit(response)
+                if response.status_code != 200:
+                    await response.aread()
+                    response_data = response.json()
+                    if isinstance(response_data, list):
+                        response_data = response_data[0]
+                    raise BackendError(f"API: {response_data['error']['message']}")
+                async for chunk in iter_sse_json(response):
+                    for candidate in chunk.get('candidates', []):
+                        for part in candidate.get('content', {}).get('parts', []):
+                            content += part.get('text', '')
+                    usage = chunk.get('usageMetadata') or usage
+                    on_delta(_strip_bold(content))
+        else:
+            response = await self.providers.gemini.post(f"/models/{self.model}:generateContent", json=payload)
+            _check_rate_limit(response)
+            response_data = response.json()
+            if sampled(logger):
+                logger.debug("%s response: %s", self.name, response_data)
+            if 'error' in response_data:
+                raise BackendError(f"API: {response_data['error']['message']}")
+            # Extract the text from the first candidate
+            content = response_data['candidates'][0]['content']['parts'][0]['text']
+            usage = response_data.get('usageMetadata')
+        if usage:
+            self.report_usage(_field(usage, 'promptTokenCount'), _field(usage, 'cachedContentTokenCount'),
+                              completion_tokens=_field(usage, 'candidatesTokenCount'))
+
+        # Strip bold markers and collapse blank lines
+        return re.sub(r'\n{3,}', '\n\n', _strip_bold(content))
+
+
+class AnthropicBackend(Backend):
+    name = 'anthropic'
+
+    def __init__(self, providers, model="claude-3-5-sonnet-20241022", max_tokens=1000):
+        self.providers = providers
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def _report(self, message):
+        usage = message.usage
+        cached = _field(usage, 'cache_read_input_tokens')
+        written = _field(usage, 'cache_creation_input_tokens')
+        # input_tokens excludes the cached part, so the prompt size is the sum of all three
+        self.report_usage(_field(usage, 'input_tokens') + cached + written, cached, written, _field(usage, 'output_tokens'))
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.7, lang='ru', context='', on_delta=None):
+        # The stable system prompt becomes an explicit cache breakpoint when it is long enough to be cached;
+        # the per-call context follows it uncached
+        block = {"type": "text", "text": system_prompt}
+        if estimate_tokens(system_prompt) >= CACHE_MIN_PREFIX_TOKENS:
+            block["cache_control"] = {"type": "ephemeral"}
+        system = [block]
+        if context:
+            system.append({"type": "text", "text": context})
+        request = dict(
+            model=self.model,
+            max_tokens=self.max_tokens,
+            temperature=temperature,
+            system=system,
+            messages=[
+                *messages,
+                {"role": "user", "content": prompt}
+            ]
+        )
+        if on_delta is not None:
+            response = ""
+            async with self.providers.anthropic.messages.stream(**request) as stream:
+                async for text in stream.text_stream:
+                    response += text
+                    on_delta(response)
+                self._report(await stream.get_final_message())
+            return response
+
+        message = await self.providers.anthropic.messages.create(**request)
+        self._report(message)
+        # Get the text from the response
+        if isinstance(message.content, list):
+            response = message.content[0].text
+        else:
+            response = message.content
+
+        # Clean up the response
+        if isinstance(response, str):
+            response = response.replace('[TextBlock(citations=None, text=', '')
+            response = response.replace(", type='text')]", '')
+            response = response.replace('\\n', '\n')
+        return response
+
+
+class OpenAIBackend(Backend):
+    name = 'openai'
+
+    def __init__(self, providers, model="gpt-4o-mini", max_tokens=1000):
+        self.providers = providers
+        self.model = model
+        self.max_tokens = max_tokens
+
+    def _report(self, usage):
+        if usage is not None:
+            self.report_usage(_field(usage, 'prompt_tokens'), _field(usage, 'prompt_tokens_details', 'cached_tokens'),
+                              completion_tokens=_field(usage, 'completion_tokens'))
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.7, lang='ru', context='', on_delta=None):
+        # The language line is fixed per language, so it stays part of the prefix OpenAI caches automatically
+        # (only from CACHE_MIN_PREFIX_TOKENS on, which the current prompts do not reach)
+        system_prompt = f"{system_prompt}\nRespond in {'Russian' if lang == 'ru' else 'English'}."
+        response = await self.providers.openai.chat.completions.create(
+            model=self.model,
+            messages=[
+                {"role": "system", "content": system_prompt},
+                *([{"role": "system", "content": context}] if context else []),
+                *messages,
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=self.max_tokens,
+            temperature=temperature,
+            stream=on_delta is not None,
+            # Sent as a raw field so usage also arrives at the end of a stream with the pinned SDK version
+            extra_body={"stream_options": {"include_usage": True}} if on_delta is not None else None
+        )
+        if on_delta is not None:
+            content = ""
+            async for chunk in response:
+                if chunk.choices:
+                    content += chunk.choices[0].delta.content or ''
+                    on_delta(content)
+                self._report(getattr(chunk, 'usage', None))
+            return content
+        self._report(response.usage)
+        return response.choices[0].message.content
+
+
+class FakeBackend(Backend):
+    """In-process provider with configurable latency and error rate, for offline routing tests"""
+
+    def __init__(self, name='fake', latency=0.0, jitter=0.0, error_rate=0.0, reply=None, chunks=5):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.reply = reply
+        self.chunks = chunks
+        self.calls = 0
+
+    async def complete(self, system_prompt, messages, prompt, temperature=0.7, lang='ru', context='', on_delta=None):
+        self.calls += 1
+        delay = max(0.0, self.latency + random.uniform(-self.jitter, self.jitter))
+        if random.random() < self.error_rate:
+            await asyncio.sleep(delay / 2)
+            raise BackendError(f"{self.name}: simulated failure")
+
+        text = self.reply or f"[{self.name}] {prompt[:80]}"
+        if on_delta is None:
+            await asyncio.sleep(delay)
+            return text
+        step = max(1, len(text) // self.chunks)
+        for end in range(step, len(text) + step, step):
+            await asyncio.sleep(delay / self.chunks)
+            on_delta(text[:end])
+        return text
+
+
+class BackendStats:
+    """Live latency and error-rate measurements for one backend"""
+
+    def __init__(self):
+        self.latency = None  # EWMA of successful call latency, seconds
+        self.error_rate = 0.0  # EWMA of failures
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.calls = 0
+        self.failures = 0
+        self.samples = deque(maxlen=LATENCY_SAMPLES)  # recent successful latencies
+        self.prompt_tokens = 0
+        self.cached_tokens = 0  # prompt tokens served from the provider's prefix cache
+        self.cache_writes = 0
+        self.completion_tokens = 0
+
+    def record_success(self, latency):
+        self.calls += 1
+        self.samples.append(latency)
+        self.latency = latency if self.latency is None else (1 - EWMA_ALPHA) * self.latency + EWMA_ALPHA * latency
+        self.error_rate *= (1 - EWMA_ALPHA)
+        self.consecutive_failures = 0
+
+    def record_failure(self, latency):
+        self.calls += 1
+        self.failures += 1
+        self.error_rate = (1 - EWMA_ALPHA) * self.error_rate + EWMA_ALPHA
+        self.consecutive_failures += 1
+        # A slow failure also worsens the latency estimate
+        self.latency = latency if self.latency is None else max(self.latency, latency)
+        if self.consecutive_failures >= BREAKER_FAILURES:
+            self.open_until = time.monotonic() + BREAKER_COOLDOWN
+
+    @property
+    def available(self):
+        return time.monotonic() >= self.open_until
+
+    def percentile(self, percent):
+        """Latency percentile over recent successful calls, or None without samples"""
+        if not self.samples:
+            return None
+        ordered = sorted(self.samples)
+        index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+        return ordered[index]
+
+
+def parse_routes(spec):
+    """Parses 'CTO=anthropic,openai;DEFAULT=openai' into {role: [backend, ...]}"""
+    routes = {}
+    for item in (spec or '').split(';'):
+        if '=' not in item:
+            continue
+        role, names = item.split('=', 1)
+        routes[role.strip().upper()] = [name.strip() for name in names.split(',') if name.strip()]
+    return routes
+
+
+class BackendRouter:
+    """Maps each role to an ordered list of backends and picks among them by live latency and errors"""
+
+    def __init__(self, routes=None, default_route=None, attempt_timeout=ROUTER_ATTEMPT_TIMEOUT, hedging=HEDGE_REQUESTS, scheduler=None, metrics=None):
+        self.backends = {}
+        self.scheduler = scheduler  # RequestScheduler applying per-provider rate limits, optional
+        self.metrics = metrics  # Metrics registry for latency, token and error series, optional
+        self.stats = {}
+        self.routes = dict(DEFAULT_ROUTES if routes is None else routes)
+        self.default_route = list(default_route or DEFAULT_ROUTE)
+        self.attempt_timeout = attempt_timeout
+        self.hedging = hedging
+        self.hedge_stats = {'requests': 0, 'hedged': 0, 'hedge_wins': 0, 'primary_wins': 0}
+
+    def register(self, backend):
+        """Adds or replaces a backend under its name"""
+        self.backends[backend.name] = backend
+        self.stats.setdefault(backend.name, BackendStats())
+        backend.usage_listener = self._record_usage
+        return backend
+
+    def _record_usage(self, name, prompt_tokens, cached_tokens, cache_writes, completion_tokens=0):
+        stats = self.stats[name]
+        stats.prompt_tokens += prompt_tokens
+        stats.cached_tokens += cached_tokens
+        stats.cache_writes += cache_writes
+        stats.completion_tokens += completion_tokens
+        if self.metrics is not None:
+            self.metrics.inc('prompt_tokens_total', prompt_tokens, provider=name)
+            self.metrics.inc('cached_tokens_total', cached_tokens, provider=name)
+            self.metrics.inc('completion_tokens_total', completion_tokens, provider=name)
+
+    def _record_error(self, name, error):
+        if self.metrics is not None:
+            self.metrics.inc('provider_errors_total', provider=name, kind=error_kind(error))
+
+    def route(self, role):
+        return [name for name in self.routes.get(role, self.default_route) if name in self.backends]
+
+    def _degraded(self, name, fastest):
+        """True when the backend should yield its place: failing often, or much slower than the fastest measured one.
+        A backend without measurements is never compared, so an untried fallback cannot overtake the primary."""
+        stats = self.stats[name]
+        if stats.error_rate > ROUTE_ERROR_THRESHOLD:
+            return True
+        return stats.latency is not None and fastest is not None and stats.latency > fastest * ROUTE_SLOWDOWN_FACTOR
+
+    def candidates(self, role):
+        """Backends for a role in the configured order; degraded backends, then open circuits, go last"""
+        names = self.route(role)
+        measured = [self.stats[name].latency for name in names if self.stats[name].latency is not None]
+        fastest = min(measured) if measured else None
+        ranked = sorted(
+            enumerate(names),
+            key=lambda item: (not self.stats[item[1]].available, self._degraded(item[1], fastest), item[0])
+        )
+        return [name for _, name in ranked]
+
+    async def _attempt(self, name, role, request, on_delta):
+        """One call to one backend with the attempt timeout; updates its live measurements"""
+        backend = self.backends[name]
+        started = None
+
+        async def call():
+            nonlocal started
+            # Time spent waiting for the rate limiter is not the backend's latency
+            started = time.monotonic()
+            return await asyncio.wait_for(backend.complete(*request, on_delta=on_delta), timeout=self.attempt_timeout)
+
+        try:
+            if self.scheduler is None:
+                result = await call()
+            else:
+                system_prompt, messages, prompt, _, _, context = request
+                tokens = request_tokens(system_prompt, messages, prompt, context) + getattr(backend, 'max_tokens', EXPECTED_OUTPUT_TOKENS)
+                result = await self.scheduler.run(name, call, tokens=tokens)
+        except asyncio.CancelledError:
+            raise
+        except QueueFull as e:
+            # Our own backlog, not a backend fault: fail over without touching its stats
+            logger.warning("Backend %s queue full for %s: %s", name, role, e)
+            self._record_error(name, e)
+            raise
+        except Exception as e:
+            # The scheduler can fail before the call starts; that is not the backend's latency or fault
+            if started is not None:
+                self.stats[name].record_failure(time.monotonic() - started)
+            self._record_error(name, e)
+            if str(e):
+                logger.warning("Backend %s failed for %s: %s", name, role, e)
+                raise
+            # Timeouts carry no message; the original stays as __cause__ so error_kind still sees it
+            error = BackendError(f"{name}: {type(e).__name__}")
+            logger.warning("Backend %s failed for %s: %s", name, role, error)
+            raise error from e
+        latency = time.monotonic() - started
+        self.stats[name].record_success(latency)
+        if self.metrics is not None:
+            self.metrics.observe('provider_latency_seconds', latency, provider=name)
+        return result
+
+    async def complete(self, role, system_prompt, messages, prompt, temperature=0.7, lang='ru', context='', on_delta=None):
+        """Calls the best backend for the role and fails over to the next one on errors or timeouts"""
+        candidates = self.candidates(role)
+        if not candidates:
+            raise BackendError(f"No backend configured for {role}")
+
+        request = (system_prompt, messages, prompt, temperature, lang, context)
+        if self.hedging and len(candidates) > 1:
+            return await self._complete_hedged(role, candidates, request, on_delta)
+
+        last_error = None
+        for name in candidates:
+            try:
+                return await self._attempt(name, role, request, on_delta)
+            except Exception as e:
+                last_error = e
+        raise last_error
+
+    def hedge_delay(self, name):
+        """How long to wait for a backend before hedging: its latency percentile once enough samples exist"""
+        stats = self.stats[name]
+        if len(stats.samples) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        return max(HEDGE_MIN_DELAY, stats.percentile(HEDGE_PERCENTILE))
+
+    async def _complete_hedged(self, role, candidates, request, on_delta):
+        """Starts the best backend and, if it is slower than usual, the next one; the first answer wins"""
+        self.hedge_stats['requests'] += 1
+        remaining = list(candidates)
+        primary = remaining[0]
+        pending = {}
+        stream_owner = None
+        hedged = False
+        last_error = None
+
+        def owned_delta(name):
+            # With streaming, the first backend to produce text owns the message and the others are cancelled
+            def _delta(text):
+                nonlocal stream_owner
+                if stream_owner is None:
+                    stream_owner = name
+                    for task, task_name in pending.items():
+                        if task_name != name:
+                            task.cancel()
+                if stream_owner == name:
+                    on_delta(text)
+            return _delta
+
+        def launch():
+            name = remaining.pop(0)
+            delta = owned_delta(name) if on_delta is not None else None
+            pending[asyncio.create_task(self._attempt(name, role, request, delta))] = name
+
+        launch()
+        try:
+            while pending:
+                timeout = None
+                if not hedged and remaining and stream_owner is None:
+                    timeout = self.hedge_delay(primary)
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done and stream_owner is not None:
+                    # Text started arriving while we waited: the streaming backend keeps the request
+                    continue
+                if not done:
+                    hedged = True
+                    self.hedge_stats['hedged'] += 1
+                    logger.debug("Hedging %s: %s slower than %.1fs, asking %s", role, primary, timeout, remaining[0])
+                    launch()
+                    continue
+                for task in done:
+                    name = pending.pop(task)
+                    if task.cancelled():
+                        continue
+                    if task.exception() is None:
+                        if hedged:
+                            self.hedge_stats['hedge_wins' if name != primary else 'primary_wins'] += 1
+                        return task.result()
+                    last_error = task.exception()
+                    if stream_owner == name:
+                        stream_owner = None
+                # Everything in flight failed: fail over to the next backend
+                if not pending and remaining:
+                    launch()
+            raise last_error or BackendError(f"No backend answered for {role}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def hedge_report(self):
+        """Hedge rate and wins, to tune the extra cost of hedging"""
+        requests = self.hedge_stats['requests']
+        return {
+            **self.hedge_stats,
+            'hedge_rate': self.hedge_stats['hedged'] / requests if requests else 0.0,
+        }
+
+    def cache_report(self):
+        """Prompt tokens served from provider prefix caches, per backend"""
+        return {
+            name: {
+                'prompt_tokens': stats.prompt_tokens,
+                'cached_tokens': stats.cached_tokens,
+                'cache_writes': stats.cache_writes,
+                'hit_rate': stats.cached_tokens / stats.prompt_tokens if stats.prompt_tokens else 0.0,
+            }
+            for name, stats in self.stats.items()
+        }
+
+    def snapshot(self):
+        """Current measurements per backend"""
+        return {
+            name: {
+                'latency': stats.latency,
+                'error_rate': stats.error_rate,
+                'calls': stats.calls,
+                'failures': stats.failures,
+                'available': stats.available,
+            }
+            for name, stats in self.stats.items()
+        }
+
+
+def build_router(providers, routes=None, scheduler=None, metrics=None):
+    """Router with the four real providers; ROLE_BACKENDS overrides the default routes"""
+    if routes is None:
+        routes = dict(DEFAULT_ROUTES)
+        routes.update(parse_routes(os.getenv('ROLE_BACKENDS')))
+    default_route = routes.pop('DEFAULT', None)
+    router = BackendRouter(routes=routes, default_route=default_route, scheduler=scheduler, metrics=metrics)
+    router.register(XAIBackend(providers))
+    router.register(GeminiBackend(providers))
+    router.register(AnthropicBackend(providers))
+    router.register(OpenAIBackend(providers))
+    return router
@@ -0,0 +1,702 @@
+"""Offline benchmark: drives the bot's handlers with synthetic updates against fake providers.
+
+    python benchmark.py --concurrency 1,16,64 --updates 200 --output results.json
+    python benchmark.py --baseline results.json    # exits 1 on a regression or a failed check
+    python benchmark.py --soak --soak-hours 6       # memory soak: exits 1 if per-chat memory keeps growing
+
+Nothing leaves the process: the four providers are FakeBackends with the configured latency and
+error rate, Telegram calls are fake messages with a fixed round trip, and chat state goes to an
+in-memory backend (or the RESP stand-in with --state redis, or a temporary SQLite file).
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import itertools
+import platform
+import tempfile
+import statistics
+import tracemalloc
+from collections import deque
+from types import SimpleNamespace
+
+# Must be set before bot.py builds its session store
+os.environ.setdefault('STATE_BACKEND', 'memory')
+
+SCENARIOS = ('message', 'ask', 'discussion', 'news', 'slow_cto')
+DEFAULT_PROFILES = {
+    'openai': '0.05:0.02:0',
+    'anthropic': '0.08:0.03:0',
+    'xai': '0.06:0.02:0',
+    'gemini': '0.04:0.02:0',
+}
+TOPIC_MARKER = re.compile(r'#(\d+)#')
+# Relative frequency of the user journeys in the soak run
+SOAK_FLOWS = {'dialog': 5, 'ask': 2, 'news': 2, 'discussion': 1, 'team': 1, 'search': 1, 'stop': 1}
+# A small pool, so repeated stories also exercise the analysis cache at its capacity
+NEWS_STORIES = tuple(f"{subject} {event}" for subject in ('Fed', 'ECB', 'OPEC', 'Nvidia', 'Bitcoin ETF')
+                     for event in ('beats expectations', 'surprises markets', 'cuts guidance', 'faces probe'))
+
+
+def parse_profile(spec):
+    """'mean[:jitter[:error_rate]]' in seconds -> (latency, jitter, error_rate)"""
+    parts = [float(part) for part in spec.split(':')] + [0.0, 0.0]
+    return parts[0], parts[1], parts[2]
+
+
+def percentile(values, percent):
+    """Nearest-rank percentile of an unsorted list"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, min(len(ordered) - 1, int(round(percent / 100 * len(ordered))) - 1))]
+
+
+class FakeTelegram:
+    """Shared counters and round-trip time of the fake Bot API"""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.sent = 0
+        self.edits = 0
+
+    async def call(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+
+
+class FakeMessage:
+    _ids = itertools.count(1)
+
+    def __init__(self, telegram, chat_id, text=None):
+        self.telegram = telegram
+        self.chat_id = chat_id
+        self.message_id = next(self._ids)
+        self.text = text
+        self.caption = None
+        self.photo = None
+        self.video = None
+        self.document = None
+        self.chat = SimpleNamespace(id=chat_id, type='private')
+
+    async def reply_text(self, text, **kwargs):
+        await self.telegram.call()
+        self.telegram.sent += 1
+        return FakeMessage(self.telegram, self.chat_id, text)
+
+    async def reply_document(self, document, **kwargs):
+        await self.telegram.call()
+        self.telegram.sent += 1
+        return FakeMessage(self.telegram, self.chat_id)
+
+    async def edit_text(self, text, **kwargs):
+        await self.telegram.call()
+        self.telegram.edits += 1
+        self.text = text
+        return self
+
+    async def edit_reply_markup(self, reply_markup=None, **kwargs):
+        await self.telegram.call()
+        self.telegram.edits += 1
+        return self
+
+    async def delete(self):
+        await self.telegram.call()
+
+
+def fake_update(telegram, update_id, chat_id, text):
+    return SimpleNamespace(
+        update_id=update_id,
+        effective_chat=SimpleNamespace(id=chat_id, type='private'),
+        effective_user=SimpleNamespace(id=chat_id),
+        message=FakeMessage(telegram, chat_id, text),
+        callback_query=None,
+    )
+
+
+def fake_callback(telegram, update_id, chat_id, data):
+    """Button press on one of the bot's earlier messages"""
+    async def answer(*args, **kwargs):
+        pass
+
+    update = fake_update(telegram, update_id, chat_id, None)
+    update.callback_query = SimpleNamespace(data=data, message=update.message, answer=answer)
+    update.message = None
+    return update
+
+
+class FakeOpenAIClient:
+    """chat.completions.create with the 'openai' profile, for the news desks that call the SDK directly"""
+
+    def __init__(self, latency, jitter, error_rate):
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.calls = 0
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, messages, max_tokens=500, response_format=None, **kwargs):
+        self.calls += 1
+        await asyncio.sleep(max(0.0, self.latency + random.uniform(-self.jitter, self.jitter)))
+        if random.random() < self.error_rate:
+            raise RuntimeError("openai: simulated failure")
+        if response_format:
+            sections = {'buy': 'SPY', 'sell': '', 'hedge': 'VIX'}
+            content = json.dumps({desk: sections for desk in ('indices', 'commodities', 'forex', 'stocks', 'crypto')})
+        else:
+            content = "✅ Buy: SPY\n❌ Sell: -\n🛡 Hedge: VIX"
+        usage = SimpleNamespace(prompt_tokens=sum(len(m['content']) for m in messages) // 4, completion_tokens=len(content) // 4)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=usage)
+
+
+class Bench:
+    def __init__(self, bot, args):
+        self.bot = bot
+        self.args = args
+        self.telegram = FakeTelegram(args.telegram_latency)
+        self.update_ids = itertools.count(1)
+        self.chat_ids = itertools.count(1_000_000)
+        self.profiles = {name: parse_profile(spec) for name, spec in DEFAULT_PROFILES.items()}
+        for spec in args.provider:
+            name, _, profile = spec.partition('=')
+            self.profiles[name] = parse_profile(profile)
+        self.checks = {}
+
+    def install_providers(self, overrides=None):
+        """Replaces the real backends with fakes; returns {name: FakeBackend}"""
+        from backends import BackendStats, FakeBackend
+        profiles = {**self.profiles, **(overrides or {})}
+        fakes = {}
+        for name, (latency, jitter, error_rate) in profiles.items():
+            fakes[name] = self.bot.router.register(FakeBackend(name, latency=latency, jitter=jitter, error_rate=error_rate))
+            # Live latency estimates from the previous scenario would skew routing
+            self.bot.router.stats[name] = BackendStats()
+        self.bot.news_handler.set_openai_client(FakeOpenAIClient(*profiles['openai']))
+        return fakes
+
+    async def dispatch(self, handler, update, args=()):
+        """Runs an update through the same pipeline as the Application: hydrate, handler, persist"""
+        context = SimpleNamespace(args=list(args), bot=None)
+        await self.bot.hydrate_session(update, context)
+        await handler(update, context)
+        await self.bot.persist_session(update, context)
+
+    def new_chat(self):
+        return next(self.chat_ids)
+
+    # Each scenario returns (handler, update) pairs; state a handler expects is set up here
+
+    def message_jobs(self, count):
+        chats = [self.new_chat() for _ in range(max(1, min(count, self.args.chats)))]
+        return [(self.bot.message_handler, fake_update(self.telegram, next(self.update_ids), chats[i % len(chats)], f"How do rates affect us? ({i})"))
+                for i in range(count)]
+
+    def ask_jobs(self, count):
+        roles = list(self.bot.PERSONALITIES)
+        jobs = []
+        for i in range(count):
+            update = fake_update(self.telegram, next(self.update_ids), self.new_chat(), f"Question {i}")
+            role = roles[i % len(roles)]
+            jobs.append((lambda u, c, role=role: self.bot.process_ask(u, c, role, u.message.text), update))
+        return jobs
+
+    def discussion_jobs(self, count):
+        roles = list(self.bot.PERSONALITIES)[:self.args.discussion_roles]
+
+        async def run(update, context):
+            chat_id = update.effective_chat.id
+            # Registered like process_chat does, so the loop runs exactly one cycle
+            self.bot.chat_tasks[chat_id] = asyncio.current_task()
+            try:
+                await self.bot.chat_loop(update, context, update.message.text, roles)
+            finally:
+                self.bot.chat_tasks.pop(chat_id, None)
+
+        jobs = []
+        for _ in range(count):
+            chat_id = self.new_chat()
+            jobs.append((run, fake_update(self.telegram, next(self.update_ids), chat_id, f"Market outlook #{chat_id}#")))
+        return jobs
+
+    def news_jobs(self, count):
+        jobs = []
+        for i in range(count):
+            chat_id = self.new_chat()
+            self.bot.news_handler.start_news_mode(chat_id)
+            # Distinct texts so every update is a cache miss
+            jobs.append((self.bot.news_handler.handle_message, fake_update(self.telegram, next(self.update_ids), chat_id, f"Central bank surprises markets, story {chat_id}")))
+        return jobs
+
+    def slow_cto_jobs(self, count):
+        jobs = self.message_jobs(count)
+        for i, (_, update) in enumerate(jobs):
+            if i % self.args.cto_every == 0:
+                self.bot.current_dialogs[update.effective_chat.id] = 'CTO'
+        return jobs
+
+    async def run_jobs(self, jobs, concurrency):
+        """Feeds jobs with at most `concurrency` in flight; returns (latencies, errors, wall time)"""
+        gate = asyncio.Semaphore(concurrency)
+        latencies = [None] * len(jobs)
+        errors = 0
+
+        async def one(index, handler, update):
+            nonlocal errors
+            async with gate:
+                started = time.perf_counter()
+                try:
+                    await self.dispatch(handler, update)
+                except Exception:
+                    errors += 1
+                latencies[index] = time.perf_counter() - started
+
+        started = time.perf_counter()
+        await asyncio.gather(*(one(i, handler, update) for i, (handler, update) in enumerate(jobs)))
+        return latencies, errors, time.perf_counter() - started
+
+    async def scenario(self, name, concurrency):
+        overrides = {}
+        routes = dict(self.bot.router.routes)
+        if name == 'slow_cto':
+            overrides['anthropic'] = (self.args.slow_cto, 0.0, 0.0)
+            # Pinned so the router cannot move the CTO to a fast backend once anthropic measures slow
+            self.bot.router.routes['CTO'] = ['anthropic']
+        fakes = self.install_providers(overrides)
+        jobs = getattr(self, f"{name}_jobs")(self.args.updates)
+        try:
+            latencies, errors, wall = await self.run_jobs(jobs, concurrency)
+        finally:
+            self.bot.router.routes = routes
+        result = summarize(latencies, errors, wall)
+        result.update(scenario=name, concurrency=concurrency, provider_calls={n: f.calls for n, f in fakes.items()})
+
+        if name == 'discussion':
+            self.checks[f"discussion_isolation@{concurrency}"] = self.check_isolation(jobs)
+        if name == 'slow_cto':
+            self.checks[f"slow_cto_nonblocking@{concurrency}"] = self.check_slow_cto(jobs, latencies, fakes['anthropic'].calls)
+        return result
+
+    def check_isolation(self, jobs):
+        """Every chat's transcript mentions only its own topic marker"""
+        leaks = 0
+        for _, update in jobs:
+            chat_id = update.effective_chat.id
+            session = self.bot.discussions.get(chat_id)
+            for message in session.transcript if session else ():
+                leaks += any(int(marker) != chat_id for marker in TOPIC_MARKER.findall(message['response']))
+        return {'passed': leaks == 0, 'chats': len(jobs), 'foreign_messages': leaks}
+
+    def check_slow_cto(self, jobs, latencies, slow_calls):
+        """Chats not talking to the slow CTO must finish well before it answers, and every CTO
+        reply must really have waited for the slow backend"""
+        fast, slow = [], []
+        for (_, update), latency in zip(jobs, latencies):
+            (slow if self.bot.current_dialogs.get(update.effective_chat.id) == 'CTO' else fast).append(latency)
+        fast_p95 = percentile(fast, 95)
+        return {
+            'passed': fast_p95 is not None and fast_p95 < self.args.slow_cto / 2 and slow_calls >= len(slow),
+            'other_chats_p95': fast_p95,
+            'cto_p50': percentile(slow, 50),
+            'slow_backend_calls': slow_calls,
+        }
+
+
+class Soak:
+    """Hours of mixed multi-chat traffic replayed in compressed time while tracemalloc watches the heap.
+
+    Simulated time runs `time_scale` times faster than the clock: the gaps between a user's messages
+    are slept scaled down, and the bot's idle, sweep and mode timeouts are divided by the same factor,
+    so chats go idle, modes expire and sweeps run as often relative to the traffic as in production.
+    Provider and Telegram latencies stay real, which only makes each simulated call look slower.
+    """
+
+    def __init__(self, bench, args):
+        self.bench = bench
+        self.bot = bench.bot
+        self.args = args
+        self.scale = args.time_scale
+        self.started = None
+        self.sessions = set()
+        self.last_active = {}  # chat_id -> simulated minute of its latest update, pruned past the idle timeout
+        self.returning = deque(maxlen=500)  # earlier chats that may come back after being evicted
+        self.samples = []
+        self.errors = 0
+
+    def now(self):
+        """Simulated minutes since the start"""
+        return (time.monotonic() - self.started) * self.scale / 60
+
+    async def pause(self, minutes):
+        await asyncio.sleep(minutes * 60 / self.scale)
+
+    async def run_update(self, handler, update, args=()):
+        self.last_active[update.effective_chat.id] = self.now()
+        try:
+            await self.bench.dispatch(handler, update, args)
+        except Exception:
+            self.errors += 1
+
+    async def send(self, handler, chat_id, text, args=()):
+        await self.run_update(handler, fake_update(self.bench.telegram, next(self.bench.update_ids), chat_id, text), args)
+
+    async def press(self, chat_id, data):
+        await self.run_update(self.bot.button, fake_callback(self.bench.telegram, next(self.bench.update_ids), chat_id, data))
+
+    # User journeys; the ones that end without /exit or a button press leave their mode to expire
+
+    async def dialog(self, chat_id):
+        for i in range(random.randint(1, 6)):
+            await self.send(self.bot.message_handler, chat_id, f"How do rates affect our book? ({i})")
+            await self.pause(random.uniform(0.5, 10))
+
+    async def ask(self, chat_id):
+        await self.send(self.bot.ask_specific, chat_id, "/ask")
+        await self.pause(random.uniform(0.2, 2))
+        if random.random() < 0.8:
+            role = random.choice(list(self.bot.PERSONALITIES))
+            await self.send(self.bot.message_handler, chat_id, f"{role} what is the biggest risk this quarter?")
+
+    async def news(self, chat_id):
+        await self.send(self.bot.news_command, chat_id, "/news")
+        for _ in range(random.randint(1, 3)):
+            await self.pause(random.uniform(0.5, 4))
+            await self.send(self.bot.message_handler, chat_id, random.choice(NEWS_STORIES))
+        if random.random() < 0.5:
+            await self.send(self.bot.exit_mode, chat_id, "/exit")
+
+    async def discussion(self, chat_id, team=False):
+        if team:
+            await self.send(self.bot.team_chat, chat_id, "/team")
+            text = "CEO,CTO,CFO expansion into Asia"
+        else:
+            await self.send(self.bot.chat, chat_id, "/chat")
+            text = "Expansion into Asia"
+        await self.pause(random.uniform(0.2, 2))
+        # One cycle, then the Continue / End buttons
+        await self.send(self.bot.message_handler, chat_id, text)
+        await self.cycle(chat_id)
+        choice = random.random()
+        if choice < 0.2:
+            await self.pause(random.uniform(0.2, 2))
+            await self.press(chat_id, self.bot.CALLBACK_CONTINUE)
+            await self.cycle(chat_id)
+        if choice < 0.6:
+            await self.pause(random.uniform(0.2, 2))
+            await self.press(chat_id, self.bot.CALLBACK_END)
+
+    async def cycle(self, chat_id):
+        """Waits for the discussion cycle the handler started in the background"""
+        task = self.bot.chat_tasks.get(chat_id)
+        if task is not None:
+            await asyncio.wait([task])
+
+    async def team(self, chat_id):
+        await self.discussion(chat_id, team=True)
+
+    async def search(self, chat_id):
+        await self.dialog(chat_id)
+        await self.send(self.bot.search_history, chat_id, "/search rates", args=['rates'])
+        await self.press(chat_id, 'search_page_1')
+        await self.send(self.bot.filter_history_by_date, chat_id, "/filter 1h", args=['1h'])
+
+    async def stop(self, chat_id):
+        await self.dialog(chat_id)
+        await self.send(self.bot.stop, chat_id, "/stop")
+
+    async def session(self):
+        if self.returning and random.random() < self.args.returning:
+            chat_id = random.choice(self.returning)
+        else:
+            chat_id = self.bench.new_chat()
+        flow = random.choices(list(SOAK_FLOWS), weights=list(SOAK_FLOWS.values()))[0]
+        try:
+            await getattr(self, flow)(chat_id)
+        except Exception:
+            self.errors += 1
+        self.returning.append(chat_id)
+
+    async def traffic(self, minutes):
+        """New chat sessions as a Poisson process until `minutes` of simulated time have passed"""
+        rate = self.args.chats_per_hour / 60
+        while self.now() < minutes:
+            await self.pause(random.expovariate(rate))
+            task = asyncio.create_task(self.session())
+            self.sessions.add(task)
+            task.add_done_callback(self.sessions.discard)
+
+    def active_chats(self):
+        """Chats that sent an update within the idle timeout; older ones are the sweeper's to drop"""
+        horizon = self.now() - self.bot.chat_memory.idle_timeout * self.scale / 60
+        for chat_id in [chat_id for chat_id, minute in self.last_active.items() if minute < horizon]:
+            del self.last_active[chat_id]
+        return len(self.last_active)
+
+    def tables(self):
+        """Sizes of the global per-chat structures"""
+        bot = self.bot
+        sizes = {name: len(table) for name, table in bot.session_store.tables.items()}
+        sizes.update(
+            chat_tasks=len(bot.chat_tasks),
+            discussions=len(bot.discussions),
+            search_indexes=len(bot.search_indexes),
+            search_queries=len(bot.search_queries),
+            filter_ranges=len(bot.filter_ranges),
+            news_mode_chats=len(bot.news_handler.news_mode_chats),
+            token_savings=len(bot.history_summarizer.token_savings),
+            last_seen=len(bot.chat_memory.last_seen),
+            hydrated=len(bot.session_store._hydrated),
+            written=len(bot.session_store._written),
+            outbox_pending=len(bot.outbox.pending),
+            outbox_workers=len(bot.outbox.workers),
+        )
+        return sizes
+
+    def sample(self):
+        traced, _ = tracemalloc.get_traced_memory()
+        active = self.active_chats()
+        self.samples.append({
+            'minute': round(self.now(), 1),
+            'traced_bytes': traced,
+            'active_chats': active,
+            'bytes_per_active_chat': traced / max(active, 1),
+            'sessions_in_flight': len(self.sessions),
+            'tables': self.tables(),
+        })
+
+    async def run(self):
+        total = self.args.soak_hours * 60
+        tracemalloc.start(25)
+        self.started = time.monotonic()
+        traffic = asyncio.create_task(self.traffic(total))
+        # Caches, pools and the resident set fill up first; growth is measured from there on
+        await self.pause(total * self.args.warmup)
+        first = tracemalloc.take_snapshot()
+        while self.now() < total:
+            self.sample()
+            await self.pause(self.args.sample_minutes)
+        last = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        await traffic
+        if self.sessions:
+            await asyncio.wait(list(self.sessions))
+
+        # With traffic over and no budget left, every chat is idle and must leave memory completely
+        memory = self.bot.chat_memory
+        memory.budget = 0
+        await asyncio.sleep(max(memory.idle_timeout, self.bot.MODE_TIMEOUT * 60) + 3 * memory.sweep_interval)
+        residual = {name: size for name, size in self.tables().items() if size}
+
+        ignore = (tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, '<frozen *>'), tracemalloc.Filter(False, '<unknown>'))
+        growth = [str(stat) for stat in last.filter_traces(ignore).compare_to(first.filter_traces(ignore), 'lineno')[:10]]
+        return self.check(residual, growth)
+
+    def check(self, residual, growth):
+        """Per-chat memory of the late samples against the early ones, and what survived the drain"""
+        window = max(1, len(self.samples) // 4)
+        early = statistics.median(sample['bytes_per_active_chat'] for sample in self.samples[:window])
+        late = statistics.median(sample['bytes_per_active_chat'] for sample in self.samples[-window:])
+        limit = self.args.soak_threshold_kb * 1024
+        return {
+            'per_chat_growth': {'passed': late - early <= limit, 'early_bytes': round(early), 'late_bytes': round(late), 'limit_bytes': limit},
+            'drained': {'passed': not residual, 'residual': residual},
+            'handler_errors': {'passed': self.errors == 0, 'errors': self.errors},
+        }, growth
+
+
+def summarize(latencies, errors, wall):
+    return {
+        'updates': len(latencies),
+        'errors': errors,
+        'wall_seconds': wall,
+        'updates_per_second': len(latencies) / wall if wall else None,
+        'p50': percentile(latencies, 50),
+        'p95': percentile(latencies, 95),
+        'p99': percentile(latencies, 99),
+        'mean': sum(latencies) / len(latencies) if latencies else None,
+    }
+
+
+def compare(results, baseline, tolerance):
+    """Regressions against a previous run: p95 up or throughput down by more than `tolerance`"""
+    previous = {(item['scenario'], item['concurrency']): item for item in baseline.get('results', [])}
+    regressions = []
+    for item in results:
+        before = previous.get((item['scenario'], item['concurrency']))
+        if not before:
+            continue
+        if before['p95'] and item['p95'] > before['p95'] * (1 + tolerance):
+            regressions.append(f"{item['scenario']}@{item['concurrency']}: p95 {before['p95']:.3f}s -> {item['p95']:.3f}s")
+        if before['updates_per_second'] and item['updates_per_second'] < before['updates_per_second'] * (1 - tolerance):
+            regressions.append(f"{item['scenario']}@{item['concurrency']}: {before['updates_per_second']:.1f} -> {item['updates_per_second']:.1f} updates/s")
+    return regressions
+
+
+async def prepare(bot, args):
+    """Points the bot at the chosen state backend and strips pacing; returns an async cleanup callable"""
+    from logs import setup_logging
+    from storage import RedisBackend, RespStandIn, SQLiteBackend
+    setup_logging(level=args.log_level)
+
+    standin = directory = None
+    if args.state == 'redis':
+        standin = await RespStandIn().start()
+        bot.session_store.backend = RedisBackend(standin.url)
+    elif args.state == 'sqlite':
+        directory = tempfile.mkdtemp(prefix='agihedge-bench-')
+        bot.session_store.backend = SQLiteBackend(os.path.join(directory, 'sessions.db'))
+    # Real pacing would make every run last seconds per chat; keep it only when it is what is measured
+    if not args.telegram_pacing:
+        bot.outbox.chat_interval = 0.0
+        bot.outbox.global_interval = 0.0
+    if not args.rate_limits:
+        bot.router.scheduler = None
+        for specialist in [*bot.news_handler.desks.values(), bot.news_handler.combined_specialist]:
+            specialist.scheduler = None
+    await bot.session_store.start()
+
+    async def cleanup():
+        await bot.session_store.close()
+        if standin is not None:
+            await standin.stop()
+        if directory is not None:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    return cleanup
+
+
+def meta(args, bench):
+    return {
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'argv': sys.argv[1:],
+        'profiles': {name: list(profile) for name, profile in bench.profiles.items()},
+        'state': args.state,
+        'telegram_latency': args.telegram_latency,
+    }
+
+
+def scenario_levels(name, levels):
+    """Concurrency levels to run a scenario at; slow_cto only shows isolation with other chats in flight"""
+    if name != 'slow_cto':
+        return levels
+    return [level for level in levels if level >= 2] or [2]
+
+
+async def run(args):
+    import bot
+    cleanup = await prepare(bot, args)
+    bench = Bench(bot, args)
+    results = []
+    try:
+        for name in args.scenario:
+            for concurrency in scenario_levels(name, args.concurrency):
+                result = await bench.scenario(name, concurrency)
+                results.append(result)
+                print(f"{name:<11} c={concurrency:<4} {result['updates_per_second']:8.1f} upd/s  "
+                      f"p50 {result['p50'] * 1000:7.1f}ms  p95 {result['p95'] * 1000:7.1f}ms  "
+                      f"p99 {result['p99'] * 1000:7.1f}ms  errors {result['errors']}")
+    finally:
+        await cleanup()
+
+    print_checks(bench.checks)
+    return {'meta': meta(args, bench), 'results': results, 'checks': bench.checks}
+
+
+async def soak(args):
+    import bot
+    cleanup = await prepare(bot, args)
+    bench = Bench(bot, args)
+    bench.install_providers()
+    memory = bot.chat_memory
+    memory.idle_timeout /= args.time_scale
+    memory.sweep_interval /= args.time_scale
+    memory.budget = int(args.history_budget_mb * 1024 * 1024)
+    bot.MODE_TIMEOUT /= args.time_scale
+    memory.start()
+    runner = Soak(bench, args)
+    try:
+        checks, growth = await runner.run()
+    finally:
+        memory.stop()
+        await cleanup()
+
+    for sample in runner.samples:
+        print(f"{sample['minute'] / 60:6.2f}h  traced {sample['traced_bytes'] / 1024:9.0f} KiB  "
+              f"active {sample['active_chats']:5d}  per chat {sample['bytes_per_active_chat'] / 1024:7.1f} KiB  "
+              f"resident {sample['tables'].get('dialog_histories', 0):5d}")
+    if not checks['per_chat_growth']['passed']:
+        print("Largest allocation growth since warm-up:")
+        for line in growth:
+            print(f"  {line}")
+    print_checks(checks)
+    return {'meta': meta(args, bench), 'samples': runner.samples, 'growth': growth, 'checks': checks}
+
+
+def print_checks(checks):
+    for name, check in checks.items():
+        print(f"{name}: {'ok' if check['passed'] else 'FAILED'} {json.dumps({k: v for k, v in check.items() if k != 'passed'})}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline throughput and latency benchmark")
+    parser.add_argument('--scenario', action='append', choices=SCENARIOS, help="repeatable; all scenarios by default")
+    parser.add_argument('--concurrency', default='1,8,32', help="comma-separated in-flight update counts")
+    parser.add_argument('--updates', type=int, default=100, help="updates per scenario and concurrency level")
+    parser.add_argument('--chats', type=int, default=50, help="distinct chats in the message scenario")
+    parser.add_argument('--provider', action='append', default=[], metavar='NAME=MEAN[:JITTER[:ERRORS]]',
+                        help="latency profile of a fake provider, e.g. anthropic=0.5:0.1:0.02")
+    parser.add_argument('--telegram-latency', type=float, default=0.01, help="seconds per fake Bot API call")
+    parser.add_argument('--telegram-pacing', action='store_true', help="keep the outbox's per-chat and global pacing")
+    parser.add_argument('--rate-limits', action='store_true', help="keep the per-provider RPM/TPM scheduler")
+    parser.add_argument('--state', choices=('memory', 'redis', 'sqlite'),
+                        help="session backend; redis uses the in-process RESP stand-in, sqlite a temporary file "
+                             "(default: memory, sqlite with --soak so evicted chats leave the heap)")
+    parser.add_argument('--discussion-roles', type=int, default=3, help="executives per discussion cycle")
+    parser.add_argument('--slow-cto', type=float, default=2.0, help="CTO provider latency in the slow_cto scenario")
+    parser.add_argument('--cto-every', type=int, default=5, help="every n-th chat talks to the CTO in slow_cto")
+    parser.add_argument('--output', help="write results as JSON")
+    parser.add_argument('--baseline', help="previous JSON results to compare against")
+    parser.add_argument('--tolerance', type=float, default=0.2, help="allowed relative p95/throughput change")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--log-level', default='WARNING')
+    soak_group = parser.add_argument_group('soak', "simulated hours of mixed traffic, checking per-chat memory")
+    soak_group.add_argument('--soak', action='store_true', help="run the soak test instead of the scenarios")
+    soak_group.add_argument('--soak-hours', type=float, default=6.0, help="simulated duration")
+    soak_group.add_argument('--time-scale', type=float, default=600.0, help="simulated seconds per real second")
+    soak_group.add_argument('--chats-per-hour', type=float, default=300.0, help="new chat sessions per simulated hour")
+    soak_group.add_argument('--returning', type=float, default=0.3, help="share of sessions from a chat seen before")
+    soak_group.add_argument('--sample-minutes', type=float, default=15.0, help="simulated minutes between memory samples")
+    soak_group.add_argument('--warmup', type=float, default=0.25, help="share of the run before sampling starts")
+    soak_group.add_argument('--soak-threshold-kb', type=float, default=16.0,
+                            help="allowed growth of traced memory per active chat between the first and last quarter of samples")
+    soak_group.add_argument('--history-budget-mb', type=float, default=0.05, help="history budget, small so eviction starts during the warm-up")
+    args = parser.parse_args(argv)
+    args.scenario = args.scenario or list(SCENARIOS)
+    args.concurrency = [int(value) for value in args.concurrency.split(',') if value.strip()]
+    args.state = args.state or ('sqlite' if args.soak else 'memory')
+    if args.soak and args.baseline:
+        parser.error("--baseline compares scenario runs, not soak runs")
+    random.seed(args.seed)
+
+    report = asyncio.run(soak(args) if args.soak else run(args))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+
+    failed = [name for name, check in report['checks'].items() if not check['passed']]
+    if args.baseline:
+        with open(args.baseline, encoding='utf-8') as f:
+            regressions = compare(report['results'], json.load(f), args.tolerance)
+        for line in regressions:
+            print(f"REGRESSION {line}")
+        failed += regressions
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,21 +1,38 @@
 import os
+import time
+import signal
+import heapq
 import asyncio
+import logging
+import itertools
 from typing import Dict, Optional
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, Message
-from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, filters
+from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler, MessageHandler, TypeHandler, filters
 from dotenv import load_dotenv
-from openai import AsyncOpenAI
-from anthropic import Anthropic
 from personalities import CEO, CMO, CTO, CFO, CISO, CDO, CLO, CRO
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from collections import defaultdict
 from news import NewsHandler
-import httpx
-import re
+from providers import ProviderClients
+from streaming import STREAM_REPLIES, StreamingReply
+from outbox import SendQueue
+from webhook import BOT_MODE, WEBHOOK_MAX_CONNECTIONS, WEBHOOK_SECRET, WEBHOOK_URL, WebhookServer
+from backends import build_router
+from ratelimit import QueueFull, RequestScheduler, retry_after_from
+from storage import SessionStore
+from sharding import SHARD_URLS, ChatOrderedProcessor, ShardForwarder
+from discussions import DISCUSSION_MODE, DISCUSSION_PANEL, DISCUSSION_SEQUENTIAL, DiscussionSession, panel_roles
+from search import ChatIndex
+from logs import bind, dropped_records, new_request_id, sampled, setup_logging, shutdown_logging
+from metrics import METRICS_LISTEN, METRICS_PATH, METRICS_PORT, Metrics, error_kind
+from export import EXPORT_FORMATS, export_filename, snapshot, write_export
+from history import ChatMemory, HistorySummarizer, estimate_tokens, entry_tokens, load_histories, local_time, merge_histories, new_history, recent, select_window, time_range, timestamp, token_budget
 
 # Загружаем переменные окружения
 load_dotenv()
 
+logger = logging.getLogger('bot')
+
 # Получаем токены
 TELEGRAM_TOKEN = os.getenv('TELEGRAM_TOKEN')
 OPENAI_API_KEY = os.getenv('OPENAI_API_KEY')
@@ -23,6 +40,41 @@ ANTHROPIC_API_KEY = os.getenv('ANTHROPIC_API_KEY')
 XAI_API_KEY = os.getenv('XAI_API_KEY')
 GEMINI_API_KEY = os.getenv('GEMINI_API_KEY')
 
+# Общие клиенты провайдеров с пулами keep-alive соединений
+providers = ProviderClients(
+    openai_api_key=OPENAI_API_KEY,
+    anthropic_api_key=ANTHROPIC_API_KEY,
+    xai_api_key=XAI_API_KEY,
+    gemini_api_key=GEMINI_API_KEY
+)
+
+# Общая очередь исходящих сообщений Telegram: темп по чату и глобально, flood-wait, склейка коротких сообщений
+outbox = SendQueue()
+
+# Общий планировщик запросов: лимиты RPM/TPM на провайдера, ограниченная очередь и Retry-After
+scheduler = RequestScheduler()
+
+# Метрики: гистограммы задержек, счетчики токенов и ошибок, глубина очередей
+metrics = Metrics()
+metrics.describe('provider_latency_seconds', "Latency of successful model calls per provider")
+metrics.describe('role_latency_seconds', "Time to a complete answer per executive, failover included")
+metrics.describe('prompt_tokens_total', "Prompt tokens reported by providers")
+metrics.describe('cached_tokens_total', "Prompt tokens served from provider prefix caches")
+metrics.describe('completion_tokens_total', "Completion tokens reported by providers")
+metrics.describe('provider_errors_total', "Failed model calls by provider and kind (error, timeout, rate_limited)")
+metrics.describe('role_errors_total', "Answers that failed on every backend, by executive and kind")
+metrics.describe('news_desk_seconds', "News desk analysis time by desk and outcome")
+metrics.describe('news_analysis_seconds', "Whole news report time")
+metrics.describe('messages_total', "Answered messages per executive")
+metrics.describe('shard_updates_dropped_total', "Updates for another shard given up on, by shard and reason")
+metrics.gauge('log_records_dropped', dropped_records, "Log records dropped because the writer thread fell behind")
+metrics.gauge('outbox_depth', lambda: outbox.depth(), "Telegram messages waiting to be sent")
+metrics.gauge('provider_queue_depth', lambda: {name: limiter['waiting'] for name, limiter in scheduler.report().items()},
+              "Model calls waiting for the provider's rate limit", label='provider')
+
+# Реестр провайдеров: для каждой роли упорядоченный список бэкендов
+router = build_router(providers, scheduler=scheduler, metrics=metrics)
+
 # Глобальные переменные для хранения состояний
 chat_states = {}  # формат: {chat_id: {'mode': 'ask'/'chat'/'team', 'timestamp': datetime}}
 chat_tasks = {}  # формат: {chat_id: task}
@@ -30,9 +82,66 @@ current_dialogs = {}  # формат: {chat_id: role}
 dialog_histories = {}  # формат: {chat_id: {role: [{'user': msg, 'assistant': resp}]}}
 user_languages = {}  # формат: {chat_id: 'ru'/'en'}
 dialog_depths = {}  # формат: {chat_id: depth}
-discussion_cycles = {}  # формат: {chat_id: {'messages_count': int, 'roles_count': int}}
-discussion_history = []  # формат: [{'role': role, 'response': response}, ...]
+discussions = {}  # формат: {chat_id: DiscussionSession}
+discussion_modes = {}  # формат: {chat_id: 'sequential'/'panel'}
 team_roles = {}  # формат: {chat_id: [roles]}
+history_summaries = {}  # формат: {chat_id: {role: {'summary': str, 'marker': str}}}
+
+def merge_dialog_histories(chat_id, stored, current):
+    """Объединяет сохраненную историю с записями, сделанными пока чат был выгружен"""
+    search_indexes.pop(chat_id, None)  # индекс перестроится по объединенной истории
+    return merge_histories(stored, current)
+
+# Постоянное хранилище состояний чатов: переживает перезапуски процесса
+session_store = SessionStore()
+session_store.register('chat_states', chat_states)
+session_store.register('current_dialogs', current_dialogs)
+session_store.register('dialog_histories', dialog_histories, load=load_histories, merge=merge_dialog_histories)
+session_store.register('user_languages', user_languages)
+session_store.register('dialog_depths', dialog_depths)
+session_store.register('team_roles', team_roles)
+session_store.register('history_summaries', history_summaries)
+session_store.register('discussion_modes', discussion_modes)
+
+async def evict_chat(chat_id: int):
+    """Выгружает неактивный чат из памяти; при включенном хранилище он загрузится снова при обращении"""
+    if session_store.enabled:
+        await session_store.evict(chat_id)
+    else:
+        dialog_histories.pop(chat_id, None)
+        history_summaries.pop(chat_id, None)
+    history_summarizer.token_savings.pop(chat_id, None)
+    discussions.pop(chat_id, None)
+    search_indexes.pop(chat_id, None)
+    search_queries.pop(chat_id, None)
+    filter_ranges.pop(chat_id, None)
+    # Закончившийся цикл обсуждения без ответа на кнопки больше не держит чат
+    if chat_id in chat_tasks and chat_tasks[chat_id].done():
+        del chat_tasks[chat_id]
+
+# История каждой роли ограничена кольцевым буфером, неактивные чаты выгружаются при превышении бюджета памяти
+chat_memory = ChatMemory(dialog_histories, on_evict=evict_chat, is_busy=lambda chat_id: chat_id in chat_tasks and not chat_tasks[chat_id].done())
+
+# Поисковые индексы истории по чатам; строятся при первом обращении и дополняются с каждой новой записью
+search_indexes = {}  # формат: {chat_id: ChatIndex}
+search_queries = {}  # формат: {chat_id: последний запрос /search} для перелистывания страниц
+filter_ranges = {}  # формат: {chat_id: (start, end)} последнего /filter для перелистывания страниц
+
+def chat_index(chat_id: int) -> ChatIndex:
+    if chat_id not in search_indexes:
+        search_indexes[chat_id] = ChatIndex.build(dialog_histories.get(chat_id, {}))
+    return search_indexes[chat_id]
+
+def remember_turn(chat_id: int, role: str, user_text: str, response: str):
+    """Добавляет реплику в историю роли и в поисковый индекс чата"""
+    index = chat_index(chat_id)
+    histories = dialog_histories.setdefault(chat_id, {})
+    if role not in histories:
+        histories[role] = new_history()
+    entry = {'user': user_text, 'assistant': response, 'date': timestamp()}
+    histories[role].append(entry)
+    index.add(role, entry)
+    update_usage_stats(chat_id, role)
 
 # Добавляем переменную для хранения текущей роли
 current_role = {}
@@ -46,6 +155,12 @@ MODE_NEWS = 'news'
 MODE_TIMEOUT = 5
 DEFAULT_HISTORY_DEPTH = 5
 MAX_HISTORY_DEPTH = 10
+# Результатов на странице /search и /filter и длина фрагмента реплики в них
+RESULTS_PAGE_SIZE = 5
+SNIPPET_LENGTH = 300
+# Количество апдейтов, обрабатываемых одновременно (медленный ответ одного чата не блокирует остальные);
+# апдейты одного чата обрабатываются по очереди в порядке поступления
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '256'))
 
 # Константы для callback данных кнопок
 CALLBACK_CONTINUE = 'continue_discussion'
@@ -120,6 +235,8 @@ You can also just send a message and CEO will respond to it!""",
         'role_question': "Please specify role and question!\nExample: /ask CEO how to increase profit?",
         'unknown_role': "Unknown role! Available roles: {}",
         'team_format': "Please specify roles and topic!\nExample: /team CEO,CTO,CFO discuss new trading strategy",
+        'panel_on': "Panel mode is on: all roles answer at once, then {} sums up",
+        'panel_off': "Panel mode is off: roles answer one after another",
         'team_started': "📋 Starting discussion on topic: {}\nParticipants:\n{}",
         'unknown_command': """❌ Unknown command: {}
 
@@ -137,13 +254,14 @@ You can also just send a message and CEO will respond to it!""",
         'depth_set': "History depth set to {} messages",
         'depth_invalid': "Please specify a number between 1 and 50",
         'export_empty': "No dialog history to export",
+        'export_usage': "Usage: /export [txt|jsonl|csv] [gz]",
         'current_depth': "Current history depth: {} messages",
         'usage_stats': "Usage Statistics",
         'search_no_keywords': "Please provide keywords to search for.",
         'search_no_results': "No results found for the given keywords.",
         'search_results': "Search Results",
-        'filter_no_dates': "Please provide start and end dates in the format YYYY-MM-DD.",
-        'filter_invalid_dates': "Invalid date format. Please use YYYY-MM-DD.",
+        'filter_no_dates': "Please provide a start and optionally an end: YYYY-MM-DD, YYYY-MM-DDTHH:MM or a period like 2h, 30m, 3d.",
+        'filter_invalid_dates': "Invalid date format. Please use YYYY-MM-DD, YYYY-MM-DDTHH:MM or a period like 2h, 30m, 3d.",
         'filter_no_results': "No results found for the given date range.",
         'filter_results': "Filtered Results",
     },
@@ -178,6 +296,8 @@ You can also just send a message and CEO will respond to it!""",
         'role_question': "Пожалуйста, укажите роль и вопрос!\nНапример: /ask CEO как увеличить прибыль?",
         'unknown_role': "Неизвестная роль! Доступные роли: {}",
         'team_format': "Пожалуйста, укажите роли и тему!\nНапример: /team CEO,CTO,CFO обсудить новую торговую стратегию",
+        'panel_on': "Режим панели включен: все роли отвечают одновременно, затем {} подводит итог",
+        'panel_off': "Режим панели выключен: роли отвечают по очереди",
         'team_started': "📋 Начинаем обсуждение темы: {}\nУчастники:\n{}",
         'unknown_command': """❌ Неизвестная команда: {}
 
@@ -195,13 +315,14 @@ You can also just send a message and CEO will respond to it!""",
         'depth_set': "Глубина истории установлена на {} сообщений",
         'depth_invalid': "Укажите число от 1 до 50",
         'export_empty': "Нет истории диалогов для экспорта",
+        'export_usage': "Использование: /export [txt|jsonl|csv] [gz]",
         'current_depth': "Текущая глубина истории: {} сообщений",
         'usage_stats': "Статистика использования",
         'search_no_keywords': "Пожалуйста, укажите ключевые слова для поиска.",
         'search_no_results': "По заданным ключевым словам ничего не найдено.",
         'search_results': "Результаты поиска",
-        'filter_no_dates': "Пожалуйста, укажите начальную и конечную даты в формате ГГГГ-ММ-ДД.",
-        'filter_invalid_dates': "Неверный формат даты. Пожалуйста, используйте ГГГГ-ММ-ДД.",
+        'filter_no_dates': "Пожалуйста, укажите начало и при необходимости конец: ГГГГ-ММ-ДД, ГГГГ-ММ-ДДTЧЧ:ММ или период вида 2h, 30m, 3d.",
+        'filter_invalid_dates': "Неверный формат даты. Используйте ГГГГ-ММ-ДД, ГГГГ-ММ-ДДTЧЧ:ММ или период вида 2h, 30m, 3d.",
         'filter_no_results': "По заданному диапазону дат ничего не найдено.",
         'filter_results': "Отфильтрованные результаты",
     }
@@ -220,145 +341,155 @@ def update_usage_stats(chat_id, role):
     usage_stats['role_distribution'][role] += 1
     current_hour = datetime.now().hour
     usage_stats['hour_distribution'][current_hour] += 1
+    metrics.inc('messages_total', role=role)
 
 def get_message(chat_id: int, key: str) -> str:
     # Английский язык по умолчанию
     lang = user_languages.get(chat_id, 'en')
     return MESSAGES[lang][key]
 
-async def get_chatgpt_response(prompt, personality, lang='ru', selected_roles=None, dialog_history=None, chat_id=None):
+async def summarize_history(previous_summary: str, entries: list) -> str:
+    """Сворачивает старые реплики диалога в краткое резюме (выполняется в фоне)"""
+    turns = "\n\n".join(f"User: {entry['user']}\nAssistant: {entry['assistant']}" for entry in entries)
+    prompt = f"Previous summary:\n{previous_summary}\n\n" if previous_summary else ""
+    prompt += f"New conversation turns:\n{turns}\n\nUpdate the summary so it covers everything above in at most 150 words. Keep facts, decisions, numbers and open questions. Write it in the language of the conversation."
+    return await router.complete(
+        'SUMMARY',
+        "You maintain concise running summaries of conversations.",
+        [],
+        prompt,
+        temperature=0.2,
+        lang='en'
+    )
+
+# Резюме старых реплик обновляется в фоне, запрос использует последнюю готовую версию
+history_summarizer = HistorySummarizer(history_summaries, summarize_history)
+
+async def get_chatgpt_response(prompt, personality, lang='ru', selected_roles=None, dialog_history=None, chat_id=None, on_delta=None):
+    # on_delta(text) вызывается с накопленным текстом, если нужен потоковый ответ
     try:
+        # Системный промпт роли неизменен и идет первым, чтобы провайдеры кэшировали его как префикс;
+        # состав команды меняется от чата к чату и передается отдельно после него
         system_prompt = personality['system_prompt']
+        team_info = ''
         if selected_roles:
-            team_info = f"\nВ обсуждении участвуют только: {', '.join(selected_roles)}" if lang == 'ru' else f"\nOnly following roles participate in discussion: {', '.join(selected_roles)}"
-            system_prompt += team_info
+            team_info = f"В обсуждении участвуют только: {', '.join(selected_roles)}" if lang == 'ru' else f"Only following roles participate in discussion: {', '.join(selected_roles)}"
 
         messages = []
         if dialog_history:
             depth = dialog_depths.get(chat_id, DEFAULT_HISTORY_DEPTH)
-            for entry in dialog_history[-depth:]:
+            # Окно истории ограничено и числом записей, и наименьшим бюджетом токенов среди провайдеров маршрута роли:
+            # при переключении или хеджировании запрос может обслужить любой из них
+            route = router.route(personality['name']) or ['openai']
+            window, older, window_tokens = select_window(dialog_history, depth, min(token_budget(name) for name in route))
+
+            # Более старые реплики заменяются резюме, которое обновляется в фоне
+            summary = history_summarizer.summary_for(chat_id, personality['name'])
+            if summary:
+                messages.extend([
+                    {"role": "user", "content": f"Summary of our earlier conversation:\n{summary}"},
+                    {"role": "assistant", "content": "Noted."}
+                ])
+            for entry in window:
                 messages.extend([
                     {"role": "user", "content": entry['user']},
                     {"role": "assistant", "content": entry['assistant']}
                 ])
+            if chat_id is not None:
+                history_summarizer.schedule(chat_id, personality['name'], older)
+                baseline_tokens = sum(entry_tokens(entry) for entry in recent(dialog_history, depth))
+                history_summarizer.record(chat_id, baseline_tokens, window_tokens + (estimate_tokens(summary) if summary else 0))
         
-        if personality['name'] == 'CMO':
-            # Используем API xAI для CMO
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    "https://api.x.ai/v1/chat/completions",
-                    headers={
-                        "Content-Type": "application/json",
-                        "Authorization": f"Bearer {XAI_API_KEY}"
-                    },
-                    json={
-                        "messages": [
-                            {"role": "system", "content": system_prompt},
-                            *messages,
-                            {"role": "user", "content": prompt}
-                        ],
-                        "model": "grok-2-vision-1212",
-                        "stream": False,
-                        "temperature": TEMPERATURES.get(personality['name'], 0.9)
-                    }
-                )
-                response_data = response.json()
-                print("Response Data:", response_data)  # Подробный отладочный вывод
-                content = response_data['choices'][0]['message']['content']
-                # Убираем звездочки
-                formatted_content = re.sub(r'\*\*', '', content)
-                return formatted_content
-        elif personality['name'] == 'CFO':
-            # Используем API Gemini для CFO
-            async with httpx.AsyncClient(timeout=30.0) as client:
-                response = await client.post(
-                    f"https://generativelanguage.googleapis.com/v1beta/models/gemini-1.5-flash:generateContent?key={GEMINI_API_KEY}",
-                    headers={
-                        "Content-Type": "application/json"
-                    },
-                    json={
-                        "contents": [{
-                            "parts": [
-                                {"text": system_prompt},
-                                *[{"text": msg['content']} for msg in messages],
-                                {"text": prompt}
-                            ]
-                        }]
-                    }
-                )
-                response_data = response.json()
-                print("Response Data:", response_data)  # Подробный отладочный вывод
-
-                if 'error' in response_data:
-                    error_message = response_data['error']['message']
-                    return f"Ошибка API: {error_message}"
-
-                # Извлечение текста из правильного места в ответе
-                content = response_data['candidates'][0]['content']['parts'][0]['text']
-                
-                # Убираем звездочки
-                formatted_content = re.sub(r'\*\*', '', content)
-                
-                # Убираем двойные пустые строки
-                formatted_content = re.sub(r'\n{3,}', '\n\n', formatted_content)
-                
-                return formatted_content
-        elif personality['name'] == 'CTO':
-            # Используем Anthropic для CTO
-            client = Anthropic(api_key=ANTHROPIC_API_KEY)
-            message = client.messages.create(
-                model="claude-3-5-sonnet-20241022",
-                max_tokens=1000,
-                temperature=TEMPERATURES.get(personality['name'], 0.7),
-                system=system_prompt,
-                messages=[
-                    *messages,
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ]
-            )
-            # Получаем текст из ответа
-            if isinstance(message.content, list):
-                response = message.content[0].text
-            else:
-                response = message.content
-
-            # Очищаем ответ
-            if isinstance(response, str):
-                response = response.replace('[TextBlock(citations=None, text=', '')
-                response = response.replace(", type='text')]", '')
-                response = response.replace('\\n', '\n')
-            
-            return response
-        else:
-            # Для остальных ролей используем OpenAI
-            client = AsyncOpenAI(api_key=OPENAI_API_KEY)
-            system_prompt = f"{system_prompt}\nRespond in {'Russian' if lang == 'ru' else 'English'}."
-            all_messages = [
-                {"role": "system", "content": system_prompt},
-                *messages,
-                {"role": "user", "content": prompt}
-            ]
-            response = await client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=all_messages,
-                max_tokens=1000,
-                temperature=TEMPERATURES.get(personality['name'], 0.7)
-            )
-            return response.choices[0].message.content
+        # Провайдер выбирается маршрутизатором: CMO - xAI, CFO - Gemini, CTO - Anthropic, остальные - OpenAI,
+        # с автоматическим переключением на резервный провайдер при ошибках и задержках
+        started = time.monotonic()
+        response = await router.complete(
+            personality['name'],
+            system_prompt,
+            messages,
+            prompt,
+            temperature=TEMPERATURES.get(personality['name'], 0.7),
+            lang=lang,
+            context=team_info,
+            on_delta=on_delta
+        )
+        metrics.observe('role_latency_seconds', time.monotonic() - started, role=personality['name'])
+        return response
     except Exception as e:
-        print("Exception occurred:", str(e))  # Подробный отладочный вывод
-        import traceback
-        traceback.print_exc()  # Вывод полного стека ошибки
+        metrics.inc('role_errors_total', role=personality['name'], kind=error_kind(e))
+        # Перегрузка провайдеров показывается пользователю отдельно от прочих ошибок
+        if isinstance(e, QueueFull) or retry_after_from(e) is not None:
+            logger.warning("Rate limited for %s: %s", personality['name'], e)
+            return "Слишком много запросов к моделям, попробуйте через минуту." if lang == 'ru' else "Too many requests to the models right now, please try again in a minute."
+        logger.exception("Response for %s failed: %s", personality['name'], e)
         return f"Ошибка: {str(e)}" if lang == 'ru' else f"Error: {str(e)}"
 
-# В начале файла, где у вас уже есть инициализация клиентов
-client = AsyncOpenAI(api_key=OPENAI_API_KEY)
+async def respond(reply_to: Message, role: str, prompt: str, lang: str, selected_roles=None, dialog_history=None, chat_id=None, is_active=None):
+    """Получает ответ роли и отправляет его в чат; в потоковом режиме текст появляется по мере генерации"""
+    emoji = ROLE_EMOJI.get(role, '👤')
+    prefix = f"{emoji} {role}:\n"
+
+    if not STREAM_REPLIES:
+        response = await get_chatgpt_response(prompt, PERSONALITIES[role], lang, selected_roles, dialog_history, chat_id)
+        # Не отправляем ответ, если обсуждение успели остановить
+        if is_active is None or is_active():
+            await outbox.reply(reply_to, f"{prefix}{response}")
+        return response
 
-# Создаем экземпляр обработчика новостей с передачей клиента
-news_handler = NewsHandler(openai_client=client)
+    reply = StreamingReply(reply_to, prefix=prefix, outbox=outbox)
+    try:
+        response = await get_chatgpt_response(prompt, PERSONALITIES[role], lang, selected_roles, dialog_history, chat_id, on_delta=reply.update)
+        if is_active is None or is_active():
+            await reply.finish(response)
+    finally:
+        # Запланированная правка не должна выйти после /stop или отмены задачи чата
+        reply.cancel()
+    return response
+
+# Создаем экземпляр обработчика новостей; клиент OpenAI передается при старте
+news_handler = NewsHandler(scheduler=scheduler, outbox=outbox, metrics=metrics)
+session_store.register('news_mode_chats', news_handler.news_mode_chats)
+metrics.gauge('chats_in_memory', lambda: len(dialog_histories), "Chats with dialog history loaded")
+
+# Локальный HTTP-эндпоинт метрик в текстовом формате Prometheus (METRICS_PORT=0 - выключен)
+metrics_server = WebhookServer(None, path=None, host=METRICS_LISTEN, port=METRICS_PORT, routes={METRICS_PATH: metrics.render}) if METRICS_PORT else None
+
+async def on_startup(application: Application):
+    """Создает и прогревает пулы соединений провайдеров, открывает хранилище состояний"""
+    await session_store.start()
+    chat_memory.start()
+    await providers.start()
+    news_handler.set_openai_client(providers.openai)
+    metrics.gauge('update_queue_depth', application.update_queue.qsize, "Telegram updates waiting to be handled")
+    if metrics_server is not None:
+        await metrics_server.start()
+
+async def on_stop(application: Application):
+    """Дожидается апдейтов, еще стоящих в очередях чатов, пока бот и клиенты провайдеров открыты"""
+    await application.update_processor.join()
+
+async def on_shutdown(application: Application):
+    """Закрывает пулы соединений провайдеров и сохраняет состояния чатов"""
+    chat_memory.stop()
+    if metrics_server is not None:
+        await metrics_server.stop()
+    await providers.close()
+    await session_store.close()
+    news_handler.cache.close()
+
+async def hydrate_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Загружает сохраненное состояние чата перед обработкой первого апдейта"""
+    # Идентификатор запроса попадает во все записи лога этого апдейта и запущенных из него задач
+    bind(request_id=new_request_id(), update_id=update.update_id,
+         chat_id=update.effective_chat.id if update.effective_chat else None)
+    if update.effective_chat:
+        await session_store.hydrate(update.effective_chat.id)
+        chat_memory.touch(update.effective_chat.id)
+
+async def persist_session(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Помечает чат для пакетной записи после обработки апдейта"""
+    if update.effective_chat:
+        session_store.mark_dirty(update.effective_chat.id)
 
 async def check_mode_timeout(chat_id: int) -> bool:
     """Проверяет, не истек ли таймаут режима"""
@@ -372,6 +503,19 @@ async def reset_chat_mode(chat_id: int):
     """Сбрасывает режим чата"""
     if chat_id in chat_states:
         del chat_states[chat_id]
+    news_handler.stop_news_mode(chat_id)
+
+async def expire_chat_modes():
+    """Сбрасывает истекшие режимы и у чатов, которые больше не пишут (иначе таймаут проверяется только при новом сообщении)"""
+    for chat_id in list(chat_states):
+        if await check_mode_timeout(chat_id):
+            session_store.mark_dirty(chat_id)
+    for chat_id in list(news_handler.news_mode_chats):
+        if chat_states.get(chat_id, {}).get('mode') != MODE_NEWS:
+            news_handler.stop_news_mode(chat_id)
+            session_store.mark_dirty(chat_id)
+
+chat_memory.on_sweep = expire_chat_modes
 
 async def set_chat_mode(chat_id: int, mode: str):
     """Устанавливает режим чата"""
@@ -380,77 +524,126 @@ async def set_chat_mode(chat_id: int, mode: str):
         'timestamp': datetime.now()
     }
 
-async def chat_loop(update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str, roles=None):
+async def chat_loop(update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str, roles=None, session=None):
     chat_id = update.effective_chat.id
     lang = user_languages.get(chat_id, 'ru')
-    global discussion_history, discussion_cycles
-    discussion_history = []
     
     if roles is None:
         roles = list(PERSONALITIES.keys())
     
-    discussion_cycles[chat_id] = {'messages_count': 0, 'roles_count': len(roles)}
+    # У каждого чата своя сессия обсуждения; при продолжении передается существующая
+    if session is None:
+        session = DiscussionSession(chat_id, topic, roles, lang, discussion_modes.get(chat_id, DISCUSSION_MODE))
+        discussions[chat_id] = session
     
     try:
+        if session.mode == DISCUSSION_PANEL:
+            await panel_round(update, context, session, topic, lang)
+            return
+
         while chat_id in chat_tasks:
             for role in roles:
                 if chat_id not in chat_tasks:
                     return
                 
                 # Формируем промпт
-                if discussion_history:
+                if session.transcript:
                     context_prompt = f"Тема: {topic}\n\nПредыдущие ответы:\n" if lang == 'ru' else f"Topic: {topic}\n\nPrevious responses:\n"
-                    context_prompt += "\n".join([f"{msg['role']}: {msg['response']}" for msg in discussion_history[-3:]])
+                    context_prompt += "\n".join([f"{msg['role']}: {msg['response']}" for msg in session.recent(3)])
                     prompt = context_prompt + ("\n\nТвой ответ с учетом предыдущих сообщений:" if lang == 'ru' else "\n\nYour response considering previous messages:")
                 else:
                     prompt = f"Тема для обсуждения: {topic}" if lang == 'ru' else f"Discussion topic: {topic}"
                 
-                # Получаем ответ от API
-                print(f"Requesting response for {role} about {topic}")  # Отладочный вывод
-                response = await get_chatgpt_response(prompt, PERSONALITIES[role], lang, roles, dialog_histories.get(chat_id, {}).get(role, []), chat_id)
-                print(f"Got response from {role}: {response[:50]}...")  # Отладочный вывод
+                # Используем правильный объект для отправки сообщения
+                if hasattr(update, 'message') and update.message:
+                    reply_to = update.message
+                else:
+                    reply_to = update.callback_query.message
+
+                # Получаем ответ от API и отправляем его
+                logger.debug("Requesting response for %s about %s", role, topic)
+                response = await respond(
+                    reply_to,
+                    role,
+                    prompt,
+                    lang,
+                    roles,
+                    dialog_histories.get(chat_id, {}).get(role, []),
+                    chat_id,
+                    is_active=lambda: chat_id in chat_tasks
+                )
+                if sampled(logger):
+                    logger.debug("Got response from %s: %s", role, response)
                 
                 if chat_id not in chat_tasks:
                     return
                 
-                # Сохраняем ответ в историю
-                discussion_history.append({'role': role, 'response': response})
-                
-                # Отправляем сообщение
-                emoji = ROLE_EMOJI.get(role, '👤')
-                message = f"{emoji} {role}:\n{response}"
-                print(f"Sending message: {message[:50]}...")  # Отладочный вывод
-                
-                # Используем правильный объект для отправки сообщения
-                if hasattr(update, 'message') and update.message:
-                    await update.message.reply_text(message)
-                elif hasattr(update, 'callback_query') and update.callback_query:
-                    await update.callback_query.message.reply_text(message)
-                
-                # Увеличиваем счетчик сообщений
-                discussion_cycles[chat_id]['messages_count'] += 1
+                # Сохраняем ответ в историю сессии и увеличиваем счетчик сообщений
+                session.add(role, response)
                 
                 # Проверяем количество циклов
-                if discussion_cycles[chat_id]['messages_count'] >= 1 * len(roles):
-                    print("Showing continue buttons...")  # Отладочный вывод
+                if session.cycle_complete:
                     await show_continue_buttons(update, context)
                     return
-                
-                await asyncio.sleep(2)
             
             # Обновляем тему для следующего цикла
-            if discussion_history:
-                topic = f"Продолжи обсуждение, учитывая предыдущие ответы. Развей последнюю мысль: {discussion_history[-1]['response']}" if lang == 'ru' else f"Continue the discussion, considering previous responses. Develop the last thought: {discussion_history[-1]['response']}"
+            if session.transcript:
+                topic = f"Продолжи обсуждение, учитывая предыдущие ответы. Развей последнюю мысль: {session.last_response}" if lang == 'ru' else f"Continue the discussion, considering previous responses. Develop the last thought: {session.last_response}"
     
     except Exception as e:
-        print(f"Error in chat_loop: {str(e)}")  # Отладочный вывод
+        logger.exception("Error in chat_loop: %s", e)
         if chat_id in chat_tasks:
             del chat_tasks[chat_id]
         error_msg = "Произошла ошибка. Обсуждение остановлено." if lang == 'ru' else "An error occurred. Discussion stopped."
         if hasattr(update, 'message') and update.message:
-            await update.message.reply_text(error_msg)
+            await outbox.reply(update.message, error_msg)
         elif hasattr(update, 'callback_query') and update.callback_query:
-            await update.callback_query.message.reply_text(error_msg)
+            await outbox.reply(update.callback_query.message, error_msg)
+
+async def panel_round(update: Update, context: ContextTypes.DEFAULT_TYPE, session: DiscussionSession, topic: str, lang: str):
+    """Раунд панели: все участники отвечают одновременно, затем одна роль подводит итог"""
+    chat_id = session.chat_id
+    reply_to = update.message if hasattr(update, 'message') and update.message else update.callback_query.message
+    is_active = lambda: chat_id in chat_tasks
+    panelists, moderator = panel_roles(session.roles)
+
+    if session.transcript:
+        prompt = f"Тема: {topic}\n\nПредыдущие ответы:\n" if lang == 'ru' else f"Topic: {topic}\n\nPrevious responses:\n"
+        prompt += "\n".join([f"{msg['role']}: {msg['response']}" for msg in session.recent(3)])
+    else:
+        prompt = f"Тема для обсуждения: {topic}" if lang == 'ru' else f"Discussion topic: {topic}"
+
+    # Все участники панели получают одну и ту же тему и отвечают параллельно
+    logger.debug("Panel round about %s: %s, synthesis by %s", topic, panelists, moderator)
+    responses = await asyncio.gather(*[
+        respond(reply_to, role, prompt, lang, session.roles, dialog_histories.get(chat_id, {}).get(role, []), chat_id, is_active=is_active)
+        for role in panelists
+    ])
+    if not is_active():
+        return
+    for role, response in zip(panelists, responses):
+        session.add(role, response)
+
+    # Итоговый раунд: одна роль реагирует на все ответы панели
+    if moderator is not None:
+        synthesis_prompt = f"Тема: {topic}\n\nОтветы участников:\n" if lang == 'ru' else f"Topic: {topic}\n\nPanel responses:\n"
+        synthesis_prompt += "\n".join([f"{role}: {response}" for role, response in zip(panelists, responses)])
+        synthesis_prompt += "\n\nПодведи итог: сравни позиции, отметь согласие и разногласия и предложи решение." if lang == 'ru' else "\n\nSum up: compare the positions, note agreements and disagreements and propose a decision."
+        response = await respond(
+            reply_to,
+            moderator,
+            synthesis_prompt,
+            lang,
+            session.roles,
+            dialog_histories.get(chat_id, {}).get(moderator, []),
+            chat_id,
+            is_active=is_active
+        )
+        if not is_active():
+            return
+        session.add(moderator, response)
+
+    await show_continue_buttons(update, context)
 
 async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -471,12 +664,12 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         # Разбиваем сообщение на роль и вопрос
         parts = message_text.split(maxsplit=1)
         if len(parts) < 2:
-            await update.message.reply_text(get_message(chat_id, 'role_question'))
+            await outbox.reply(update.message, get_message(chat_id, 'role_question'))
             return
         role, question = parts
         role = role.upper()
         if role not in PERSONALITIES:
-            await update.message.reply_text(get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
+            await outbox.reply(update.message, get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
             return
         await process_ask(update, context, role, question)
         await reset_chat_mode(chat_id)
@@ -488,7 +681,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif current_mode == MODE_TEAM:
         parts = message_text.split(maxsplit=1)
         if len(parts) < 2:
-            await update.message.reply_text(get_message(chat_id, 'team_format'))
+            await outbox.reply(update.message, get_message(chat_id, 'team_format'))
             return
         roles, topic = parts
         await process_team(update, context, roles, topic)
@@ -499,7 +692,7 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id in chat_tasks:
         return
 
-    print(f"User ID: {chat_id}")  # Выводит ID в консоль
+    logger.info("User ID: %s", chat_id)
 
     # Используем сохраненную роль или CEO по умолчанию
     role = current_dialogs.get(chat_id, 'CEO')
@@ -508,29 +701,24 @@ async def message_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if chat_id not in dialog_histories:
         dialog_histories[chat_id] = {}
     if role not in dialog_histories[chat_id]:
-        dialog_histories[chat_id][role] = []
+        dialog_histories[chat_id][role] = new_history()
 
     # Получаем историю диалога
     dialog_history = dialog_histories[chat_id][role]
     
-    # Получаем ответ с учетом истории
-    response = await get_chatgpt_response(
-        message_text, 
-        PERSONALITIES[role], 
-        lang, 
-        None, 
+    # Получаем ответ с учетом истории и отправляем его
+    response = await respond(
+        update.message,
+        role,
+        message_text,
+        lang,
+        None,
         dialog_history,
         chat_id
     )
     
     # Сохраняем сообщение и ответ в историю
-    dialog_histories[chat_id][role].append({
-        'user': message_text,
-        'assistant': response
-    })
-    
-    emoji = ROLE_EMOJI.get(role, '👤')
-    await update.message.reply_text(f"{emoji} {role}:\n{response}")
+    remember_turn(chat_id, role, message_text, response)
 
 async def language(update: Update, context: ContextTypes.DEFAULT_TYPE):
     keyboard = [
@@ -540,7 +728,8 @@ async def language(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ]
     ]
     reply_markup = InlineKeyboardMarkup(keyboard)
-    await update.message.reply_text(
+    await outbox.reply(
+        update.message,
         "Выберите язык / Choose your language:",
         reply_markup=reply_markup
     )
@@ -552,7 +741,7 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if query.data.startswith('lang_'):
         lang = query.data.split('_')[1]
         user_languages[query.message.chat_id] = lang
-        await query.message.reply_text(MESSAGES[lang]['lang_changed'])
+        await outbox.reply(query.message, MESSAGES[lang]['lang_changed'])
         # Обновляем сообщение с кнопками
         await query.message.edit_reply_markup(reply_markup=None)
     elif query.data.startswith('switch_'):
@@ -560,32 +749,47 @@ async def button(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id = query.message.chat_id
         current_dialogs[chat_id] = role
         emoji = ROLE_EMOJI.get(role, '👤')
-        await query.message.reply_text(
+        await outbox.reply(
+            query.message,
             get_message(chat_id, 'speaker_changed').format(emoji, role)
         )
         # Обновляем сообщение с кнопками
         await query.message.edit_reply_markup(reply_markup=None)
+    elif query.data.startswith('search_page_'):
+        chat_id = query.message.chat_id
+        if chat_id not in search_queries:
+            await query.message.edit_reply_markup(reply_markup=None)
+            return
+        text, reply_markup = render_search_page(chat_id, int(query.data.rsplit('_', 1)[1]))
+        await query.message.edit_text(text, reply_markup=reply_markup)
+    elif query.data.startswith('filter_page_'):
+        chat_id = query.message.chat_id
+        text, reply_markup = render_filter_page(chat_id, int(query.data.rsplit('_', 1)[1])) if chat_id in filter_ranges else (None, None)
+        if text is None:
+            await query.message.edit_reply_markup(reply_markup=None)
+            return
+        await query.message.edit_text(text, reply_markup=reply_markup)
     elif query.data == CALLBACK_CONTINUE:
         chat_id = query.message.chat_id
-        if chat_id in chat_tasks:
-            discussion_cycles[chat_id]['messages_count'] = 0  # Сбрасываем счетчик сообщений
+        session = discussions.get(chat_id)
+        # Повторное нажатие, пока цикл еще идет, игнорируется
+        if chat_id in chat_tasks and session is not None and chat_tasks[chat_id].done():
+            session.next_cycle()  # Сбрасываем счетчик сообщений
             await query.message.edit_text("Обсуждение продолжается...")
-            # Создаем новую задачу для продолжения обсуждения
-            if discussion_history:
-                last_topic = f"Продолжи обсуждение, учитывая предыдущие ответы. Развей последнюю мысль: {discussion_history[-1]['response']}"
-                # Используем сохраненные роли для режима /team
-                roles = team_roles.get(chat_id, list(PERSONALITIES.keys()))
+            # Создаем новую задачу для продолжения обсуждения этого чата
+            if session.last_response:
+                last_topic = f"Продолжи обсуждение, учитывая предыдущие ответы. Развей последнюю мысль: {session.last_response}"
                 # Создаем фейковый update для chat_loop
                 fake_message = query.message
                 fake_update = Update(update.update_id, message=fake_message)
-                task = asyncio.create_task(chat_loop(fake_update, context, last_topic, roles))
+                task = asyncio.create_task(chat_loop(fake_update, context, last_topic, session.roles, session))
                 chat_tasks[chat_id] = task
     elif query.data == CALLBACK_END:
         chat_id = query.message.chat_id
         if chat_id in chat_tasks:
             del chat_tasks[chat_id]
-        if chat_id in discussion_cycles:
-            del discussion_cycles[chat_id]
+        if chat_id in discussions:
+            del discussions[chat_id]
         if chat_id in team_roles:
             del team_roles[chat_id]
         await reset_chat_mode(chat_id)
@@ -621,7 +825,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "You can also just send a message and the CEO will respond to it!"
     )
     
-    await update.message.reply_text(message)
+    await outbox.reply(update.message, message)
 
 async def process_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, topic: str):
     """Обработка группового чата"""
@@ -629,22 +833,15 @@ async def process_chat(update: Update, context: ContextTypes.DEFAULT_TYPE, topic
     lang = user_languages.get(chat_id, 'ru')
     
     if chat_id in chat_tasks:
-        await update.message.reply_text(get_message(chat_id, 'discussion_already'))
+        await outbox.reply(update.message, get_message(chat_id, 'discussion_already'))
         return
 
-    print(f"Starting chat discussion about: {topic}")  # Отладочный вывод
-    await update.message.reply_text(get_message(chat_id, 'discussion_started').format(topic))
+    logger.info("Starting chat discussion about: %s", topic)
+    await outbox.reply(update.message, get_message(chat_id, 'discussion_started').format(topic))
     
-    # Создаем и сохраняем задачу
-    task = asyncio.create_task(chat_loop(update, context, topic))
-    chat_tasks[chat_id] = task
-    
-    try:
-        await task
-    except Exception as e:
-        print(f"Error in process_chat: {str(e)}")  # Отладочный вывод
-        if chat_id in chat_tasks:
-            del chat_tasks[chat_id]
+    # Цикл идет отдельной задачей и сам обрабатывает свои ошибки: апдейты чата обрабатываются по очереди,
+    # и /stop или кнопки этого чата не должны ждать конца цикла
+    chat_tasks[chat_id] = asyncio.create_task(chat_loop(update, context, topic))
 
 async def process_team(update: Update, context: ContextTypes.DEFAULT_TYPE, roles_str: str, topic: str):
     """Обработка команды team"""
@@ -654,30 +851,22 @@ async def process_team(update: Update, context: ContextTypes.DEFAULT_TYPE, roles
     roles = [role.strip().upper() for role in roles_str.split(',')]
     invalid_roles = [role for role in roles if role not in PERSONALITIES]
     if invalid_roles:
-        await update.message.reply_text(get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
+        await outbox.reply(update.message, get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
         return
     
     if chat_id in chat_tasks:
-        await update.message.reply_text(get_message(chat_id, 'discussion_already'))
+        await outbox.reply(update.message, get_message(chat_id, 'discussion_already'))
         return
     
-    print(f"Starting team discussion about: {topic} with roles: {roles}")  # Отладочный вывод
+    logger.info("Starting team discussion about: %s with roles: %s", topic, roles)
     role_list = ', '.join([f"{ROLE_EMOJI[role]} {role}" for role in roles])
-    await update.message.reply_text(get_message(chat_id, 'team_started').format(topic, role_list))
+    await outbox.reply(update.message, get_message(chat_id, 'team_started').format(topic, role_list))
     
     # Сохраняем роли для продолжения обсуждения
     team_roles[chat_id] = roles
     
-    # Создаем и сохраняем задачу
-    task = asyncio.create_task(chat_loop(update, context, topic, roles))
-    chat_tasks[chat_id] = task
-    
-    try:
-        await task
-    except Exception as e:
-        print(f"Error in process_team: {str(e)}")  # Отладочный вывод
-        if chat_id in chat_tasks:
-            del chat_tasks[chat_id]
+    # Цикл идет отдельной задачей, как в process_chat
+    chat_tasks[chat_id] = asyncio.create_task(chat_loop(update, context, topic, roles))
 
 async def ask_specific(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -685,24 +874,32 @@ async def ask_specific(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await set_chat_mode(chat_id, MODE_ASK)
     prompt = "Enter role and your question in format:\nCEO how to increase profit?"
-    await update.message.reply_text(prompt)
+    await outbox.reply(update.message, prompt)
 
 async def stop(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     if chat_id in chat_tasks:
         chat_tasks[chat_id].cancel()
         del chat_tasks[chat_id]
+    discussions.pop(chat_id, None)
+    team_roles.pop(chat_id, None)
     if chat_id in current_dialogs:
         del current_dialogs[chat_id]
     # Очищаем историю диалога при остановке
     if chat_id in dialog_histories:
         del dialog_histories[chat_id]
-    await update.message.reply_text(get_message(chat_id, 'discussion_stopped'))
+    history_summarizer.reset(chat_id)
+    search_indexes.pop(chat_id, None)
+    search_queries.pop(chat_id, None)
+    filter_ranges.pop(chat_id, None)
+    # Выходим и из режима чата (в том числе новостного)
+    await reset_chat_mode(chat_id)
+    await outbox.reply(update.message, get_message(chat_id, 'discussion_stopped'))
 
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     command = update.message.text
-    await update.message.reply_text(get_message(chat_id, 'unknown_command').format(command))
+    await outbox.reply(update.message, get_message(chat_id, 'unknown_command').format(command))
 
 def get_role_keyboard():
     keyboard = []
@@ -723,7 +920,8 @@ async def switch_speaker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     roles_text = "\n".join([f"{ROLE_EMOJI.get(role, '👤')} {role}" for role in PERSONALITIES.keys()])
     
     # Отправляем сообщение с кнопками
-    await update.message.reply_text(
+    await outbox.reply(
+        update.message,
         get_message(chat_id, 'available_roles').format(roles_text),
         reply_markup=get_role_keyboard()
     )
@@ -732,7 +930,8 @@ async def current_speaker(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     current_role = current_dialogs.get(chat_id, 'CEO')
     emoji = ROLE_EMOJI.get(current_role, '👤')
-    await update.message.reply_text(
+    await outbox.reply(
+        update.message,
         get_message(chat_id, 'current_speaker').format(emoji, current_role)
     )
 
@@ -741,55 +940,66 @@ async def clear_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     role = current_dialogs.get(chat_id, 'CEO')
     
     if chat_id in dialog_histories and role in dialog_histories[chat_id]:
-        dialog_histories[chat_id][role] = []
+        dialog_histories[chat_id][role] = new_history()
+    history_summarizer.reset(chat_id, role)
+    if chat_id in search_indexes:
+        search_indexes[chat_id].reset(role)
     
-    await update.message.reply_text(get_message(chat_id, 'history_cleared').format(role))
+    await outbox.reply(update.message, get_message(chat_id, 'history_cleared').format(role))
 
 async def set_depth(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     if not context.args or not context.args[0].isdigit():
-        await update.message.reply_text(get_message(chat_id, 'depth_invalid'))
+        await outbox.reply(update.message, get_message(chat_id, 'depth_invalid'))
         return
     
     depth = int(context.args[0])
     if depth < 1 or depth > MAX_HISTORY_DEPTH:
-        await update.message.reply_text(get_message(chat_id, 'depth_invalid'))
+        await outbox.reply(update.message, get_message(chat_id, 'depth_invalid'))
         return
     
     dialog_depths[chat_id] = depth
-    await update.message.reply_text(get_message(chat_id, 'depth_set').format(depth))
+    await outbox.reply(update.message, get_message(chat_id, 'depth_set').format(depth))
+
+async def set_panel_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Переключает формат /chat и /team: по очереди или панелью с итоговым раундом"""
+    chat_id = update.effective_chat.id
+    current = discussion_modes.get(chat_id, DISCUSSION_MODE)
+
+    if context.args and context.args[0].lower() in ('on', 'off'):
+        enabled = context.args[0].lower() == 'on'
+    else:
+        enabled = current != DISCUSSION_PANEL
+
+    discussion_modes[chat_id] = DISCUSSION_PANEL if enabled else DISCUSSION_SEQUENTIAL
+    if enabled:
+        await outbox.reply(update.message, get_message(chat_id, 'panel_on').format(panel_roles(PERSONALITIES.keys())[1]))
+    else:
+        await outbox.reply(update.message, get_message(chat_id, 'panel_off'))
 
 async def export_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     lang = user_languages.get(chat_id, 'ru')
     
     if chat_id not in dialog_histories or not dialog_histories[chat_id]:
-        await update.message.reply_text(get_message(chat_id, 'export_empty'))
+        await outbox.reply(update.message, get_message(chat_id, 'export_empty'))
         return
     
-    # Формируем текст для экспорта
-    export_text = "=== Dialog History Export ===\n\n"
-    for role, history in dialog_histories[chat_id].items():
-        if history:
-            export_text += f"=== {role} ===\n"
-            for entry in history:
-                export_text += f"User: {entry['user']}\n"
-                export_text += f"{role}: {entry['assistant']}\n\n"
-    
-    # Создаем временный файл
-    with open(f"history_export_{chat_id}.txt", "w", encoding="utf-8") as f:
-        f.write(export_text)
-    
-    # Отправляем файл
-    with open(f"history_export_{chat_id}.txt", "rb") as f:
-        await update.message.reply_document(
-            document=f,
-            filename=f"dialog_history_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt"
-        )
+    args = [arg.lower() for arg in context.args or []]
+    fmt = next((arg for arg in args if arg in EXPORT_FORMATS), 'txt')
+    compress = any(arg in ('gz', 'gzip') for arg in args)
+    if any(arg not in EXPORT_FORMATS + ('gz', 'gzip') for arg in args):
+        await outbox.reply(update.message, get_message(chat_id, 'export_usage'))
+        return
     
-    # Удаляем временный файл
-    os.remove(f"history_export_{chat_id}.txt")
+    # Экспорт пишется по записям в буфер в памяти (при большом объеме - во временный файл системы)
+    # в отдельном потоке, чтобы не блокировать цикл событий
+    export_file = await asyncio.to_thread(write_export, snapshot(dialog_histories[chat_id]), fmt, compress)
+    try:
+        await outbox.send(chat_id, update.message.reply_document, export_file, filename=export_filename(fmt, compress))
+    finally:
+        export_file.close()
 
 async def show_usage_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
@@ -803,81 +1013,149 @@ async def show_usage_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats_text += "Самые активные часы:\n"
     for hour, count in sorted(usage_stats['hour_distribution'].items()):
         stats_text += f"{hour}:00 - {hour}:59: {count}\n"
+
+    # Экономия токенов истории в этом чате: окно по бюджету и резюме против окна по числу записей
+    savings = history_summarizer.savings_for(chat_id)
+    if savings['baseline']:
+        saved = savings['baseline'] - savings['sent']
+        stats_text += f"Токены истории: отправлено {savings['sent']} вместо {savings['baseline']} (экономия {saved / savings['baseline']:.0%})\n"
     
-    await update.message.reply_text(stats_text)
+    await outbox.reply(update.message, stats_text)
 
 async def search_history(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     lang = user_languages.get(chat_id, 'ru')
     
     if not context.args:
-        await update.message.reply_text(get_message(chat_id, 'search_no_keywords'))
+        await outbox.reply(update.message, get_message(chat_id, 'search_no_keywords'))
         return
     
-    keywords = ' '.join(context.args).lower()
-    results = []
-    
-    for role, history in dialog_histories.get(chat_id, {}).items():
-        for entry in history:
-            if keywords in entry['user'].lower() or keywords in entry['assistant'].lower():
-                results.append((role, entry))
-    
-    if not results:
-        await update.message.reply_text(get_message(chat_id, 'search_no_results'))
+    query = ' '.join(context.args)
+    if not chat_index(chat_id).count(query):
+        await outbox.reply(update.message, get_message(chat_id, 'search_no_results'))
         return
     
-    search_text = f"🔍 {get_message(chat_id, 'search_results')}\n"
+    search_queries[chat_id] = query
+    text, reply_markup = render_search_page(chat_id, 0)
+    await outbox.reply(update.message, text, reply_markup=reply_markup)
+
+def snippet(text: str) -> str:
+    return text if len(text) <= SNIPPET_LENGTH else text[:SNIPPET_LENGTH].rstrip() + "…"
+
+def render_results_page(title: str, results: list, page: int, total: int, callback_prefix: str):
+    """Страница результатов с кнопками перелистывания; длина сообщения ограничена размером страницы и фрагментов"""
+    pages = max(1, (total + RESULTS_PAGE_SIZE - 1) // RESULTS_PAGE_SIZE)
+    text = f"{title} ({page + 1}/{pages})\n\n"
     for role, entry in results:
-        search_text += f"{ROLE_EMOJI.get(role, '👤')} {role}:\n"
-        search_text += f"🗣 User: {entry['user']}\n"
-        search_text += f"👤 {role}: {entry['assistant']}\n\n"
-    
-    await update.message.reply_text(search_text)
+        when = f" · {local_time(entry['date'])}" if entry.get('date') else ""
+        text += f"{ROLE_EMOJI.get(role, '👤')} {role}{when}:\n"
+        text += f"🗣 User: {snippet(entry['user'])}\n"
+        text += f"👤 {role}: {snippet(entry['assistant'])}\n\n"
+
+    buttons = []
+    if page > 0:
+        buttons.append(InlineKeyboardButton("◀️", callback_data=f"{callback_prefix}{page - 1}"))
+    if page + 1 < pages:
+        buttons.append(InlineKeyboardButton("▶️", callback_data=f"{callback_prefix}{page + 1}"))
+    return text, InlineKeyboardMarkup([buttons]) if buttons else None
+
+def render_search_page(chat_id: int, page: int):
+    # Ранжирование по индексу: стоимость зависит от числа совпадений, а не от длины истории
+    index = chat_index(chat_id)
+    query = search_queries.get(chat_id, '')
+    results = index.search(query, limit=(page + 1) * RESULTS_PAGE_SIZE)[page * RESULTS_PAGE_SIZE:]
+    return render_results_page(f"🔍 {get_message(chat_id, 'search_results')}", results, page, index.count(query), 'search_page_')
+
+PERIOD_UNITS = {'m': 'minutes', 'h': 'hours', 'd': 'days'}
+
+def parse_moment(value: str, end: bool = False) -> datetime:
+    """Дата, дата со временем или период назад от текущего момента (2h, 30m, 3d);
+    конец диапазона без времени включает весь день; даты вводятся в местном времени,
+    периоды отсчитываются в UTC, чтобы переход на летнее время не сдвигал границы"""
+    if value[:-1].isdigit() and value[-1:].lower() in PERIOD_UNITS:
+        return datetime.now(timezone.utc) - timedelta(**{PERIOD_UNITS[value[-1].lower()]: int(value[:-1])})
+    for fmt, span in (('%Y-%m-%d', timedelta(days=1)), ('%Y-%m-%dT%H:%M', timedelta(minutes=1)), ('%Y-%m-%dT%H:%M:%S', timedelta(seconds=1))):
+        try:
+            moment = datetime.strptime(value, fmt)
+        except ValueError:
+            continue
+        return moment + span - timedelta(seconds=1) if end else moment
+    raise ValueError(f"Unsupported date: {value}")
 
 async def filter_history_by_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     lang = user_languages.get(chat_id, 'ru')
     
-    if len(context.args) < 2:
-        await update.message.reply_text(get_message(chat_id, 'filter_no_dates'))
+    if not context.args:
+        await outbox.reply(update.message, get_message(chat_id, 'filter_no_dates'))
         return
     
     try:
-        start_date = datetime.strptime(context.args[0], '%Y-%m-%d')
-        end_date = datetime.strptime(context.args[1], '%Y-%m-%d')
+        start_date = parse_moment(context.args[0])
+        end_date = parse_moment(context.args[1], end=True) if len(context.args) > 1 else datetime.now(timezone.utc)
     except ValueError:
-        await update.message.reply_text(get_message(chat_id, 'filter_invalid_dates'))
+        await outbox.reply(update.message, get_message(chat_id, 'filter_invalid_dates'))
         return
     
-    filtered_results = []
-    
-    for role, history in dialog_histories.get(chat_id, {}).items():
-        for entry in history:
-            entry_date = datetime.strptime(entry['date'], '%Y-%m-%d')
-            if start_date <= entry_date <= end_date:
-                filtered_results.append((role, entry))
-    
-    if not filtered_results:
-        await update.message.reply_text(get_message(chat_id, 'filter_no_results'))
+    filter_ranges[chat_id] = (timestamp(start_date), timestamp(end_date))
+    text, reply_markup = render_filter_page(chat_id, 0)
+    if text is None:
+        await outbox.reply(update.message, get_message(chat_id, 'filter_no_results'))
         return
     
-    filter_text = f"📅 {get_message(chat_id, 'filter_results')}\n"
-    for role, entry in filtered_results:
-        filter_text += f"{ROLE_EMOJI.get(role, '👤')} {role}:\n"
-        filter_text += f"🗣 User: {entry['user']}\n"
-        filter_text += f"👤 {role}: {entry['assistant']}\n\n"
-    
-    await update.message.reply_text(filter_text)
+    await outbox.reply(update.message, text, reply_markup=reply_markup)
+
+def render_filter_page(chat_id: int, page: int):
+    # Записи каждой роли упорядочены по времени: границы диапазона находятся бинарным поиском,
+    # затем роли сливаются в общую ленту от новых к старым
+    start, end = filter_ranges.get(chat_id, ('', ''))
+    slices = [
+        [(role, entry) for entry in reversed(time_range(history, start, end))]
+        for role, history in dialog_histories.get(chat_id, {}).items()
+    ]
+    total = sum(len(entries) for entries in slices)
+    if not total:
+        return None, None
+    merged = heapq.merge(*slices, key=lambda item: item[1].get('date', ''), reverse=True)
+    results = list(itertools.islice(merged, page * RESULTS_PAGE_SIZE, (page + 1) * RESULTS_PAGE_SIZE))
+    return render_results_page(f"📅 {get_message(chat_id, 'filter_results')}", results, page, total, 'filter_page_')
 
 # Список ID администраторов
 ADMIN_IDS = [123456789, 987654321, 189234871]  # Добавлен ваш ID
 
+def format_latency(histogram) -> str:
+    p50, p95 = histogram.quantile(0.5), histogram.quantile(0.95)
+    return f"{histogram.count} вызовов, p50 {p50:.2f}с, p95 {p95:.2f}с"
+
+def metrics_summary() -> str:
+    """Сводка метрик для /admin_stats; квантили оцениваются по корзинам гистограмм"""
+    text = "Задержки провайдеров:\n"
+    for labels, histogram in sorted(metrics.series('provider_latency_seconds').items()):
+        provider = dict(labels)['provider']
+        prompt = metrics.counter('prompt_tokens_total', provider=provider)
+        completion = metrics.counter('completion_tokens_total', provider=provider)
+        text += f"{provider}: {format_latency(histogram)}, токенов {prompt} + {completion}\n"
+    text += "Задержки ролей:\n"
+    for labels, histogram in sorted(metrics.series('role_latency_seconds').items()):
+        text += f"{ROLE_EMOJI.get(dict(labels)['role'], '👤')} {dict(labels)['role']}: {format_latency(histogram)}\n"
+    errors = metrics.series('provider_errors_total')
+    if errors:
+        text += "Ошибки провайдеров:\n"
+        for labels, count in sorted(errors.items()):
+            text += f"{dict(labels)['provider']} ({dict(labels)['kind']}): {count}\n"
+    desks = metrics.series('news_desk_seconds')
+    if desks:
+        text += "Отделы новостей:\n"
+        for labels, histogram in sorted(desks.items()):
+            text += f"{dict(labels)['desk']} ({dict(labels)['outcome']}): {format_latency(histogram)}\n"
+    return text
+
 async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     
     # Проверяем, является ли пользователь администратором
     if chat_id not in ADMIN_IDS:
-        await update.message.reply_text("У вас нет прав для просмотра этой информации.")
+        await outbox.reply(update.message, "У вас нет прав для просмотра этой информации.")
         return
     
     # Формируем текст статистики
@@ -889,8 +1167,45 @@ async def admin_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats_text += "Самые активные часы:\n"
     for hour, count in sorted(usage_stats['hour_distribution'].items()):
         stats_text += f"{hour}:00 - {hour}:59: {count}\n"
-    
-    await update.message.reply_text(stats_text)
+
+    # Статистика кэша анализа новостей
+    cache_stats = news_handler.cache.stats()
+    stats_text += "Кэш анализа новостей:\n"
+    stats_text += f"Попадания: {cache_stats['hits']}, промахи: {cache_stats['misses']} ({cache_stats['hit_rate']:.0%})\n"
+    stats_text += f"Записей в памяти: {cache_stats['size']}\n"
+
+    # Объем истории диалогов в памяти
+    memory = chat_memory.report()
+    stats_text += "История диалогов в памяти:\n"
+    stats_text += f"Чатов: {memory['chats']}, записей: {memory['entries']}\n"
+    stats_text += f"Размер: {memory['bytes'] / 1024 / 1024:.1f} из {memory['budget'] / 1024 / 1024:.0f} МБ, выгружено чатов: {memory['evictions']}\n"
+
+    # Статистика хеджированных запросов
+    if router.hedging:
+        hedge = router.hedge_report()
+        stats_text += "Хеджирование запросов:\n"
+        stats_text += f"Запросов: {hedge['requests']}, с хеджем: {hedge['hedged']} ({hedge['hedge_rate']:.0%})\n"
+        stats_text += f"Побед резервного: {hedge['hedge_wins']}, основного: {hedge['primary_wins']}\n"
+
+    # Очередь исходящих сообщений Telegram
+    stats_text += "Исходящие сообщения:\n"
+    stats_text += f"В очереди: {outbox.depth()}, отправлено: {outbox.stats['sent']}, склеено: {outbox.stats['coalesced']}, flood-wait: {outbox.stats['flood_waits']}\n"
+
+    # Очереди планировщика запросов
+    stats_text += "Лимиты провайдеров:\n"
+    for name, limiter in scheduler.report().items():
+        stats_text += f"{name}: в очереди {limiter['waiting']}, 429: {limiter['throttled']}, отклонено: {limiter['rejected']}\n"
+
+    # Попадания в кэш префикса промпта на стороне провайдеров
+    stats_text += "Кэш промптов провайдеров:\n"
+    for name, usage in router.cache_report().items():
+        if usage['prompt_tokens']:
+            stats_text += f"{name}: {usage['cached_tokens']} из {usage['prompt_tokens']} токенов из кэша ({usage['hit_rate']:.0%})\n"
+
+    # Задержки, токены и ошибки из реестра метрик
+    stats_text += metrics_summary()
+
+    await outbox.reply(update.message, stats_text)
 
 # Добавьте команду /news
 async def news_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -900,10 +1215,9 @@ async def news_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Устанавливаем режим новостей
     chat_states[chat_id] = {'mode': MODE_NEWS, 'timestamp': datetime.now()}
     news_handler.start_news_mode(chat_id)
-    print(f"Режим новостей установлен для чата {chat_id}")  # Отладочный вывод
     
     message = "Analysts are ready. Send news to receive trading signals."
-    await update.message.reply_text(message)
+    await outbox.reply(update.message, message)
 
 async def exit_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Выход из текущего режима"""
@@ -914,7 +1228,7 @@ async def exit_mode(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await reset_chat_mode(chat_id)
     
     message = "Mode reset"
-    await update.message.reply_text(message)
+    await outbox.reply(update.message, message)
 
 async def process_ask(update: Update, context: ContextTypes.DEFAULT_TYPE, role: str, question: str):
     """Обработка запроса к конкретной роли"""
@@ -922,12 +1236,13 @@ async def process_ask(update: Update, context: ContextTypes.DEFAULT_TYPE, role:
     lang = user_languages.get(chat_id, 'ru')
     
     if role not in PERSONALITIES:
-        await update.message.reply_text(get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
+        await outbox.reply(update.message, get_message(chat_id, 'unknown_role').format(', '.join(PERSONALITIES.keys())))
         return
 
-    response = await get_chatgpt_response(
+    response = await respond(
+        update.message,
+        role,
         question,
-        PERSONALITIES[role],
         lang,
         None,
         dialog_histories.get(chat_id, {}).get(role, []),
@@ -935,22 +1250,11 @@ async def process_ask(update: Update, context: ContextTypes.DEFAULT_TYPE, role:
     )
 
     # Сохраняем сообщение и ответ в историю
-    if chat_id not in dialog_histories:
-        dialog_histories[chat_id] = {}
-    if role not in dialog_histories[chat_id]:
-        dialog_histories[chat_id][role] = []
-    
-    dialog_histories[chat_id][role].append({
-        'user': question,
-        'assistant': response
-    })
+    remember_turn(chat_id, role, question, response)
 
     # Устанавливаем текущую роль для продолжения диалога
     current_dialogs[chat_id] = role
 
-    emoji = ROLE_EMOJI.get(role, '👤')
-    await update.message.reply_text(f"{emoji} {role}:\n{response}")
-
 async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /chat"""
     chat_id = update.effective_chat.id
@@ -958,7 +1262,7 @@ async def chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await set_chat_mode(chat_id, MODE_CHAT)
     prompt = "Please specify the topic for discussion!"
-    await update.message.reply_text(prompt)
+    await outbox.reply(update.message, prompt)
 
 async def team_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Обработчик команды /team"""
@@ -967,7 +1271,7 @@ async def team_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     await set_chat_mode(chat_id, MODE_TEAM)
     prompt = "Please specify roles and topic!\nExample: CEO,CTO,CFO discuss new trading strategy"
-    await update.message.reply_text(prompt)
+    await outbox.reply(update.message, prompt)
 
 async def show_continue_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """Показывает кнопки для продолжения или завершения обсуждения"""
@@ -990,12 +1294,75 @@ async def show_continue_buttons(update: Update, context: ContextTypes.DEFAULT_TY
     
     message = "Discussion cycle completed. Would you like to continue?"
     
-    await update.message.reply_text(message, reply_markup=reply_markup)
+    await outbox.reply(update.message, message, reply_markup=reply_markup)
+
+async def serve_webhook(application: Application):
+    """Режим вебхука: встроенный HTTP-сервер принимает обновления и кладет их в очередь приложения,
+    откуда они обрабатываются параллельно (до CONCURRENT_UPDATES одновременно, по одному на чат)"""
+    # При нескольких процессах каждый чат обслуживает один из них; чужие обновления пересылаются владельцу
+    forwarder = ShardForwarder(secret_token=WEBHOOK_SECRET, metrics=metrics) if len(SHARD_URLS) > 1 else None
+
+    async def enqueue(data: dict):
+        if forwarder is not None and not forwarder.is_local(data):
+            await forwarder.forward(data)
+            return
+        await application.update_queue.put(Update.de_json(data, application.bot))
+
+    server = WebhookServer(enqueue)
+    # Сигнал остановки завершает ожидание, чтобы сохранить состояния чатов, дослать очередь и закрыть клиентов
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT, signal.SIGABRT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+    await application.initialize()
+    await on_startup(application)
+    await application.start()
+    try:
+        await server.start()
+        if WEBHOOK_URL:
+            await application.bot.set_webhook(
+                WEBHOOK_URL,
+                secret_token=WEBHOOK_SECRET or None,
+                max_connections=WEBHOOK_MAX_CONNECTIONS,
+                allowed_updates=Update.ALL_TYPES
+            )
+        # Работаем до сигнала остановки процесса
+        await stop.wait()
+    finally:
+        await server.stop()
+        if forwarder is not None:
+            await forwarder.close()
+        await application.stop()
+        await on_stop(application)
+        await on_shutdown(application)
+        await application.shutdown()
 
 def main():
+    # Логи пишет фоновый поток из очереди, цикл событий не ждет stdout
+    setup_logging()
+    # Без секрета любой, кто достучится до порта, сможет подделать апдейты любого чата (в том числе через пересылку между шардами)
+    if BOT_MODE == 'webhook' and not WEBHOOK_SECRET:
+        logger.error("В режиме вебхука нужно задать WEBHOOK_SECRET, бот не запущен")
+        shutdown_logging()
+        raise SystemExit(1)
     while True:
         try:
-            application = Application.builder().token(TELEGRAM_TOKEN).build()
+            application = (
+                Application.builder()
+                .token(TELEGRAM_TOKEN)
+                .concurrent_updates(ChatOrderedProcessor(CONCURRENT_UPDATES))
+                .post_init(on_startup)
+                .post_stop(on_stop)
+                .post_shutdown(on_shutdown)
+                .build()
+            )
+
+            # Загрузка состояния чата до всех обработчиков и отметка для записи после них
+            application.add_handler(TypeHandler(Update, hydrate_session), group=-1)
+            application.add_handler(TypeHandler(Update, persist_session), group=1)
 
             # Основные обработчики
             application.add_handler(CommandHandler("start", start))
@@ -1018,6 +1385,7 @@ def main():
             # Добавляем новые обработчики для работы с историей
             application.add_handler(CommandHandler("clear", clear_history))
             application.add_handler(CommandHandler("depth", set_depth))
+            application.add_handler(CommandHandler("panel", set_panel_mode))
             application.add_handler(CommandHandler("export", export_history))
             
             # Добавляем обработчики для новых функций
@@ -1034,13 +1402,16 @@ def main():
             # Обработчик неизвестных команд (должен быть последним!)
             application.add_handler(MessageHandler(filters.COMMAND, unknown))
 
-            print("🚀 Бот AGI Hedge Fund запущен...")
-            application.run_polling()
+            logger.info("🚀 Бот AGI Hedge Fund запущен...")
+            if BOT_MODE == 'webhook':
+                asyncio.run(serve_webhook(application))
+            else:
+                application.run_polling()
+            # Обычный возврат означает сигнал остановки, а не сбой: перезапуск не нужен
+            break
         except Exception as e:
-            print(f"Произошла ошибка: {e}. Перезапуск бота...")
-            import traceback
-            traceback.print_exc()
-            asyncio.sleep(5)  # Задержка перед перезапуском
+            logger.exception("Произошла ошибка: %s. Перезапуск бота...", e)
+            time.sleep(5)  # Задержка перед перезапуском
 
 if __name__ == '__main__':
     main()
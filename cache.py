@@ -0,0 +1,120 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Settings for the news analysis cache
+NEWS_CACHE_TTL = float(os.getenv('NEWS_CACHE_TTL', '1800'))
+NEWS_CACHE_SIZE = int(os.getenv('NEWS_CACHE_SIZE', '1024'))
+NEWS_CACHE_PATH = os.getenv('NEWS_CACHE_PATH')  # optional SQLite file that survives restarts
+NEWS_CACHE_DB_SIZE = int(os.getenv('NEWS_CACHE_DB_SIZE', '10000'))  # row cap of the SQLite file
+
+
+def normalize_text(text):
+    """Lowercases and collapses whitespace so trivially different forwards share a key"""
+    return re.sub(r'\s+', ' ', text or '').strip().lower()
+
+
+def content_key(text, desk=''):
+    """Content address of a news text for one desk"""
+    digest = hashlib.sha256(normalize_text(text).encode('utf-8')).hexdigest()
+    return f"{desk}:{digest}" if desk else digest
+
+
+class AnalysisCache:
+    """TTL + LRU cache of analysis texts with an optional on-disk SQLite backing"""
+
+    def __init__(self, ttl=NEWS_CACHE_TTL, max_size=NEWS_CACHE_SIZE, path=NEWS_CACHE_PATH,
+                 max_rows=NEWS_CACHE_DB_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self.max_rows = max_rows
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()  # key -> (stored_at, value)
+        self._db = None
+        self._db_lock = threading.Lock()
+        if path:
+            self._open_db()
+
+    def _open_db(self):
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        with self._db_lock:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS analyses (key TEXT PRIMARY KEY, value TEXT NOT NULL, stored_at REAL NOT NULL)"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS analyses_stored_at ON analyses (stored_at)")
+            self._prune()
+            self._db.commit()
+
+    def _prune(self):
+        """Drops expired rows and the oldest ones beyond max_rows; the caller holds _db_lock"""
+        self._db.execute("DELETE FROM analyses WHERE stored_at < ?", (time.time() - self.ttl,))
+        self._db.execute(
+            "DELETE FROM analyses WHERE key IN "
+            "(SELECT key FROM analyses ORDER BY stored_at DESC LIMIT -1 OFFSET ?)",
+            (self.max_rows,)
+        )
+
+    def _db_get(self, key):
+        with self._db_lock:
+            row = self._db.execute("SELECT value, stored_at FROM analyses WHERE key = ?", (key,)).fetchone()
+        return row
+
+    def _db_put(self, key, value, stored_at):
+        with self._db_lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO analyses (key, value, stored_at) VALUES (?, ?, ?)",
+                (key, value, stored_at)
+            )
+            self._prune()
+            self._db.commit()
+
+    def _remember(self, key, value, stored_at):
+        self._entries[key] = (stored_at, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    async def get(self, key):
+        """Returns the cached value or None; expired entries count as misses"""
+        now = time.time()
+        entry = self._entries.get(key)
+        if entry is None and self._db is not None:
+            row = await asyncio.to_thread(self._db_get, key)
+            if row is not None:
+                entry = (row[1], row[0])
+                self._remember(key, entry[1], entry[0])
+        if entry is None or now - entry[0] > self.ttl:
+            self._entries.pop(key, None)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    async def set(self, key, value):
+        stored_at = time.time()
+        self._remember(key, value, stored_at)
+        if self._db is not None:
+            await asyncio.to_thread(self._db_put, key, value, stored_at)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0,
+            'size': len(self._entries),
+        }
+
+    def close(self):
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
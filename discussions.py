@@ -0,0 +1,54 @@
+import os
+from collections import deque
+
+# Responses kept per discussion; prompts only ever quote the last few
+DISCUSSION_TRANSCRIPT_SIZE = int(os.getenv('DISCUSSION_TRANSCRIPT_SIZE', '50'))
+# Discussion formats: roles speak one after another, or all at once followed by one synthesis reply
+DISCUSSION_SEQUENTIAL = 'sequential'
+DISCUSSION_PANEL = 'panel'
+DISCUSSION_MODE = os.getenv('DISCUSSION_MODE', DISCUSSION_SEQUENTIAL).lower()
+PANEL_SYNTHESIS_ROLE = os.getenv('PANEL_SYNTHESIS_ROLE', 'CEO').upper()
+
+
+class DiscussionSession:
+    """State of one chat's /chat or /team discussion; every chat owns its own instance"""
+
+    def __init__(self, chat_id, topic, roles, lang='ru', mode=None):
+        self.chat_id = chat_id
+        self.topic = topic
+        self.roles = list(roles)
+        self.lang = lang
+        self.mode = mode or DISCUSSION_MODE
+        self.transcript = deque(maxlen=DISCUSSION_TRANSCRIPT_SIZE)  # [{'role': role, 'response': response}, ...]
+        self.messages_count = 0  # responses in the current cycle
+
+    def add(self, role, response):
+        self.transcript.append({'role': role, 'response': response})
+        self.messages_count += 1
+
+    def recent(self, count=3):
+        return list(self.transcript)[-count:]
+
+    @property
+    def last_response(self):
+        return self.transcript[-1]['response'] if self.transcript else None
+
+    @property
+    def cycle_complete(self):
+        return self.messages_count >= len(self.roles)
+
+    def next_cycle(self):
+        self.messages_count = 0
+
+
+def panel_roles(roles, synthesis_role=PANEL_SYNTHESIS_ROLE):
+    """Splits the participants into concurrent panelists and the role that sums them up.
+
+    The synthesis role speaks last if it takes part, otherwise the first participant does;
+    a single participant just answers without a synthesis round.
+    """
+    roles = list(roles)
+    if len(roles) < 2:
+        return roles, None
+    moderator = synthesis_role if synthesis_role in roles else roles[0]
+    return [role for role in roles if role != moderator], moderator
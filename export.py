@@ -0,0 +1,79 @@
+import io
+import os
+import csv
+import gzip
+import json
+import tempfile
+from datetime import datetime
+
+from history import local_time
+
+EXPORT_FORMATS = ('txt', 'jsonl', 'csv')
+# Exports stay in memory up to this many bytes and spill to a file in the system temp directory beyond it
+EXPORT_SPOOL_SIZE = int(os.getenv('EXPORT_SPOOL_SIZE', str(1024 * 1024)))
+CSV_COLUMNS = ('role', 'date', 'user', 'assistant')
+
+
+def snapshot(role_histories):
+    """Shallow copy of each role's entries, so the export can be written off the event loop
+    while new turns keep arriving"""
+    return {role: list(history) for role, history in role_histories.items() if history}
+
+
+def _write_txt(out, role_histories):
+    out.write("=== Dialog History Export ===\n\n")
+    for role, history in role_histories.items():
+        out.write(f"=== {role} ===\n")
+        for entry in history:
+            if entry.get('date'):
+                out.write(f"[{local_time(entry['date'])}]\n")
+            out.write(f"User: {entry['user']}\n")
+            out.write(f"{role}: {entry['assistant']}\n\n")
+
+
+def _write_jsonl(out, role_histories):
+    for role, history in role_histories.items():
+        for entry in history:
+            record = {'role': role, 'date': entry.get('date'), 'user': entry['user'], 'assistant': entry['assistant']}
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+
+def _write_csv(out, role_histories):
+    writer = csv.writer(out)
+    writer.writerow(CSV_COLUMNS)
+    for role, history in role_histories.items():
+        for entry in history:
+            writer.writerow((role, entry.get('date', ''), entry['user'], entry['assistant']))
+
+
+WRITERS = {'txt': _write_txt, 'jsonl': _write_jsonl, 'csv': _write_csv}
+
+
+def export_filename(fmt, compress=False, moment=None):
+    moment = moment or datetime.now()
+    return f"dialog_history_{moment:%Y%m%d_%H%M%S}.{fmt}" + ('.gz' if compress else '')
+
+
+def write_export(role_histories, fmt='txt', compress=False, spool_size=EXPORT_SPOOL_SIZE):
+    """Writes the histories entry by entry into a spooled buffer and returns it rewound.
+
+    Only the encoder's small buffer is held besides the output, and the output itself moves to disk
+    once it outgrows `spool_size`, so memory stays flat however long the history is.
+    """
+    if fmt not in WRITERS:
+        raise ValueError(f"Unknown export format: {fmt}")
+    buffer = tempfile.SpooledTemporaryFile(max_size=spool_size)
+    raw = gzip.GzipFile(fileobj=buffer, mode='wb') if compress else buffer
+    # newline='' leaves line endings to the writers (csv uses \r\n as RFC 4180 expects)
+    out = io.TextIOWrapper(raw, encoding='utf-8', newline='')
+    try:
+        WRITERS[fmt](out, role_histories)
+        out.flush()
+        out.detach()
+        if compress:
+            raw.close()  # writes the gzip trailer; the underlying buffer stays open
+    except Exception:
+        buffer.close()
+        raise
+    buffer.seek(0)
+    return buffer
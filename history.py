@@ -0,0 +1,294 @@
+import os
+import sys
+import time
+import asyncio
+import hashlib
+import logging
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime, timezone
+
+logger = logging.getLogger(__name__)
+
+# Entries kept per (chat, role); older turns drop off the ring buffer
+HISTORY_BUFFER_SIZE = int(os.getenv('HISTORY_BUFFER_SIZE', '100'))
+# Resident size of all dialog histories above which idle chats are evicted from memory
+HISTORY_MEMORY_BUDGET = int(float(os.getenv('HISTORY_MEMORY_BUDGET_MB', '64')) * 1024 * 1024)
+# Only chats idle for at least this many seconds are evicted
+CHAT_IDLE_TIMEOUT = float(os.getenv('CHAT_IDLE_TIMEOUT', '900'))
+HISTORY_SWEEP_INTERVAL = float(os.getenv('HISTORY_SWEEP_INTERVAL', '60'))
+
+
+def new_history(entries=()):
+    """Bounded ring buffer of {'user': ..., 'assistant': ...} entries for one role"""
+    return deque(entries, maxlen=HISTORY_BUFFER_SIZE)
+
+
+def load_histories(roles):
+    """Turns stored {role: [entries]} back into ring buffers"""
+    return {role: new_history(map(utc_entry, entries)) for role, entries in roles.items()}
+
+
+def utc_entry(entry):
+    """Entries saved with naive local timestamps get them rewritten in UTC"""
+    date = entry.get('date')
+    if not date or date.endswith('+00:00'):
+        return entry
+    return {**entry, 'date': timestamp(datetime.fromisoformat(date))}
+
+
+def merge_histories(stored, current):
+    """Stored entries followed by the newer in-memory ones, per role, within the ring buffer size"""
+    merged = {role: new_history(entries) for role, entries in stored.items()}
+    for role, entries in current.items():
+        merged[role] = new_history(list(merged.get(role, ())) + list(entries))
+    return merged
+
+
+def recent(history, depth):
+    """Last `depth` entries of a history as a list"""
+    if depth <= 0:
+        return []
+    start = max(0, len(history) - depth)
+    return [history[i] for i in range(start, len(history))]
+
+
+def timestamp(moment=None):
+    """Entry timestamp: ISO 8601 in UTC to the second, so string order is time order even across
+    DST changes; naive moments are taken as local time"""
+    moment = moment or datetime.now(timezone.utc)
+    return moment.astimezone(timezone.utc).isoformat(timespec='seconds')
+
+
+def local_time(value):
+    """Entry timestamp for display, in the local time zone"""
+    return datetime.fromisoformat(value).astimezone().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def entry_time(entry):
+    # Entries saved before timestamps existed sort first
+    return entry.get('date', '')
+
+
+def time_range(history, start, end):
+    """Entries dated start <= date <= end (ISO strings); histories are appended in time order,
+    so both ends are found by binary search"""
+    low = bisect_left(history, start, key=entry_time)
+    high = bisect_right(history, end, key=entry_time)
+    return [history[i] for i in range(low, high)]
+
+
+def entry_size(entry):
+    """Approximate resident size of one history entry in bytes"""
+    return sys.getsizeof(entry) + sum(sys.getsizeof(value) for value in entry.values())
+
+
+def chat_size(role_histories):
+    return sum(entry_size(entry) for history in role_histories.values() for entry in history)
+
+
+class ChatMemory:
+    """Tracks chat activity and evicts idle chats from memory when histories exceed the budget"""
+
+    def __init__(self, histories, budget=HISTORY_MEMORY_BUDGET, idle_timeout=CHAT_IDLE_TIMEOUT,
+                 sweep_interval=HISTORY_SWEEP_INTERVAL, on_evict=None, is_busy=None, on_sweep=None):
+        self.histories = histories
+        self.budget = budget
+        self.idle_timeout = idle_timeout
+        self.sweep_interval = sweep_interval
+        self.on_evict = on_evict  # async callable(chat_id) that drops the chat from memory
+        self.is_busy = is_busy  # callable(chat_id) -> True while the chat must stay resident
+        self.on_sweep = on_sweep  # async callable() run before each sweep, e.g. to expire per-chat modes
+        self.last_seen = {}
+        self.evictions = 0
+        self._sweeper = None
+
+    def touch(self, chat_id):
+        self.last_seen[chat_id] = time.monotonic()
+
+    def forget(self, chat_id):
+        self.last_seen.pop(chat_id, None)
+
+    def report(self):
+        """Current resident size of the dialog histories"""
+        sizes = {chat_id: chat_size(roles) for chat_id, roles in list(self.histories.items())}
+        return {
+            'chats': len(sizes),
+            'entries': sum(len(history) for roles in self.histories.values() for history in roles.values()),
+            'bytes': sum(sizes.values()),
+            'budget': self.budget,
+            'evictions': self.evictions,
+        }
+
+    def _idle(self, chat_id, now):
+        return now - self.last_seen.get(chat_id, 0.0) >= self.idle_timeout and not (self.is_busy and self.is_busy(chat_id))
+
+    async def _evict(self, chat_id):
+        if self.on_evict is not None:
+            await self.on_evict(chat_id)
+        else:
+            self.histories.pop(chat_id, None)
+        self.forget(chat_id)
+
+    async def sweep(self):
+        """Evicts idle chats without history, then least recently active idle chats until the histories fit the budget"""
+        now = time.monotonic()
+        evicted = 0
+        # A chat without history only holds settings and modes, so keeping it resident saves nothing
+        for chat_id in [chat_id for chat_id in self.last_seen if chat_id not in self.histories]:
+            if self._idle(chat_id, now):
+                await self._evict(chat_id)
+                evicted += 1
+
+        sizes = {chat_id: chat_size(roles) for chat_id, roles in list(self.histories.items())}
+        total = sum(sizes.values())
+        idle = sorted(
+            (self.last_seen.get(chat_id, 0.0), chat_id) for chat_id in sizes if self._idle(chat_id, now)
+        ) if total > self.budget else []
+        for _, chat_id in idle:
+            if total <= self.budget:
+                break
+            await self._evict(chat_id)
+            total -= sizes[chat_id]
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+    async def _sweep_loop(self):
+        while True:
+            await asyncio.sleep(self.sweep_interval)
+            try:
+                if self.on_sweep is not None:
+                    await self.on_sweep()
+                evicted = await self.sweep()
+                if evicted:
+                    logger.info("Evicted %d idle chats from memory", evicted)
+            except Exception as e:
+                logger.exception("History sweep failed: %s", e)
+
+    def start(self):
+        self._sweeper = asyncio.create_task(self._sweep_loop())
+
+    def stop(self):
+        if self._sweeper is not None:
+            self._sweeper.cancel()
+            self._sweeper = None
+
+
+# Token budgets for the history window per provider, overridable via HISTORY_TOKEN_BUDGET_<PROVIDER>
+DEFAULT_TOKEN_BUDGETS = {
+    'openai': 3000,
+    'anthropic': 3000,
+    'xai': 3000,
+    'gemini': 4000,
+}
+DEFAULT_TOKEN_BUDGET = 3000
+# Older turns are folded into a rolling summary once this many are waiting
+HISTORY_SUMMARIES = os.getenv('HISTORY_SUMMARIES', '1').lower() in ('1', 'true', 'yes', 'on')
+HISTORY_SUMMARY_BATCH = int(os.getenv('HISTORY_SUMMARY_BATCH', '3'))
+
+
+def estimate_tokens(text):
+    """Rough token count without a tokenizer: about three characters per token for mixed RU/EN text"""
+    return len(text or '') // 3 + 1
+
+
+def entry_tokens(entry):
+    return estimate_tokens(entry['user']) + estimate_tokens(entry['assistant'])
+
+
+def token_budget(provider):
+    default = DEFAULT_TOKEN_BUDGETS.get(provider, DEFAULT_TOKEN_BUDGET)
+    value = os.getenv(f"HISTORY_TOKEN_BUDGET_{provider.upper()}")
+    return int(value) if value and value.isdigit() else default
+
+
+def select_window(history, max_entries, budget):
+    """Newest entries that fit both the entry limit and the token budget.
+
+    Returns (window, older, window_tokens); `older` are the buffered entries left out of the window.
+    """
+    entries = recent(history, len(history))
+    window = []
+    used = 0
+    for entry in reversed(entries[-max_entries:] if max_entries > 0 else []):
+        cost = entry_tokens(entry)
+        if used + cost > budget:
+            break
+        window.append(entry)
+        used += cost
+    window.reverse()
+    return window, entries[:len(entries) - len(window)], used
+
+
+def entry_marker(entry):
+    return hashlib.sha1(f"{entry['user']}\x00{entry['assistant']}".encode('utf-8')).hexdigest()[:16]
+
+
+class HistorySummarizer:
+    """Keeps a rolling summary of the turns that no longer fit the history window.
+
+    Summaries are refreshed in background tasks, so the request path only reads the latest one.
+    """
+
+    def __init__(self, summaries, summarize, batch=HISTORY_SUMMARY_BATCH, enabled=HISTORY_SUMMARIES):
+        self.summaries = summaries  # {chat_id: {role: {'summary': str, 'marker': str}}}
+        self.summarize = summarize  # async callable(previous_summary, entries) -> str
+        self.batch = batch
+        self.enabled = enabled
+        self.token_savings = {}  # chat_id -> {'baseline': int, 'sent': int}
+        self._running = {}
+
+    def summary_for(self, chat_id, role):
+        state = self.summaries.get(chat_id, {}).get(role)
+        return state['summary'] if state else ''
+
+    def reset(self, chat_id, role=None):
+        roles = self.summaries.get(chat_id)
+        if roles is None:
+            return
+        if role is None:
+            self.summaries.pop(chat_id, None)
+        else:
+            roles.pop(role, None)
+
+    def _pending(self, chat_id, role, older):
+        """Entries of `older` that are newer than the last folded one"""
+        state = self.summaries.get(chat_id, {}).get(role)
+        if state:
+            for index in range(len(older) - 1, -1, -1):
+                if entry_marker(older[index]) == state['marker']:
+                    return older[index + 1:]
+        return older
+
+    def schedule(self, chat_id, role, older):
+        """Starts a background refresh once enough turns have dropped out of the window"""
+        if not self.enabled or (chat_id, role) in self._running:
+            return
+        pending = self._pending(chat_id, role, older)
+        if len(pending) < self.batch:
+            return
+        task = asyncio.create_task(self._refresh(chat_id, role, pending))
+        self._running[(chat_id, role)] = task
+
+    async def _refresh(self, chat_id, role, pending):
+        try:
+            summary = await self.summarize(self.summary_for(chat_id, role), pending)
+            if summary:
+                self.summaries.setdefault(chat_id, {})[role] = {
+                    'summary': summary,
+                    'marker': entry_marker(pending[-1]),
+                }
+        except Exception as e:
+            logger.warning("History summary refresh failed for %s/%s: %s", chat_id, role, e)
+        finally:
+            self._running.pop((chat_id, role), None)
+
+    def record(self, chat_id, baseline_tokens, sent_tokens):
+        """Accumulates prompt tokens of the count-based window versus what was actually sent"""
+        savings = self.token_savings.setdefault(chat_id, {'baseline': 0, 'sent': 0})
+        savings['baseline'] += baseline_tokens
+        savings['sent'] += sent_tokens
+
+    def savings_for(self, chat_id):
+        return self.token_savings.get(chat_id, {'baseline': 0, 'sent': 0})
@@ -0,0 +1,126 @@
+import os
+import sys
+import copy
+import json
+import queue
+import random
+import secrets
+import logging
+import logging.handlers
+from contextvars import ContextVar
+
+# DEBUG, INFO, WARNING or ERROR; debug payloads are not even formatted above DEBUG
+LOG_LEVEL = os.getenv('LOG_LEVEL', 'INFO').upper()
+# 'text' for humans, 'json' for one object per line
+LOG_FORMAT = os.getenv('LOG_FORMAT', 'text').lower()
+# Share of verbose payload dumps (raw provider responses, message texts) kept at DEBUG level
+LOG_SAMPLE_RATE = float(os.getenv('LOG_SAMPLE_RATE', '0.05'))
+# Records waiting for the writer thread; beyond that new records are dropped rather than blocking the loop
+LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', '10000'))
+
+# Fields of the update being handled (request_id, chat_id, ...); tasks started while handling inherit them
+log_context = ContextVar('log_context', default={})
+
+_listener = None
+_handler = None
+
+
+def new_request_id():
+    return secrets.token_hex(4)
+
+
+def bind(**fields):
+    """Adds fields to every record logged from the current task and the tasks it starts"""
+    log_context.set({**log_context.get(), **fields})
+
+
+def sampled(logger, rate=None):
+    """True for a random share of calls when DEBUG is enabled; guards expensive debug dumps"""
+    return logger.isEnabledFor(logging.DEBUG) and random.random() < (LOG_SAMPLE_RATE if rate is None else rate)
+
+
+class ContextFilter(logging.Filter):
+    """Copies the bound context onto the record in the calling task, before it crosses to the writer thread"""
+
+    def filter(self, record):
+        record.context = log_context.get()
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    def __init__(self, records):
+        super().__init__(records)
+        self.dropped = 0
+
+    def prepare(self, record):
+        """Merges the arguments in the caller, where they are still valid; formatting happens on the writer thread"""
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s%(context_text)s')
+
+    def format(self, record):
+        context = getattr(record, 'context', None)
+        record.context_text = ' [' + ' '.join(f"{key}={value}" for key, value in context.items()) + ']' if context else ''
+        return super().format(record)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            **(getattr(record, 'context', None) or {}),
+        }
+        if record.exc_text:
+            entry['exc'] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+def setup_logging(level=LOG_LEVEL, fmt=LOG_FORMAT, stream=None):
+    """Routes all logging through a bounded queue to one writer thread; safe to call more than once"""
+    global _listener, _handler
+    if _listener is not None:
+        return _listener
+    records = queue.Queue(LOG_QUEUE_SIZE)
+    handler = _handler = _DroppingQueueHandler(records)
+    handler.addFilter(ContextFilter())
+    output = logging.StreamHandler(stream or sys.stdout)
+    output.setFormatter(JsonFormatter() if fmt == 'json' else TextFormatter())
+    root = logging.getLogger()
+    root.handlers[:] = [handler]
+    root.setLevel(level)
+    # httpx logs every request at INFO
+    logging.getLogger('httpx').setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(records, output)
+    _listener.start()
+    return _listener
+
+
+def dropped_records():
+    """Records lost because the writer thread fell behind"""
+    return _handler.dropped if _handler is not None else 0
+
+
+def shutdown_logging():
+    """Writes out queued records and stops the writer thread"""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
@@ -0,0 +1,153 @@
+import os
+import logging
+from bisect import bisect_left
+from ratelimit import QueueFull, retry_after_from
+
+logger = logging.getLogger(__name__)
+
+# Local Prometheus-style endpoint; 0 disables it. Keep it on loopback unless a scraper needs it.
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+METRICS_LISTEN = os.getenv('METRICS_LISTEN', '127.0.0.1')
+METRICS_PATH = os.getenv('METRICS_PATH', '/metrics')
+METRICS_PREFIX = 'agihedge_'
+# Upper bounds in seconds; model calls take from a fraction of a second to the attempt timeout
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 60.0)
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Histogram:
+    """Fixed-bucket histogram: recording is one bisect over a handful of bounds"""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # the last slot is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """Estimate interpolated inside the bucket holding the q-th observation; None when empty"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for i, count in enumerate(self.counts):
+            if count and seen + count >= rank:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                if i == len(self.buckets):
+                    return lower
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+
+class Metrics:
+    """In-process registry of counters, histograms and gauges rendered in the Prometheus text format.
+
+    Counters and histograms are updated in place on the hot path; gauges are callbacks that are only
+    read when the metrics are rendered, so queue depths cost nothing between scrapes.
+    """
+
+    def __init__(self, prefix=METRICS_PREFIX):
+        self.prefix = prefix
+        self.counters = {}  # name -> {label key: value}
+        self.histograms = {}  # name -> {label key: Histogram}
+        self.gauges = {}  # name -> (callable, label name or None)
+        self.help = {}
+
+    def describe(self, name, text):
+        self.help[name] = text
+
+    def inc(self, name, amount=1, **labels):
+        series = self.counters.setdefault(name, {})
+        key = _labels(labels)
+        series[key] = series.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        series = self.histograms.setdefault(name, {})
+        key = _labels(labels)
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name, read, text='', label=None):
+        """Registers read() -> number, or read() -> {label value: number} when `label` is given"""
+        self.gauges[name] = (read, label)
+        if text:
+            self.describe(name, text)
+
+    def counter(self, name, **labels):
+        return self.counters.get(name, {}).get(_labels(labels), 0)
+
+    def series(self, name):
+        """{label key: value or Histogram} of one counter or histogram"""
+        return self.counters.get(name) or self.histograms.get(name) or {}
+
+    def render(self):
+        """Prometheus text exposition format (version 0.0.4)"""
+        lines = []
+
+        def header(name, kind):
+            full = self.prefix + name
+            if name in self.help:
+                lines.append(f"# HELP {full} {self.help[name]}")
+            lines.append(f"# TYPE {full} {kind}")
+            return full
+
+        for name, series in sorted(self.counters.items()):
+            full = header(name, 'counter')
+            for key, value in sorted(series.items()):
+                lines.append(f"{full}{_format_labels(key)} {_format_value(value)}")
+        for name, series in sorted(self.histograms.items()):
+            full = header(name, 'histogram')
+            for key, histogram in sorted(series.items()):
+                cumulative = 0
+                for bound, count in zip(histogram.buckets + (float('inf'),), histogram.counts):
+                    cumulative += count
+                    le = '+Inf' if bound == float('inf') else repr(float(bound))
+                    lines.append(f"{full}_bucket{_format_labels(key, [('le', le)])} {cumulative}")
+                lines.append(f"{full}_sum{_format_labels(key)} {_format_value(histogram.sum)}")
+                lines.append(f"{full}_count{_format_labels(key)} {histogram.count}")
+        for name, (read, label) in sorted(self.gauges.items()):
+            full = header(name, 'gauge')
+            try:
+                value = read()
+            except Exception as e:
+                logger.warning("Gauge %s failed: %s", name, e)
+                continue
+            values = [(((label, item),), number) for item, number in value.items()] if label else [((), value)]
+            for key, value in sorted(values):
+                lines.append(f"{full}{_format_labels(key)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def error_kind(error):
+    """'timeout', 'rate_limited' or 'error' for an exception raised by a model call;
+    errors wrapped by the router are classified by their cause"""
+    while error is not None:
+        if isinstance(error, QueueFull) or retry_after_from(error) is not None:
+            return 'rate_limited'
+        if 'timeout' in type(error).__name__.lower():
+            return 'timeout'
+        error = error.__cause__
+    return 'error'
@@ -1,112 +1,320 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from cache import AnalysisCache, content_key
+from history import estimate_tokens
+from logs import sampled
+
+# Per-desk timeout in seconds; a slow desk is reported as degraded instead of delaying the whole report
+DESK_TIMEOUT = float(os.getenv('NEWS_DESK_TIMEOUT', '25'))
+
+# 'per_desk' sends the news once per desk, 'combined' asks for all desks in a single request
+ANALYSIS_MODE_PER_DESK = 'per_desk'
+ANALYSIS_MODE_COMBINED = 'combined'
+NEWS_ANALYSIS_MODE = os.getenv('NEWS_ANALYSIS_MODE', ANALYSIS_MODE_PER_DESK)
+COMBINED_MAX_TOKENS = int(os.getenv('NEWS_COMBINED_MAX_TOKENS', '1200'))
+
+logger = logging.getLogger(__name__)
+
+DESK_TITLES = {
+    'indices': "📈 Indices Specialist",
+    'commodities': "🛢️ Commodities Specialist",
+    'forex': "💱 Forex Specialist",
+    'stocks': "🏢 Stocks Specialist",
+    'crypto': "🪙 Crypto Specialist",
+}
+
 class BaseSpecialist:
-    def __init__(self, openai_client=None):
+    prompt = ""
+
+    def __init__(self, openai_client=None, scheduler=None, metrics=None):
         self.openai_client = openai_client
+        self.scheduler = scheduler  # RequestScheduler shared with the executives, optional
+        self.metrics = metrics  # Metrics registry shared with the bot, optional
 
-    async def _analyze_with_ai(self, prompt, news):
-        try:
-            if not self.openai_client:
-                return "Error: OpenAI client not initialized"
-            
-            full_prompt = f"{prompt}\n\nNews for analysis:\n{news}"
-            
-            response = await self.openai_client.chat.completions.create(
+    async def _analyze_with_ai(self, prompt, news, max_tokens=500, **options):
+        # Errors propagate to NewsHandler, which marks only this desk as degraded
+        if not self.openai_client:
+            raise RuntimeError("OpenAI client not initialized")
+        
+        full_prompt = f"{prompt}\n\nNews for analysis:\n{news}"
+        
+        def call():
+            return self.openai_client.chat.completions.create(
                 model="gpt-3.5-turbo",  # or gpt-4 if you have access
                 messages=[
                     {"role": "system", "content": "You are an experienced financial analyst."},
                     {"role": "user", "content": full_prompt}
                 ],
                 temperature=0.7,
-                max_tokens=500
+                max_tokens=max_tokens,
+                **options
             )
-            
-            return response.choices[0].message.content
-            
-        except Exception as e:
-            return f"Error during analysis: {str(e)}"
 
-class IndicesSpecialist(BaseSpecialist):
+        if self.scheduler is None:
+            response = await call()
+        else:
+            response = await self.scheduler.run('openai', call, tokens=estimate_tokens(full_prompt) + max_tokens)
+
+        usage = getattr(response, 'usage', None)
+        if self.metrics is not None and usage is not None:
+            self.metrics.inc('prompt_tokens_total', getattr(usage, 'prompt_tokens', 0) or 0, provider='openai')
+            self.metrics.inc('completion_tokens_total', getattr(usage, 'completion_tokens', 0) or 0, provider='openai')
+        
+        return response.choices[0].message.content
+
     async def analyze_news(self, news):
-        prompt = """Analyze the news ONLY in terms of its impact on major stock indices (S&P 500, Dow Jones, Nasdaq, Russell, etc.).
+        return await self._analyze_with_ai(self.prompt, news)
+
+class IndicesSpecialist(BaseSpecialist):
+    prompt = """Analyze the news ONLY in terms of its impact on major stock indices (S&P 500, Dow Jones, Nasdaq, Russell, etc.).
 If the news does not affect the indices, return an empty response.
 Response format:
 ✅ Buy: (only index ETFs, e.g., SPY, QQQ, DIA, IWM)
 ❌ Sell: (only index ETFs)
 🛡 Hedge: (only index hedging instruments - VIX, inverse ETFs)
 Use only index instrument tickers."""
-        return await self._analyze_with_ai(prompt, news)
 
 class CommoditiesSpecialist(BaseSpecialist):
-    async def analyze_news(self, news):
-        prompt = """Analyze the news ONLY in terms of its impact on commodities (gold, silver, oil, gas, metals, etc.).
+    prompt = """Analyze the news ONLY in terms of its impact on commodities (gold, silver, oil, gas, metals, etc.).
 If the news does not affect commodities, return an empty response.
 Response format:
 ✅ Buy: (only commodities and their ETFs, e.g., GLD, SLV, USO, UNG)
 ❌ Sell: (only commodities and their ETFs)
 🛡 Hedge: (only commodity hedging instruments)
 Use only commodity instrument tickers."""
-        return await self._analyze_with_ai(prompt, news)
 
 class ForexSpecialist(BaseSpecialist):
-    async def analyze_news(self, news):
-        prompt = """Analyze the news ONLY in terms of its impact on major currency pairs (EUR/USD, GBP/USD, USD/JPY, USD/CHF, etc.).
+    prompt = """Analyze the news ONLY in terms of its impact on major currency pairs (EUR/USD, GBP/USD, USD/JPY, USD/CHF, etc.).
 If the news does not affect currency pairs, return an empty response.
 Response format:
 ✅ Buy: (only currency pairs)
 ❌ Sell: (only currency pairs)
 🛡 Hedge: (only currency risk hedging instruments)
 Use only currency pair symbols."""
-        return await self._analyze_with_ai(prompt, news)
 
 class StocksSpecialist(BaseSpecialist):
-    async def analyze_news(self, news):
-        prompt = """Analyze the news ONLY in terms of its impact on individual stocks and stock market sectors.
+    prompt = """Analyze the news ONLY in terms of its impact on individual stocks and stock market sectors.
 If the news does not affect specific stocks or sectors, return an empty response.
 Response format:
 ✅ Buy: (only specific company stocks or sector ETFs, e.g., XLK, XLF)
 ❌ Sell: (only specific company stocks or sector ETFs)
 🛡 Hedge: (only stock hedging instruments)
 Use only stock and sector ETF tickers."""
-        return await self._analyze_with_ai(prompt, news)
 
 class CryptoSpecialist(BaseSpecialist):
-    async def analyze_news(self, news):
-        prompt = """Analyze the news ONLY in terms of its impact on cryptocurrencies (Bitcoin, Ethereum, altcoins, etc.).
+    prompt = """Analyze the news ONLY in terms of its impact on cryptocurrencies (Bitcoin, Ethereum, altcoins, etc.).
 If the news does not affect cryptocurrencies, return an empty response.
 Response format:
 ✅ Buy: (only cryptocurrencies and crypto ETFs, e.g., BTC, ETH, GBTC, ETHE)
 ❌ Sell: (only cryptocurrencies and crypto ETFs)
 🛡 Hedge: (only cryptocurrency hedging instruments)
 Use only cryptocurrency and related instrument tickers."""
-        return await self._analyze_with_ai(prompt, news)
+
+class CombinedSpecialist(BaseSpecialist):
+    """Answers for every desk in one request, so the news text is sent and billed once"""
+
+    SIGNALS = (("buy", "✅ Buy"), ("sell", "❌ Sell"), ("hedge", "🛡 Hedge"))
+
+    def __init__(self, desks, openai_client=None, scheduler=None, metrics=None):
+        super().__init__(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.desks = desks
+
+    def build_prompt(self):
+        desk_instructions = "\n\n".join(f"[{desk}]\n{specialist.prompt}" for desk, specialist in self.desks.items())
+        keys = ", ".join(f'"{desk}"' for desk in self.desks)
+        return f"""You are the following desk analysts at once. Follow each desk's instructions independently.
+
+{desk_instructions}
+
+Instead of each desk's response format, return ONLY a JSON object with the keys {keys}.
+Each value is an object with the string fields "buy", "sell" and "hedge".
+Leave all three fields empty for a desk the news does not affect."""
+
+    def split_sections(self, content):
+        """Splits the structured answer back into per-desk texts in the usual Buy/Sell/Hedge format"""
+        data = json.loads(content)
+        if not isinstance(data, dict):
+            raise ValueError("combined analysis is not a JSON object")
+
+        sections = {}
+        for desk in self.desks:
+            entry = data.get(desk) or {}
+            if not isinstance(entry, dict):
+                raise ValueError(f"combined analysis has no object for {desk}")
+            lines = []
+            for key, label in self.SIGNALS:
+                value = entry.get(key) or ""
+                if isinstance(value, list):
+                    value = ", ".join(str(item) for item in value)
+                value = str(value).strip()
+                if value:
+                    lines.append(f"{label}: {value}")
+            sections[desk] = "\n".join(lines)
+        return sections
+
+    async def analyze_news(self, news):
+        content = await self._analyze_with_ai(
+            self.build_prompt(),
+            news,
+            max_tokens=COMBINED_MAX_TOKENS,
+            response_format={"type": "json_object"}
+        )
+        return self.split_sections(content)
 
 class NewsHandler:
-    def __init__(self, openai_client=None):
-        self.news_mode_chats = set()
+    def __init__(self, openai_client=None, mode=None, cache=None, scheduler=None, outbox=None, metrics=None):
+        self.news_mode_chats = {}  # chat_id -> True; a dict so the session store can persist it per chat
+        self.outbox = outbox  # SendQueue shared with the bot; replies go straight out without it
+        self.openai_client = openai_client
+        self.indices_specialist = IndicesSpecialist(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.commodities_specialist = CommoditiesSpecialist(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.forex_specialist = ForexSpecialist(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.stocks_specialist = StocksSpecialist(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.crypto_specialist = CryptoSpecialist(openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.desks = {
+            'indices': self.indices_specialist,
+            'commodities': self.commodities_specialist,
+            'forex': self.forex_specialist,
+            'stocks': self.stocks_specialist,
+            'crypto': self.crypto_specialist,
+        }
+        self.combined_specialist = CombinedSpecialist(self.desks, openai_client=openai_client, scheduler=scheduler, metrics=metrics)
+        self.desk_timeout = DESK_TIMEOUT
+        self.metrics = metrics
+        self.mode = mode or NEWS_ANALYSIS_MODE
+        # Analyses are shared across chats: the same headline is analyzed once per TTL
+        self.cache = cache or AnalysisCache()
+        self._inflight = {}  # (news key, desks) -> task, so simultaneous forwards share one analysis
+
+    def set_openai_client(self, openai_client):
+        """Shares one pooled OpenAI client between the handler and all specialists"""
         self.openai_client = openai_client
-        self.indices_specialist = IndicesSpecialist(openai_client=openai_client)
-        self.commodities_specialist = CommoditiesSpecialist(openai_client=openai_client)
-        self.forex_specialist = ForexSpecialist(openai_client=openai_client)
-        self.stocks_specialist = StocksSpecialist(openai_client=openai_client)
-        self.crypto_specialist = CryptoSpecialist(openai_client=openai_client)
+        for specialist in self.desks.values():
+            specialist.openai_client = openai_client
+        self.combined_specialist.openai_client = openai_client
+
+    def _record_desk(self, desk, started, outcome):
+        if self.metrics is not None:
+            self.metrics.observe('news_desk_seconds', time.monotonic() - started, desk=desk, outcome=outcome)
+
+    async def _run_desk(self, desk, specialist, news_text):
+        """Runs one desk with its own timeout; returns (text, degraded)"""
+        started = time.monotonic()
+        try:
+            analysis = await asyncio.wait_for(specialist.analyze_news(news_text), timeout=self.desk_timeout)
+            self._record_desk(desk, started, 'ok')
+            return analysis or "", False
+        except asyncio.TimeoutError:
+            logger.warning("Desk %s timed out after %ss", desk, self.desk_timeout)
+            self._record_desk(desk, started, 'timeout')
+            return f"⚠️ Degraded: no answer within {self.desk_timeout:g}s", True
+        except Exception as e:
+            logger.warning("Desk %s failed: %s", desk, e)
+            self._record_desk(desk, started, 'error')
+            return f"⚠️ Degraded: analysis failed ({str(e)})", True
+
+    async def _analyze_per_desk(self, news_text, desks=None):
+        """Runs the desks concurrently and returns {desk: (text, degraded)}"""
+        desks = list(desks or self.desks)
+        results = await asyncio.gather(*[
+            self._run_desk(desk, self.desks[desk], news_text) for desk in desks
+        ])
+        return dict(zip(desks, results))
+
+    async def _analyze_combined(self, news_text):
+        """Analyzes all desks with one request; falls back to per-desk mode on malformed output"""
+        started = time.monotonic()
+        try:
+            sections = await asyncio.wait_for(
+                self.combined_specialist.analyze_news(news_text),
+                timeout=self.desk_timeout
+            )
+        except asyncio.TimeoutError:
+            logger.warning("Combined analysis timed out after %ss", self.desk_timeout)
+            self._record_desk('combined', started, 'timeout')
+            return {desk: (f"⚠️ Degraded: no answer within {self.desk_timeout:g}s", True) for desk in self.desks}
+        except ValueError as e:
+            logger.warning("Combined analysis returned malformed output (%s), falling back to per-desk mode", e)
+            self._record_desk('combined', started, 'malformed')
+            return await self._analyze_per_desk(news_text)
+        except Exception as e:
+            logger.warning("Combined analysis failed: %s", e)
+            self._record_desk('combined', started, 'error')
+            return {desk: (f"⚠️ Degraded: analysis failed ({str(e)})", True) for desk in self.desks}
+        self._record_desk('combined', started, 'ok')
+        return {desk: (sections[desk], False) for desk in self.desks}
+
+    async def _analyze_fresh(self, news_text, desks):
+        """Analyzes the given desks in the configured mode and caches the healthy results"""
+        if self.mode == ANALYSIS_MODE_COMBINED:
+            results = await self._analyze_combined(news_text)
+        else:
+            results = await self._analyze_per_desk(news_text, desks)
+        for desk in desks:
+            text, degraded = results[desk]
+            if not degraded:
+                await self.cache.set(content_key(news_text, desk), text)
+        return results
+
+    async def analyze(self, news_text):
+        """Returns {desk: (text, degraded)}, serving repeated news from the cache"""
+        started = time.monotonic()
+        results = {}
+        for desk in self.desks:
+            cached = await self.cache.get(content_key(news_text, desk))
+            if cached is not None:
+                results[desk] = (cached, False)
+
+        missing = tuple(desk for desk in self.desks if desk not in results)
+        if missing:
+            inflight_key = (content_key(news_text), missing)
+            task = self._inflight.get(inflight_key)
+            if task is None:
+                task = asyncio.create_task(self._analyze_fresh(news_text, missing))
+                self._inflight[inflight_key] = task
+                task.add_done_callback(lambda _: self._inflight.pop(inflight_key, None))
+            fresh = await asyncio.shield(task)
+            for desk in missing:
+                results[desk] = fresh[desk]
+
+        elapsed = time.monotonic() - started
+        logger.info("News analysis (%s, %d cached) took %.2fs", self.mode, len(self.desks) - len(missing), elapsed)
+        if self.metrics is not None:
+            self.metrics.observe('news_analysis_seconds', elapsed, mode=self.mode, cached='yes' if not missing else 'no')
+        return {desk: results[desk] for desk in self.desks}
 
-    def _generate_conclusion(self, indices, commodities, forex, stocks, crypto):
+    def _format_report(self, results):
+        """Builds the unified report; degraded desks are left out of the conclusion"""
+        sections = [f"{DESK_TITLES[desk]}\n{text}" for desk, (text, degraded) in results.items()]
+        healthy = [text for text, degraded in results.values() if not degraded]
+        return (
+            "📊 Trading signals from our analysts\n\n"
+            + "\n\n".join(sections)
+            + "\n\n"
+            + self._generate_conclusion(*healthy)
+        )
+
+    def _generate_conclusion(self, *analyses):
         """Generates a meaningful conclusion based on recommendations from all specialists"""
         
         # Formulate the main strategy
         strategy_parts = []
-        for analysis in [indices, commodities, forex, stocks, crypto]:
+        for analysis in analyses:
             if "Buy" in analysis:
                 strategy_parts.append(analysis.split("Buy:")[1].split("\n")[0].strip())
         
         # Collect risks
         risks = []
-        for analysis in [indices, commodities, forex, stocks, crypto]:
+        for analysis in analyses:
             if "Sell" in analysis:
                 risks.append(analysis.split("Sell:")[1].split("\n")[0].strip())
         
         # Collect hedging measures
         hedging = []
-        for analysis in [indices, commodities, forex, stocks, crypto]:
+        for analysis in analyses:
             if "Hedge" in analysis:
                 hedging.append(analysis.split("Hedge:")[1].split("\n")[0].strip())
 
@@ -121,11 +329,16 @@ class NewsHandler:
         conclusion = "📌 Conclusion:\n" + "\n".join(conclusion_parts) + "\n\n🚀 Awaiting the next news!"
         return conclusion
 
+    async def _reply(self, message, text, coalesce=True):
+        if self.outbox is None:
+            return await message.reply_text(text)
+        return await self.outbox.reply(message, text, coalesce=coalesce)
+
     async def handle_message(self, update, context):
         try:
             chat_id = update.effective_chat.id
             if chat_id not in self.news_mode_chats:
-                print(f"Chat {chat_id} is not in news mode")  # Debug
+                logger.debug("Chat %s is not in news mode", chat_id)
                 return
             
             # Get the news text from a regular or forwarded message
@@ -134,82 +347,62 @@ class NewsHandler:
             # Check for attributes
             is_forwarded = hasattr(update.message, 'forward_from') or hasattr(update.message, 'forward_from_chat')
             
-            # Debug information
-            print(f"Message type: {'Forwarded' if is_forwarded else 'Regular'}")
-            print(f"Text: {update.message.text}")
-            print(f"Caption: {update.message.caption}")
-            
             if is_forwarded:
-                print("Processing forwarded message")  # Debug
                 if update.message.text:
                     news_text = update.message.text
-                    print(f"Received text: {news_text}")  # Debug
                 elif update.message.caption:
                     news_text = update.message.caption
-                    print(f"Received caption: {news_text}")  # Debug
                 elif update.message.photo:
                     news_text = update.message.caption
-                    print(f"Received photo with caption: {news_text}")  # Debug
                 elif update.message.video:
                     news_text = update.message.caption
-                    print(f"Received video with caption: {news_text}")  # Debug
                 elif update.message.document:
                     news_text = update.message.caption
-                    print(f"Received document with caption: {news_text}")  # Debug
             else:
                 # Processing regular message with media
                 if update.message.text:
                     news_text = update.message.text
-                    print(f"Received regular message: {news_text}")  # Debug
                 elif update.message.photo:
                     news_text = update.message.caption
-                    print(f"Received photo with caption: {news_text}")  # Debug
                 elif update.message.video:
                     news_text = update.message.caption
-                    print(f"Received video with caption: {news_text}")  # Debug
                 elif update.message.document:
                     news_text = update.message.caption
-                    print(f"Received document with caption: {news_text}")  # Debug
+
+            # The full text is only dumped for a sample of messages, and only at DEBUG level
+            if sampled(logger):
+                logger.debug("%s news message: %s", 'Forwarded' if is_forwarded else 'Regular', news_text)
 
             # Check that the news text is not empty
             if not news_text:
-                await update.message.reply_text("Failed to retrieve news text. Please ensure the message contains text or a media caption.")
+                await self._reply(update.message, "Failed to retrieve news text. Please ensure the message contains text or a media caption.")
                 return
 
             # Send a message about the start of the analysis
-            status_message = await update.message.reply_text("🔄 Analyzing the news...")
-
-            # Get analysis from each specialist
-            try:
-                indices = await self.indices_specialist.analyze_news(news_text)
-                commodities = await self.commodities_specialist.analyze_news(news_text)
-                forex = await self.forex_specialist.analyze_news(news_text)
-                stocks = await self.stocks_specialist.analyze_news(news_text)
-                crypto = await self.crypto_specialist.analyze_news(news_text)
-            except Exception as e:
-                print(f"Error during analysis: {str(e)}")  # Debug
-                await status_message.edit_text(f"An error occurred during analysis: {str(e)}")
+            # The status message is edited or deleted later, so it is never merged with other messages
+            status_message = await self._reply(update.message, "🔄 Analyzing the news...", coalesce=False)
+
+            # Get analysis from all specialists concurrently
+            results = await self.analyze(news_text)
+            if all(degraded for text, degraded in results.values()):
+                await status_message.edit_text("An error occurred during analysis: all desks are unavailable")
                 return
 
             # Formulate a unified message
-            report = (
-                "📊 Trading signals from our analysts\n\n"
-                f"📈 Indices Specialist\n{indices}\n\n"
-                f"🛢️ Commodities Specialist\n{commodities}\n\n"
-                f"💱 Forex Specialist\n{forex}\n\n"
-                f"🏢 Stocks Specialist\n{stocks}\n\n"
-                f"🪙 Crypto Specialist\n{crypto}\n\n"
-                f"{self._generate_conclusion(indices, commodities, forex, stocks, crypto)}"
-            )
+            report = self._format_report(results)
 
             await status_message.delete()
-            await update.message.reply_text(report)
+            await self._reply(update.message, report)
             
         except Exception as e:
-            print(f"General error: {str(e)}")  # Debug
-            await update.message.reply_text(f"An error occurred: {str(e)}")
+            logger.exception("News handling failed: %s", e)
+            await self._reply(update.message, f"An error occurred: {str(e)}")
 
     def start_news_mode(self, chat_id):
         """Enables news mode for the specified chat"""
-        self.news_mode_chats.add(chat_id)
-        print(f"News mode activated for chat {chat_id}")  # Debug output
+        self.news_mode_chats[chat_id] = True
+        logger.info("News mode activated for chat %s", chat_id)
+
+    def stop_news_mode(self, chat_id):
+        """Disables news mode for the chat; called whenever the chat leaves the mode"""
+        self.news_mode_chats.pop(chat_id, None)
@@ -0,0 +1,138 @@
+import os
+import time
+import asyncio
+from collections import deque
+from telegram.error import RetryAfter
+from streaming import TELEGRAM_MESSAGE_LIMIT
+
+# Telegram allows about one message per second per chat and about 30 per second overall
+TELEGRAM_CHAT_INTERVAL = float(os.getenv('TELEGRAM_CHAT_INTERVAL', '1.0'))
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+# Plain messages up to this length that queue up for the same chat are sent as one message
+TELEGRAM_COALESCE_CHARS = int(os.getenv('TELEGRAM_COALESCE_CHARS', '500'))
+TELEGRAM_SEND_RETRIES = int(os.getenv('TELEGRAM_SEND_RETRIES', '3'))
+COALESCE_SEPARATOR = "\n\n"
+
+
+class _Outgoing:
+    def __init__(self, send, text, kwargs, coalesce, future):
+        self.send = send
+        self.text = text
+        self.kwargs = kwargs
+        self.coalesce = coalesce
+        self.future = future
+
+
+class SendQueue:
+    """Shared outbound queue: paces messages per chat and globally, waits out flood control
+    and merges consecutive short messages to the same chat.
+
+    Callers await delivery and get the sent Message back, as with reply_text.
+    """
+
+    def __init__(self, chat_interval=TELEGRAM_CHAT_INTERVAL, global_rate=TELEGRAM_GLOBAL_RATE,
+                 coalesce_chars=TELEGRAM_COALESCE_CHARS, retries=TELEGRAM_SEND_RETRIES):
+        self.chat_interval = chat_interval
+        self.global_interval = 1.0 / global_rate if global_rate > 0 else 0.0
+        self.coalesce_chars = coalesce_chars
+        self.retries = retries
+        self.pending = {}  # chat_id -> deque of _Outgoing
+        self.workers = {}  # chat_id -> drain task, alive while the chat has pending or recent messages
+        self.stats = {'sent': 0, 'coalesced': 0, 'flood_waits': 0}
+        self._global_next = 0.0
+        self._global_lock = asyncio.Lock()
+
+    async def reply(self, message, text, coalesce=True, **kwargs):
+        """Queued equivalent of message.reply_text(text, **kwargs)"""
+        return await self.send(message.chat_id, message.reply_text, text, coalesce, **kwargs)
+
+    async def edit(self, message, text, **kwargs):
+        """Queued equivalent of message.edit_text(text, **kwargs); edits share the chat's pacing with new messages"""
+        return await self.send(message.chat_id, message.edit_text, text, False, **kwargs)
+
+    async def send(self, chat_id, send, text, coalesce=True, **kwargs):
+        """Queues send(text, **kwargs) for the chat; only messages without extra options are merged"""
+        future = asyncio.get_running_loop().create_future()
+        outgoing = _Outgoing(send, text, kwargs, coalesce and not kwargs, future)
+        self.pending.setdefault(chat_id, deque()).append(outgoing)
+        if chat_id not in self.workers:
+            self.workers[chat_id] = asyncio.create_task(self._drain(chat_id))
+        return await future
+
+    def depth(self):
+        return sum(len(queue) for queue in self.pending.values())
+
+    def _take(self, queue):
+        """Pops the next message, merged with the short plain messages queued right after it"""
+        # Messages whose sender was cancelled (e.g. by /stop) are dropped
+        while queue and queue[0].future.cancelled():
+            queue.popleft()
+        if not queue:
+            return []
+        batch = [queue.popleft()]
+        if not batch[0].coalesce or len(batch[0].text) > self.coalesce_chars:
+            return batch
+        length = len(batch[0].text)
+        while queue and queue[0].coalesce and len(queue[0].text) <= self.coalesce_chars and not queue[0].future.cancelled():
+            length += len(COALESCE_SEPARATOR) + len(queue[0].text)
+            if length > TELEGRAM_MESSAGE_LIMIT:
+                break
+            batch.append(queue.popleft())
+        return batch
+
+    async def _global_slot(self):
+        async with self._global_lock:
+            now = time.monotonic()
+            if self._global_next > now:
+                await asyncio.sleep(self._global_next - now)
+            self._global_next = max(now, self._global_next) + self.global_interval
+
+    async def _deliver(self, batch):
+        # A single item is passed through as is, so documents can be queued too
+        text = batch[0].text if len(batch) == 1 else COALESCE_SEPARATOR.join(item.text for item in batch)
+        attempt = 0
+        while True:
+            await self._global_slot()
+            try:
+                return await batch[0].send(text, **batch[0].kwargs)
+            except RetryAfter as e:
+                self.stats['flood_waits'] += 1
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+                await asyncio.sleep(float(e.retry_after))
+
+    async def _drain(self, chat_id):
+        queue = self.pending[chat_id]
+        next_send = 0.0
+        try:
+            while True:
+                wait = next_send - time.monotonic()
+                if not queue and wait <= 0:
+                    break
+                if wait > 0:
+                    # Also keeps the worker alive for the rest of the interval so pacing holds for the next message
+                    await asyncio.sleep(wait)
+                    continue
+
+                batch = self._take(queue)
+                if not batch:
+                    continue
+                try:
+                    message = await self._deliver(batch)
+                except Exception as e:
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_exception(e)
+                else:
+                    self.stats['sent'] += 1
+                    self.stats['coalesced'] += len(batch) - 1
+                    for item in batch:
+                        if not item.future.done():
+                            item.future.set_result(message)
+                next_send = time.monotonic() + self.chat_interval
+        finally:
+            self.workers.pop(chat_id, None)
+            self.pending.pop(chat_id, None)
+            for item in queue:
+                item.future.cancel()
@@ -0,0 +1,186 @@
+import os
+import asyncio
+import logging
+import importlib.util
+import httpx
+from openai import AsyncOpenAI
+from anthropic import AsyncAnthropic
+
+logger = logging.getLogger(__name__)
+
+XAI_BASE_URL = "https://api.x.ai/v1"
+GEMINI_BASE_URL = "https://generativelanguage.googleapis.com/v1beta"
+OPENAI_BASE_URL = "https://api.openai.com/v1"
+ANTHROPIC_BASE_URL = "https://api.anthropic.com"
+
+PROVIDERS = ('xai', 'gemini', 'openai', 'anthropic')
+
+# Default pool sizes per provider: (max_connections, max_keepalive_connections)
+DEFAULT_POOL_LIMITS = {
+    'xai': (20, 10),
+    'gemini': (20, 10),
+    'openai': (50, 20),
+    'anthropic': (20, 10),
+}
+
+
+def _env_int(name, default):
+    value = os.getenv(name)
+    return int(value) if value and value.isdigit() else default
+
+
+def _env_float(name, default):
+    value = os.getenv(name)
+    try:
+        return float(value) if value else default
+    except ValueError:
+        return default
+
+
+def _env_flag(name, default=False):
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def pool_limits(provider):
+    """Returns httpx.Limits for a provider, overridable via <PROVIDER>_MAX_CONNECTIONS / <PROVIDER>_MAX_KEEPALIVE"""
+    max_connections, max_keepalive = DEFAULT_POOL_LIMITS[provider]
+    prefix = provider.upper()
+    return httpx.Limits(
+        max_connections=_env_int(f"{prefix}_MAX_CONNECTIONS", max_connections),
+        max_keepalive_connections=_env_int(f"{prefix}_MAX_KEEPALIVE", max_keepalive),
+        keepalive_expiry=_env_float("PROVIDER_KEEPALIVE_EXPIRY", 60.0),
+    )
+
+
+def http2_available():
+    return importlib.util.find_spec('h2') is not None
+
+
+class ProviderClients:
+    """Long-lived, pooled clients for every LLM provider, shared by all requests"""
+
+    def __init__(self, openai_api_key=None, anthropic_api_key=None, xai_api_key=None, gemini_api_key=None,
+                 timeout=None, http2=None):
+        self.openai_api_key = openai_api_key
+        self.anthropic_api_key = anthropic_api_key
+        self.xai_api_key = xai_api_key
+        self.gemini_api_key = gemini_api_key
+        self.timeout = timeout if timeout is not None else _env_float("PROVIDER_TIMEOUT", 30.0)
+
+        http2 = _env_flag("PROVIDER_HTTP2") if http2 is None else http2
+        if http2 and not http2_available():
+            logger.warning("PROVIDER_HTTP2 is enabled but the 'h2' package is not installed, falling back to HTTP/1.1")
+            http2 = False
+        self.http2 = http2
+
+        self._xai = None
+        self._gemini = None
+        self._openai = None
+        self._anthropic = None
+        self._openai_http = None
+        self._anthropic_http = None
+
+    def _async_http_client(self, provider, **kwargs):
+        return httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=pool_limits(provider),
+            http2=self.http2,
+            **kwargs
+        )
+
+    @property
+    def xai(self):
+        """httpx client for the xAI chat completions API"""
+        if self._xai is None:
+            self._xai = self._async_http_client(
+                'xai',
+                base_url=XAI_BASE_URL,
+                headers={
+                    "Content-Type": "application/json",
+                    "Authorization": f"Bearer {self.xai_api_key}"
+                }
+            )
+        return self._xai
+
+    @property
+    def gemini(self):
+        """httpx client for the Gemini generateContent API"""
+        if self._gemini is None:
+            self._gemini = self._async_http_client(
+                'gemini',
+                base_url=GEMINI_BASE_URL,
+                headers={"Content-Type": "application/json"},
+                params={"key": self.gemini_api_key}
+            )
+        return self._gemini
+
+    @property
+    def openai(self):
+        """AsyncOpenAI client backed by a shared connection pool"""
+        if self._openai is None:
+            self._openai_http = self._async_http_client('openai')
+            # Retries and 429 back-off belong to the RequestScheduler and the router's failover;
+            # SDK retries would repeat every request on top of them
+            self._openai = AsyncOpenAI(
+                api_key=self.openai_api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=self._openai_http
+            )
+        return self._openai
+
+    @property
+    def anthropic(self):
+        """AsyncAnthropic client backed by a shared connection pool"""
+        if self._anthropic is None:
+            self._anthropic_http = self._async_http_client('anthropic')
+            self._anthropic = AsyncAnthropic(
+                api_key=self.anthropic_api_key,
+                timeout=self.timeout,
+                max_retries=0,
+                http_client=self._anthropic_http
+            )
+        return self._anthropic
+
+    async def start(self):
+        """Creates all clients and warms their pools so the first reply skips the TCP+TLS handshake"""
+        await self.warm()
+
+    async def warm(self):
+        """Opens one keep-alive connection per provider; failures are ignored"""
+        async def _touch(client, url):
+            try:
+                await client.head(url, timeout=5.0)
+            except Exception as e:
+                logger.info("Warm-up request to %s failed: %s", url, e)
+
+        # Touching the properties creates the clients
+        self.openai
+        self.anthropic
+        targets = [
+            (self.xai, XAI_BASE_URL),
+            (self.gemini, GEMINI_BASE_URL),
+            (self._openai_http, OPENAI_BASE_URL),
+            (self._anthropic_http, ANTHROPIC_BASE_URL),
+        ]
+        await asyncio.gather(*[_touch(client, url) for client, url in targets])
+
+    async def close(self):
+        """Closes every pool; clients are recreated lazily on next use"""
+        if self._xai is not None:
+            await self._xai.aclose()
+        if self._gemini is not None:
+            await self._gemini.aclose()
+        if self._openai is not None:
+            await self._openai.close()
+        if self._anthropic is not None:
+            await self._anthropic.close()
+        self._xai = None
+        self._gemini = None
+        self._openai = None
+        self._anthropic = None
+        self._openai_http = None
+        self._anthropic_http = None
@@ -0,0 +1,181 @@
+import os
+import time
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Default per-provider limits; override with <PROVIDER>_RPM / <PROVIDER>_TPM, 0 disables a limit
+DEFAULT_LIMITS = {
+    'openai': {'rpm': 500, 'tpm': 200000},
+    'anthropic': {'rpm': 50, 'tpm': 40000},
+    'xai': {'rpm': 60, 'tpm': 100000},
+    'gemini': {'rpm': 15, 'tpm': 1000000},
+}
+# Requests allowed to wait for one provider; beyond that new requests fail fast
+RATE_QUEUE_DEPTH = int(os.getenv('RATE_QUEUE_DEPTH', '100'))
+# How many times a request rejected with 429 is retried after the provider's Retry-After
+RATE_LIMIT_RETRIES = int(os.getenv('RATE_LIMIT_RETRIES', '2'))
+# Pause used when a 429 comes without a Retry-After header
+RATE_RETRY_AFTER_DEFAULT = float(os.getenv('RATE_RETRY_AFTER_DEFAULT', '5'))
+
+
+class QueueFull(Exception):
+    """Raised when too many requests are already waiting for a provider"""
+
+
+class RateLimited(Exception):
+    """Raised by adapters when a provider answers 429"""
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _parse_retry_after(value):
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        return None
+
+
+def retry_after_from(error):
+    """Seconds to back off if the error is a provider rate limit, otherwise None.
+
+    Understands RateLimited, the OpenAI/Anthropic SDK status errors and httpx.HTTPStatusError.
+    """
+    if isinstance(error, RateLimited):
+        return error.retry_after if error.retry_after is not None else RATE_RETRY_AFTER_DEFAULT
+    response = getattr(error, 'response', None)
+    status = getattr(error, 'status_code', None) or getattr(response, 'status_code', None)
+    if status != 429:
+        return None
+    headers = getattr(response, 'headers', None) or {}
+    delay = _parse_retry_after(headers.get('retry-after'))
+    return RATE_RETRY_AFTER_DEFAULT if delay is None else delay
+
+
+def provider_limits(provider):
+    defaults = DEFAULT_LIMITS.get(provider, {'rpm': 0, 'tpm': 0})
+    limits = {}
+    for kind in ('rpm', 'tpm'):
+        value = os.getenv(f"{provider.upper()}_{kind.upper()}")
+        limits[kind] = int(value) if value and value.isdigit() else defaults[kind]
+    return limits
+
+
+class TokenBucket:
+    """Allows `per_minute` units per minute with bursts up to one minute's worth"""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+
+    @property
+    def unlimited(self):
+        return self.capacity <= 0
+
+    def _refill(self):
+        now = time.monotonic()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount):
+        """Seconds until `amount` units are available"""
+        if self.unlimited:
+            return 0.0
+        self._refill()
+        amount = min(amount, self.capacity)
+        return 0.0 if self.level >= amount else (amount - self.level) / self.rate
+
+    def take(self, amount):
+        if not self.unlimited:
+            self.level -= min(amount, self.capacity)
+
+
+class ProviderLimiter:
+    """Request and token buckets of one provider with a bounded FIFO of waiting requests"""
+
+    def __init__(self, rpm=0, tpm=0, max_queue=RATE_QUEUE_DEPTH):
+        self.requests = TokenBucket(rpm)
+        self.tokens = TokenBucket(tpm)
+        self.max_queue = max_queue
+        self.waiting = 0
+        self.blocked_until = 0.0
+        self.throttled = 0  # 429 answers seen
+        self.rejected = 0  # requests refused because the queue was full
+        self._lock = asyncio.Lock()
+
+    def pause(self, seconds):
+        """Holds every request to this provider for `seconds` (Retry-After)"""
+        self.throttled += 1
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+    async def acquire(self, tokens=0):
+        if self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise QueueFull(f"Too many requests waiting ({self.waiting})")
+        self.waiting += 1
+        try:
+            # The lock keeps waiting requests in arrival order
+            async with self._lock:
+                while True:
+                    wait = max(
+                        self.blocked_until - time.monotonic(),
+                        self.requests.wait_time(1),
+                        self.tokens.wait_time(tokens),
+                    )
+                    if wait <= 0:
+                        self.requests.take(1)
+                        self.tokens.take(tokens)
+                        return
+                    await asyncio.sleep(wait)
+        finally:
+            self.waiting -= 1
+
+
+class RequestScheduler:
+    """Central gate for outbound model calls: per-provider RPM/TPM buckets, bounded queues and Retry-After"""
+
+    def __init__(self, limits=None, max_queue=RATE_QUEUE_DEPTH, retries=RATE_LIMIT_RETRIES):
+        self.limits = limits or {}
+        self.max_queue = max_queue
+        self.retries = retries
+        self.limiters = {}
+
+    def limiter(self, provider):
+        if provider not in self.limiters:
+            limits = self.limits.get(provider) or provider_limits(provider)
+            self.limiters[provider] = ProviderLimiter(limits['rpm'], limits['tpm'], self.max_queue)
+        return self.limiters[provider]
+
+    async def run(self, provider, call, tokens=0):
+        """Waits for the provider's budget, then awaits call(); 429s pause the provider and are retried"""
+        limiter = self.limiter(provider)
+        attempt = 0
+        while True:
+            await limiter.acquire(tokens)
+            try:
+                return await call()
+            except Exception as e:
+                delay = retry_after_from(e)
+                if delay is None:
+                    raise
+                limiter.pause(delay)
+                logger.warning("%s rate limited, pausing %.1fs", provider, delay)
+                if attempt >= self.retries:
+                    raise
+                attempt += 1
+
+    def report(self):
+        """Queue depth and throttling counters per provider"""
+        return {
+            provider: {
+                'waiting': limiter.waiting,
+                'throttled': limiter.throttled,
+                'rejected': limiter.rejected,
+            }
+            for provider, limiter in self.limiters.items()
+        }
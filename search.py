@@ -0,0 +1,103 @@
+import re
+import math
+import heapq
+from collections import defaultdict, deque
+from history import HISTORY_BUFFER_SIZE
+
+WORD = re.compile(r"\w+", re.UNICODE)
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+
+def tokenize(text):
+    """Lowercased words of at least two characters"""
+    return [word for word in WORD.findall((text or '').lower()) if len(word) > 1]
+
+
+class ChatIndex:
+    """Inverted index over one chat's dialog history, updated as entries are appended.
+
+    It mirrors the per-role ring buffers: once a role has more than `capacity` entries, its oldest
+    entry leaves the index too, so memory and query cost are bounded by the buffer size.
+    """
+
+    def __init__(self, capacity=HISTORY_BUFFER_SIZE):
+        self.capacity = capacity
+        self.postings = defaultdict(dict)  # term -> {doc_id: term frequency}
+        self.docs = {}  # doc_id -> (role, entry, length)
+        self.by_role = defaultdict(deque)  # role -> doc_ids, oldest first
+        self.total_length = 0
+        self._next_id = 0
+
+    def add(self, role, entry):
+        terms = tokenize(entry['user']) + tokenize(entry['assistant'])
+        doc_id = self._next_id
+        self._next_id += 1
+        counts = defaultdict(int)
+        for term in terms:
+            counts[term] += 1
+        for term, count in counts.items():
+            self.postings[term][doc_id] = count
+        self.docs[doc_id] = (role, entry, len(terms))
+        self.total_length += len(terms)
+        ids = self.by_role[role]
+        ids.append(doc_id)
+        while len(ids) > self.capacity:
+            self._remove(ids.popleft())
+
+    def _remove(self, doc_id):
+        role, entry, length = self.docs.pop(doc_id)
+        self.total_length -= length
+        for term in set(tokenize(entry['user']) + tokenize(entry['assistant'])):
+            postings = self.postings.get(term)
+            if postings is None:
+                continue
+            postings.pop(doc_id, None)
+            if not postings:
+                del self.postings[term]
+
+    def reset(self, role=None):
+        """Drops one role's entries, or everything"""
+        roles = [role] if role is not None else list(self.by_role)
+        for name in roles:
+            for doc_id in self.by_role.pop(name, ()):
+                self._remove(doc_id)
+
+    def search(self, query, limit=None):
+        """Entries matching any query word, best first: entries with more of the words rank first,
+        then by BM25 score, then newest first. Returns [(role, entry), ...]"""
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not terms or not self.docs:
+            return []
+        average = self.total_length / len(self.docs) or 1
+        scores = defaultdict(float)
+        matched = defaultdict(int)
+        for term in terms:
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = math.log(1 + (len(self.docs) - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, frequency in postings.items():
+                length = self.docs[doc_id][2]
+                scores[doc_id] += idf * frequency * (K1 + 1) / (frequency + K1 * (1 - B + B * length / average))
+                matched[doc_id] += 1
+        rank = lambda doc_id: (matched[doc_id], scores[doc_id], doc_id)
+        ranked = heapq.nlargest(limit, scores, key=rank) if limit else sorted(scores, key=rank, reverse=True)
+        return [self.docs[doc_id][:2] for doc_id in ranked]
+
+    def count(self, query):
+        """Number of entries matching any query word"""
+        matches = set()
+        for term in set(tokenize(query)):
+            matches.update(self.postings.get(term, ()))
+        return len(matches)
+
+    @classmethod
+    def build(cls, role_histories, capacity=HISTORY_BUFFER_SIZE):
+        """Index of existing histories, e.g. after the chat was loaded from the session store"""
+        index = cls(capacity)
+        for role, history in role_histories.items():
+            for entry in history:
+                index.add(role, entry)
+        return index
@@ -0,0 +1,207 @@
+import os
+import zlib
+import asyncio
+import logging
+import httpx
+from collections import deque
+from telegram.ext import BaseUpdateProcessor
+
+logger = logging.getLogger(__name__)
+
+# Comma-separated webhook URLs of all bot processes, in shard order; their number is the shard count
+SHARD_URLS = [url.strip() for url in os.getenv('SHARD_URLS', '').split(',') if url.strip()]
+# Position of this process in SHARD_URLS (0-based)
+SHARD_INDEX = int(os.getenv('SHARD_INDEX', '0'))
+SHARD_FORWARD_TIMEOUT = float(os.getenv('SHARD_FORWARD_TIMEOUT', '10'))
+# Tries per update on transport errors, 5xx and 429 before it is dropped; other 4xx are dropped at once
+SHARD_FORWARD_ATTEMPTS = int(os.getenv('SHARD_FORWARD_ATTEMPTS', '6'))
+# Updates waiting per owning shard; beyond that new ones are dropped rather than piling up in memory
+SHARD_QUEUE_SIZE = int(os.getenv('SHARD_QUEUE_SIZE', '1000'))
+
+# Update fields that carry the chat; updates without a chat fall back to the sending user
+CHAT_PATHS = (
+    ('message', 'chat', 'id'),
+    ('edited_message', 'chat', 'id'),
+    ('channel_post', 'chat', 'id'),
+    ('edited_channel_post', 'chat', 'id'),
+    ('callback_query', 'message', 'chat', 'id'),
+    ('my_chat_member', 'chat', 'id'),
+    ('chat_member', 'chat', 'id'),
+    ('chat_join_request', 'chat', 'id'),
+    ('callback_query', 'from', 'id'),
+    ('inline_query', 'from', 'id'),
+    ('chosen_inline_result', 'from', 'id'),
+    ('shipping_query', 'from', 'id'),
+    ('pre_checkout_query', 'from', 'id'),
+    ('poll_answer', 'user', 'id'),
+)
+
+
+def chat_id_of(update):
+    """Chat (or user, for chat-less updates) a raw update belongs to; None for updates like polls"""
+    for path in CHAT_PATHS:
+        value = update
+        for key in path:
+            value = value.get(key) if isinstance(value, dict) else None
+        if value is not None:
+            return value
+    return None
+
+
+def shard_for(chat_id, count):
+    """Stable shard of a chat: the same chat_id maps to the same shard in every process and on every host"""
+    if count <= 1 or chat_id is None:
+        return 0
+    return zlib.crc32(str(chat_id).encode()) % count
+
+
+class ChatOrderedProcessor(BaseUpdateProcessor):
+    """Handles up to `max_concurrent_updates` updates at once, but one at a time per chat, in arrival order.
+
+    Each chat has its own queue drained by one worker task, which takes a concurrency slot only while
+    it runs an update; later updates of a busy chat wait in its queue without holding a slot, so one
+    chat cannot starve the others. process_update returns once the update is queued; join() waits
+    for the queues to drain.
+    """
+
+    __slots__ = ('_chats', '_workers')
+
+    def __init__(self, max_concurrent_updates):
+        super().__init__(max_concurrent_updates)
+        self._chats = {}  # chat_id -> deque of update coroutines waiting for the chat's worker
+        self._workers = set()
+
+    async def do_process_update(self, update, coroutine):
+        chat = getattr(update, 'effective_chat', None)
+        if chat is None:
+            await coroutine
+            return
+        queue = self._chats.get(chat.id)
+        if queue is None:
+            queue = self._chats[chat.id] = deque()
+            worker = asyncio.create_task(self._drain(chat.id, queue))
+            self._workers.add(worker)
+            worker.add_done_callback(self._workers.discard)
+        queue.append(coroutine)
+
+    async def _drain(self, chat_id, queue):
+        try:
+            while queue:
+                coroutine = queue.popleft()
+                async with self._semaphore:
+                    try:
+                        await coroutine
+                    except Exception:
+                        logger.exception("Update of chat %s failed", chat_id)
+        finally:
+            del self._chats[chat_id]
+            for coroutine in queue:
+                coroutine.close()
+
+    async def join(self):
+        """Waits until every queued update has been handled"""
+        while self._workers:
+            await asyncio.gather(*self._workers, return_exceptions=True)
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        await self.join()
+
+
+class ShardForwarder:
+    """Sends updates owned by other shards to their webhook, one ordered stream per shard.
+
+    Any process can receive any update (e.g. behind a round-robin load balancer); every update of a
+    chat is still handled by the same process, and ChatOrderedProcessor there handles it in the
+    order it arrived.
+    """
+
+    def __init__(self, urls=SHARD_URLS, secret_token='', index=SHARD_INDEX, timeout=SHARD_FORWARD_TIMEOUT,
+                 attempts=SHARD_FORWARD_ATTEMPTS, queue_size=SHARD_QUEUE_SIZE, metrics=None):
+        self.urls = list(urls)
+        self.index = index
+        self.secret_token = secret_token
+        self.timeout = timeout
+        self.attempts = attempts
+        self.queue_size = queue_size
+        self.metrics = metrics  # Metrics registry for dropped updates, optional
+        self.queues = {}  # shard -> asyncio.Queue of raw updates
+        self.workers = {}
+        self.stats = {'forwarded': 0, 'failed': 0, 'dropped': 0}
+        self._client = None
+
+    @property
+    def count(self):
+        return len(self.urls) or 1
+
+    def owner(self, update):
+        return shard_for(chat_id_of(update), self.count)
+
+    def is_local(self, update):
+        return self.owner(update) == self.index
+
+    async def forward(self, update):
+        """Queues the update for its owning shard; delivery keeps per-shard order"""
+        shard = self.owner(update)
+        if shard not in self.queues:
+            self.queues[shard] = asyncio.Queue(self.queue_size)
+            self.workers[shard] = asyncio.create_task(self._deliver(shard))
+        try:
+            self.queues[shard].put_nowait(update)
+        except asyncio.QueueFull:
+            self._drop(update, shard, 'queue_full')
+
+    def _drop(self, update, shard, reason, detail=''):
+        """Gives up on an update: 'rejected' by the owner, 'retries_exhausted' or 'queue_full'"""
+        self.stats['dropped'] += 1
+        if self.metrics is not None:
+            self.metrics.inc('shard_updates_dropped_total', shard=shard, reason=reason)
+        logger.error("Dropped update %s for shard %s (%s): %s", update.get('update_id'), shard, reason, detail or '-')
+
+    async def _post(self, shard, update, headers):
+        """Delivers one update; returns None on success or (reason, detail) when it was given up on"""
+        delay = 0.5
+        for attempt in range(1, self.attempts + 1):
+            try:
+                response = await self._client.post(self.urls[shard], json=update, headers=headers)
+            except httpx.TransportError as e:
+                error = str(e) or type(e).__name__
+            else:
+                if response.is_success:
+                    return None
+                error = f"HTTP {response.status_code}"
+                # A rejected update (bad payload, wrong secret) fails the same way every time
+                if response.status_code < 500 and response.status_code != 429:
+                    return 'rejected', error
+            self.stats['failed'] += 1
+            logger.warning("Forwarding update %s to shard %s failed (attempt %d/%d): %s",
+                           update.get('update_id'), shard, attempt, self.attempts, error)
+            if attempt < self.attempts:
+                await asyncio.sleep(delay)
+                delay = min(delay * 2, 10.0)
+        return 'retries_exhausted', error
+
+    async def _deliver(self, shard):
+        if self._client is None:
+            self._client = httpx.AsyncClient(timeout=self.timeout)
+        headers = {'X-Telegram-Bot-Api-Secret-Token': self.secret_token} if self.secret_token else {}
+        queue = self.queues[shard]
+        while True:
+            update = await queue.get()
+            # Later updates wait while this one is retried, so they never overtake it
+            failure = await self._post(shard, update, headers)
+            if failure is None:
+                self.stats['forwarded'] += 1
+            else:
+                self._drop(update, shard, *failure)
+
+    async def close(self):
+        for task in self.workers.values():
+            task.cancel()
+        self.workers.clear()
+        self.queues.clear()
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
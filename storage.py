@@ -0,0 +1,529 @@
+import os
+import json
+import asyncio
+import logging
+import sqlite3
+import threading
+from collections import deque
+from datetime import datetime
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+# Where per-chat state lives: 'sqlite' (default), 'redis' (shared by several bot processes), 'memory' or 'none'
+STATE_BACKEND = os.getenv('STATE_BACKEND', 'sqlite').lower()
+# SQLite file for per-chat state; an empty value disables persistence
+SESSION_DB_PATH = os.getenv('SESSION_DB_PATH', 'sessions.sqlite3')
+STATE_REDIS_URL = os.getenv('STATE_REDIS_URL', 'redis://127.0.0.1:6379/0')
+STATE_REDIS_PREFIX = os.getenv('STATE_REDIS_PREFIX', 'agihedge:chat:')
+# Seconds between batched writes; all changes of a chat within one interval become one row write
+SESSION_FLUSH_INTERVAL = float(os.getenv('SESSION_FLUSH_INTERVAL', '1.0'))
+
+
+def _encode_default(value):
+    if isinstance(value, datetime):
+        return {'__datetime__': value.isoformat()}
+    if isinstance(value, (set, tuple, deque)):
+        return list(value)
+    raise TypeError(f"Cannot store {type(value).__name__}")
+
+
+def _decode_hook(value):
+    if '__datetime__' in value and len(value) == 1:
+        return datetime.fromisoformat(value['__datetime__'])
+    return value
+
+
+def encode_value(value):
+    return json.dumps(value, ensure_ascii=False, default=_encode_default)
+
+
+def decode_value(raw):
+    return json.loads(raw, object_hook=_decode_hook)
+
+
+def _copy(value):
+    """Copy of the containers inside a value, so a worker thread can encode it while the loop mutates the original"""
+    if isinstance(value, dict):
+        return {key: _copy(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, deque, set)):
+        return [_copy(item) for item in value]
+    return value
+
+
+def _encode_rows(snapshot):
+    """Encodes (chat_id, name, value or _MISSING, previous raw) and keeps the rows that changed; runs in a thread"""
+    rows = []
+    for chat_id, name, value, previous in snapshot:
+        raw = None if value is _MISSING else encode_value(value)
+        if raw != previous:
+            rows.append((chat_id, name, raw))
+    return rows
+
+
+def merge_dicts(chat_id, stored, current):
+    """Default merge on hydration: keys written while the chat was out of memory win over stored ones"""
+    if isinstance(stored, dict) and isinstance(current, dict):
+        return {**stored, **current}
+    return current
+
+
+_MISSING = object()
+
+
+class StateBackend:
+    """Storage for encoded per-chat values: rows are (chat_id, name, raw JSON or None to delete)"""
+
+    async def open(self):
+        pass
+
+    async def load(self, chat_id):
+        """Returns [(name, raw), ...] saved for the chat"""
+        raise NotImplementedError
+
+    async def write(self, rows):
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class MemoryBackend(StateBackend):
+    """In-process backend: keeps the encoded rows in a dict, for single-process runs and benchmarks"""
+
+    def __init__(self):
+        self.rows = {}  # chat_id -> {name: raw}
+
+    async def load(self, chat_id):
+        return list(self.rows.get(chat_id, {}).items())
+
+    async def write(self, rows):
+        for chat_id, name, raw in rows:
+            if raw is None:
+                self.rows.get(chat_id, {}).pop(name, None)
+            else:
+                self.rows.setdefault(chat_id, {})[name] = raw
+
+
+class SQLiteBackend(StateBackend):
+    """Local SQLite file in WAL mode; queries run in a worker thread"""
+
+    def __init__(self, path=SESSION_DB_PATH):
+        self.path = path
+        self._db = None
+        self._db_lock = threading.Lock()
+
+    def _connect(self):
+        db = sqlite3.connect(self.path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS chat_state ("
+            "chat_id INTEGER NOT NULL, name TEXT NOT NULL, value TEXT NOT NULL, "
+            "PRIMARY KEY (chat_id, name))"
+        )
+        db.commit()
+        return db
+
+    def _load_rows(self, chat_id):
+        with self._db_lock:
+            return self._db.execute("SELECT name, value FROM chat_state WHERE chat_id = ?", (chat_id,)).fetchall()
+
+    def _write_rows(self, rows):
+        with self._db_lock:
+            with self._db:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO chat_state (chat_id, name, value) VALUES (?, ?, ?)",
+                    [(chat_id, name, raw) for chat_id, name, raw in rows if raw is not None]
+                )
+                self._db.executemany(
+                    "DELETE FROM chat_state WHERE chat_id = ? AND name = ?",
+                    [(chat_id, name) for chat_id, name, raw in rows if raw is None]
+                )
+
+    async def open(self):
+        if self._db is None:
+            self._db = await asyncio.to_thread(self._connect)
+
+    async def load(self, chat_id):
+        return await asyncio.to_thread(self._load_rows, chat_id)
+
+    async def write(self, rows):
+        await asyncio.to_thread(self._write_rows, rows)
+
+    async def close(self):
+        if self._db is None:
+            return
+        with self._db_lock:
+            self._db.close()
+        self._db = None
+
+
+def _encode_command(args):
+    parts = [f"*{len(args)}\r\n".encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+        parts.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+    return b"".join(parts)
+
+
+class RedisError(Exception):
+    """Error reply from a Redis-protocol server"""
+
+
+class RedisBackend(StateBackend):
+    """Keeps each chat in one Redis hash (field per state dict) over a single pipelined RESP connection.
+
+    Works with Redis and anything that speaks its protocol (KeyDB, Dragonfly, RespStandIn below).
+    """
+
+    def __init__(self, url=STATE_REDIS_URL, prefix=STATE_REDIS_PREFIX):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = parsed.password
+        self.db = int(parsed.path.strip('/') or 0)
+        self.prefix = prefix
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    def key(self, chat_id):
+        return f"{self.prefix}{chat_id}"
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis connection closed")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b'+':
+            return payload.decode()
+        if kind == b'-':
+            return RedisError(payload.decode())
+        if kind == b':':
+            return int(payload)
+        if kind == b'$':
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2].decode('utf-8')
+        if kind == b'*':
+            length = int(payload)
+            return None if length < 0 else [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        setup = []
+        if self.password:
+            setup.append(('AUTH', self.password))
+        if self.db:
+            setup.append(('SELECT', self.db))
+        if setup:
+            await self._send(setup)
+
+    async def _send(self, commands):
+        self._writer.write(b"".join(_encode_command(command) for command in commands))
+        await self._writer.drain()
+        replies = [await self._read_reply() for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    async def pipeline(self, commands):
+        """Sends all commands in one write and reads their replies; reconnects once after a dropped connection"""
+        async with self._lock:
+            for attempt in (0, 1):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._send(commands)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    await self._disconnect()
+                    if attempt:
+                        raise
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+        self._reader = self._writer = None
+
+    async def open(self):
+        await self.pipeline([('PING',)])
+
+    async def load(self, chat_id):
+        reply, = await self.pipeline([('HGETALL', self.key(chat_id))])
+        return list(zip(reply[::2], reply[1::2]))
+
+    async def write(self, rows):
+        updates = {}
+        deletes = {}
+        for chat_id, name, raw in rows:
+            if raw is None:
+                deletes.setdefault(chat_id, []).append(name)
+            else:
+                updates.setdefault(chat_id, []).extend((name, raw))
+        commands = [('HSET', self.key(chat_id), *fields) for chat_id, fields in updates.items()]
+        commands += [('HDEL', self.key(chat_id), *names) for chat_id, names in deletes.items()]
+        if commands:
+            await self.pipeline(commands)
+
+    async def close(self):
+        async with self._lock:
+            await self._disconnect()
+
+
+class RespStandIn:
+    """In-memory server for the subset of the Redis protocol RedisBackend uses, for local runs and benchmarks"""
+
+    def __init__(self, host='127.0.0.1', port=0):
+        self.host = host
+        self.port = port
+        self.hashes = {}
+        self._server = None
+        self._connections = set()
+
+    @property
+    def url(self):
+        return f"redis://{self.host}:{self._server.sockets[0].getsockname()[1]}/0"
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        return self
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.sleep(0)
+            await self._server.wait_closed()
+            self._server = None
+
+    def _execute(self, command, args):
+        if command == 'PING':
+            return b"+PONG\r\n"
+        if command in ('SELECT', 'AUTH'):
+            return b"+OK\r\n"
+        if command == 'HSET':
+            fields = self.hashes.setdefault(args[0], {})
+            pairs = list(zip(args[1::2], args[2::2]))
+            added = sum(1 for name, _ in pairs if name not in fields)
+            fields.update(pairs)
+            return f":{added}\r\n".encode()
+        if command == 'HDEL':
+            fields = self.hashes.get(args[0], {})
+            removed = sum(1 for name in args[1:] if fields.pop(name, None) is not None)
+            return f":{removed}\r\n".encode()
+        if command == 'HGETALL':
+            items = [value for pair in self.hashes.get(args[0], {}).items() for value in pair]
+            return _encode_command(items)
+        if command == 'DEL':
+            removed = sum(1 for key in args if self.hashes.pop(key, None) is not None)
+            return f":{removed}\r\n".encode()
+        return f"-ERR unknown command '{command}'\r\n".encode()
+
+    async def _serve(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                args = []
+                for _ in range(int(line[1:-2])):
+                    length = int((await reader.readline())[1:-2])
+                    args.append((await reader.readexactly(length + 2))[:-2].decode('utf-8'))
+                writer.write(self._execute(args[0].upper(), args[1:]))
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+
+def backend_from_env():
+    """State backend selected by STATE_BACKEND, or None when persistence is off"""
+    if STATE_BACKEND == 'redis':
+        return RedisBackend(STATE_REDIS_URL)
+    if STATE_BACKEND == 'memory':
+        return MemoryBackend()
+    if STATE_BACKEND == 'sqlite' and SESSION_DB_PATH:
+        return SQLiteBackend(SESSION_DB_PATH)
+    return None
+
+
+class SessionStore:
+    """Mirrors the per-chat state dicts into a state backend with lazy hydration and batched writes.
+
+    With several bot processes each chat must be served by one process (see sharding.py), so the
+    in-memory copy of a chat stays authoritative while the backend makes it survive restarts and moves.
+    """
+
+    def __init__(self, backend=None, flush_interval=SESSION_FLUSH_INTERVAL):
+        self.backend = backend_from_env() if backend is None else backend
+        self.flush_interval = flush_interval
+        self.tables = {}  # name -> {chat_id: value}
+        self.loaders = {}  # name -> callable that rebuilds a decoded value
+        self.mergers = {}  # name -> callable(chat_id, stored, current) combining both on hydration
+        self._hydrated = set()
+        self._dirty = set()
+        self._written = {}  # (chat_id, name) -> last encoded value in the backend
+        self._loading = {}  # chat_id -> task loading it, shared by concurrent hydrations
+        self._evicting = {}  # chat_id -> Event set once its eviction write is done
+        self._flush_lock = asyncio.Lock()
+        self._opened = False
+        self._flusher = None
+
+    @property
+    def enabled(self):
+        return self.backend is not None
+
+    def register(self, name, table, load=None, merge=merge_dicts):
+        """Registers a module-level dict keyed by chat_id; load rebuilds values from their JSON form,
+        merge combines a stored value with one written while the chat was not loaded"""
+        self.tables[name] = table
+        if load is not None:
+            self.loaders[name] = load
+        self.mergers[name] = merge
+        return table
+
+    async def hydrate(self, chat_id):
+        """Loads a chat's saved state on its first access in this process"""
+        if not self._opened or chat_id in self._hydrated:
+            return
+        loading = self._loading.get(chat_id)
+        if loading is None:
+            loading = self._loading[chat_id] = asyncio.ensure_future(self._load(chat_id))
+            loading.add_done_callback(lambda _: self._loading.pop(chat_id, None))
+        await asyncio.shield(loading)
+
+    async def _load(self, chat_id):
+        # An eviction still writing the chat would otherwise be read back half done
+        evicting = self._evicting.get(chat_id)
+        if evicting is not None:
+            await evicting.wait()
+            if chat_id in self._hydrated:  # the eviction failed and kept the chat
+                return
+        rows = await self.backend.load(chat_id)
+        for name, raw in rows:
+            table = self.tables.get(name)
+            if table is None:
+                continue
+            self._written[(chat_id, name)] = raw
+            value = decode_value(raw)
+            load = self.loaders.get(name)
+            value = load(value) if load else value
+            if chat_id in table:
+                # Written while the chat was out of memory (e.g. by a background task): keep both
+                value = self.mergers[name](chat_id, value, table[chat_id])
+                self._dirty.add(chat_id)
+            table[chat_id] = value
+        self._hydrated.add(chat_id)
+
+    def _snapshot(self, chat_ids):
+        """Copies of the chats' values next to what the backend holds, taken on the event loop"""
+        return [
+            (chat_id, name, _copy(table[chat_id]) if chat_id in table else _MISSING, self._written.get((chat_id, name)))
+            for chat_id in chat_ids for name, table in self.tables.items()
+        ]
+
+    async def evict(self, chat_id):
+        """Drops a chat from memory and writes what it held; it is hydrated again on next access.
+
+        The tables are emptied before the write, so nothing written to them while it runs is dropped
+        with them: such late values stay in memory and are merged on the next hydration.
+        """
+        self._dirty.discard(chat_id)
+        snapshot = self._snapshot([chat_id]) if self._opened else []
+        values = {name: table.pop(chat_id) for name, table in self.tables.items() if chat_id in table}
+        self._hydrated.discard(chat_id)
+        if not snapshot:
+            return
+        evicting = self._evicting[chat_id] = asyncio.Event()
+        try:
+            async with self._flush_lock:
+                await self._write(snapshot, retry=False)
+        except Exception:
+            # Keep the chat resident; retried by the next flush
+            for name, value in values.items():
+                table = self.tables[name]
+                table[chat_id] = self.mergers[name](chat_id, value, table[chat_id]) if chat_id in table else value
+            self._hydrated.add(chat_id)
+            self._dirty.add(chat_id)
+            raise
+        else:
+            for name in self.tables:
+                self._written.pop((chat_id, name), None)
+        finally:
+            del self._evicting[chat_id]
+            evicting.set()
+
+    def mark_dirty(self, chat_id):
+        """Schedules the chat for the next batched write"""
+        if self.enabled:
+            self._dirty.add(chat_id)
+
+    async def _write(self, snapshot, retry=True):
+        """Encodes a snapshot in a worker thread and writes the rows that differ from the backend"""
+        rows = await asyncio.to_thread(_encode_rows, snapshot)
+        if not rows:
+            return
+        for chat_id, name, raw in rows:
+            if raw is None:
+                self._written.pop((chat_id, name), None)
+            else:
+                self._written[(chat_id, name)] = raw
+        try:
+            await self.backend.write(rows)
+        except Exception:
+            # Retry these chats on the next flush (an eviction handles its own failure)
+            for chat_id, name, raw in rows:
+                self._written.pop((chat_id, name), None)
+                if retry:
+                    self._dirty.add(chat_id)
+            raise
+
+    async def flush(self):
+        """Writes all pending changes in one batch; only copying the values happens on the event loop"""
+        if not self._opened:
+            return
+        # One flush at a time, so an older snapshot can never be written after a newer one
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, set()
+            if dirty:
+                await self._write(self._snapshot(dirty))
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.exception("Session flush failed: %s", e)
+
+    async def start(self):
+        """Opens the backend and starts the background writer"""
+        if not self.enabled:
+            return
+        if not self._opened:
+            await self.backend.open()
+            self._opened = True
+        self._flusher = asyncio.create_task(self._flush_loop())
+
+    async def close(self):
+        """Stops the writer and flushes what is left"""
+        if self._flusher is not None:
+            self._flusher.cancel()
+            self._flusher = None
+        if not self._opened:
+            return
+        try:
+            await self.flush()
+        except Exception as e:
+            logger.exception("Final session flush failed: %s", e)
+        await self.backend.close()
+        self._opened = False
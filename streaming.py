@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import asyncio
+import logging
+from telegram.error import BadRequest, RetryAfter
+
+logger = logging.getLogger(__name__)
+
+# Streaming replies are opt-in per deployment
+STREAM_REPLIES = os.getenv('STREAM_REPLIES', '0').lower() in ('1', 'true', 'yes', 'on')
+# Minimum seconds between two edits of the same message (Telegram allows about one edit per second per chat)
+STREAM_EDIT_INTERVAL = float(os.getenv('STREAM_EDIT_INTERVAL', '1.5'))
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+CURSOR = " ▌"
+
+
+async def iter_sse_json(response):
+    """Yields the JSON payloads of a server-sent events response until [DONE]"""
+    async for line in response.aiter_lines():
+        if not line.startswith("data:"):
+            continue
+        data = line[5:].strip()
+        if not data:
+            continue
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+
+
+class StreamingReply:
+    """Pushes partial text into one Telegram message using throttled edit_text calls.
+
+    With an outbox, the first message and every edit go through it, so all streams of a chat share
+    its per-chat and global pacing; `interval` only limits how often this one message is edited.
+    """
+
+    def __init__(self, reply_to, prefix="", interval=STREAM_EDIT_INTERVAL, outbox=None):
+        self.reply_to = reply_to
+        self.prefix = prefix
+        self.interval = interval
+        self.outbox = outbox  # SendQueue for the message and its edits, optional
+        self.message = None
+        self._text = ""
+        self._shown = None
+        self._next_edit = 0.0
+        self._pending = None
+
+    def _render(self, text, cursor=True):
+        rendered = f"{self.prefix}{text}{CURSOR if cursor else ''}"
+        if len(rendered) > TELEGRAM_MESSAGE_LIMIT:
+            rendered = rendered[:TELEGRAM_MESSAGE_LIMIT - 1] + "…"
+        return rendered
+
+    async def _send(self, text):
+        if self.outbox is None:
+            return await self.reply_to.reply_text(text)
+        # The message is edited later, so it must not be merged with others
+        return await self.outbox.reply(self.reply_to, text, coalesce=False)
+
+    async def _edit(self, text):
+        if self.outbox is None:
+            return await self.message.edit_text(text)
+        return await self.outbox.edit(self.message, text)
+
+    async def _push(self, rendered):
+        """Sends or edits the message; honours flood-wait and skips no-op edits"""
+        if rendered == self._shown:
+            return
+        try:
+            if self.message is None:
+                self.message = await self._send(rendered)
+            else:
+                await self._edit(rendered)
+            self._shown = rendered
+            self._next_edit = time.monotonic() + self.interval
+        except RetryAfter as e:
+            # The outbox already waited out its retries; this partial text is skipped, the next one still goes out
+            logger.warning("Streaming edit skipped, flood control for %ss", e.retry_after)
+            self._next_edit = time.monotonic() + float(e.retry_after)
+        except BadRequest as e:
+            if "not modified" not in str(e).lower():
+                raise
+
+    async def _flush(self):
+        await self._push(self._render(self._text))
+
+    def update(self, text):
+        """Records the latest partial text; an edit is scheduled only when the throttle allows it"""
+        self._text = text
+        if not text.strip():
+            return
+        if self._pending is not None and not self._pending.done():
+            return
+        if time.monotonic() < self._next_edit:
+            return
+        self._pending = asyncio.create_task(self._flush())
+
+    def cancel(self):
+        """Drops a scheduled edit that has not gone out yet, e.g. when the discussion was stopped"""
+        if self._pending is not None:
+            self._pending.cancel()
+
+    async def finish(self, text):
+        """Shows the final text; overflow beyond the Telegram limit is sent as extra messages"""
+        if self._pending is not None:
+            try:
+                await self._pending
+            except Exception as e:
+                logger.warning("Streaming edit failed: %s", e)
+        delay = self._next_edit - time.monotonic()
+        if self.message is not None and delay > 0:
+            await asyncio.sleep(delay)
+
+        full_text = f"{self.prefix}{text}"
+        chunks = [full_text[i:i + TELEGRAM_MESSAGE_LIMIT] for i in range(0, len(full_text), TELEGRAM_MESSAGE_LIMIT)] or [""]
+        if self.message is None:
+            self.message = await self._send(chunks[0])
+        elif chunks[0] != self._shown:
+            try:
+                await self._edit(chunks[0])
+            except RetryAfter as e:
+                await asyncio.sleep(float(e.retry_after))
+                await self._edit(chunks[0])
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    raise
+        self._shown = chunks[0]
+        for chunk in chunks[1:]:
+            await self._send(chunk)
+        return self.message
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep bot.py from opening the SQLite session file or other real state at import
+os.environ.setdefault('STATE_BACKEND', 'memory')
+os.environ.setdefault('SESSION_DB_PATH', '')
+
+
+@pytest.fixture(autouse=True)
+def fresh_outbox(monkeypatch):
+    """The bot's outbox holds an asyncio.Lock bound to the first loop it ran on; each test runs its own loop"""
+    if 'bot' in sys.modules:
+        from outbox import SendQueue
+        monkeypatch.setattr(sys.modules['bot'], 'outbox', SendQueue(chat_interval=0.0, global_rate=0))
@@ -0,0 +1,176 @@
+import asyncio
+
+from backends import BackendError, BackendRouter, FakeBackend
+from metrics import Metrics, error_kind
+
+
+def make_router():
+    router = BackendRouter(routes={'CTO': ['anthropic', 'openai']}, hedging=False)
+    router.register(FakeBackend('anthropic'))
+    router.register(FakeBackend('openai'))
+    return router
+
+
+def test_untried_fallback_does_not_overtake_a_slow_healthy_primary():
+    router = make_router()
+    router.stats['anthropic'].record_success(4.0)
+    assert router.candidates('CTO') == ['anthropic', 'openai']
+
+
+def test_primary_keeps_route_unless_much_slower_than_a_measured_fallback():
+    router = make_router()
+    for _ in range(10):
+        router.stats['anthropic'].record_success(6.0)
+        router.stats['openai'].record_success(3.0)
+    assert router.candidates('CTO') == ['anthropic', 'openai']
+
+    for _ in range(10):
+        router.stats['anthropic'].record_success(20.0)
+    assert router.candidates('CTO') == ['openai', 'anthropic']
+
+
+def test_failing_primary_yields_to_fallback():
+    router = make_router()
+    router.stats['anthropic'].record_failure(1.0)
+    assert router.candidates('CTO') == ['anthropic', 'openai']
+    router.stats['anthropic'].record_failure(1.0)
+    assert router.candidates('CTO') == ['openai', 'anthropic']
+
+
+def test_route_is_stable_across_ordinary_replies():
+    router = BackendRouter(routes={'CTO': ['anthropic', 'openai']}, hedging=False)
+    router.register(FakeBackend('anthropic', latency=0.05))
+    router.register(FakeBackend('openai', latency=0.01))
+
+    async def run():
+        for _ in range(5):
+            await router.complete('CTO', 'system', [], 'question')
+
+    asyncio.run(run())
+    assert router.stats['anthropic'].calls == 5
+    assert router.stats['openai'].calls == 0
+
+
+def anthropic_request(system_prompt):
+    """The system blocks AnthropicBackend sends for a prompt"""
+    from types import SimpleNamespace
+    from backends import AnthropicBackend
+
+    sent = {}
+
+    async def create(**request):
+        sent.update(request)
+        return SimpleNamespace(content=[SimpleNamespace(text='ok')], usage={})
+
+    providers = SimpleNamespace(anthropic=SimpleNamespace(messages=SimpleNamespace(create=create)))
+    asyncio.run(AnthropicBackend(providers).complete(system_prompt, [], 'question', context='team'))
+    return sent['system']
+
+
+def test_cache_breakpoint_only_for_prompts_long_enough_to_cache():
+    from backends import CACHE_MIN_PREFIX_TOKENS
+
+    short = anthropic_request("You are the CTO.")
+    assert 'cache_control' not in short[0]
+    assert short[1] == {'type': 'text', 'text': 'team'}
+
+    long = anthropic_request("x" * (CACHE_MIN_PREFIX_TOKENS * 3 + 3))
+    assert long[0]['cache_control'] == {'type': 'ephemeral'}
+
+
+def test_timeouts_are_classified_as_timeouts():
+    router = BackendRouter(routes={'CTO': ['anthropic']}, hedging=False, attempt_timeout=0.05, metrics=Metrics())
+    router.register(FakeBackend('anthropic', latency=1.0))
+
+    async def run():
+        try:
+            await router.complete('CTO', 'system', [], 'prompt')
+        except Exception as e:
+            return e
+
+    error = asyncio.run(run())
+    assert isinstance(error, BackendError) and str(error) == 'anthropic: TimeoutError'
+    assert error_kind(error) == 'timeout'
+    assert router.metrics.counter('provider_errors_total', provider='anthropic', kind='timeout') == 1
+
+
+def test_scheduler_error_before_the_call_is_not_masked():
+    class BrokenScheduler:
+        async def run(self, name, call, tokens=0):
+            raise RuntimeError('limiter bug')
+
+    router = BackendRouter(routes={'CTO': ['anthropic']}, hedging=False, scheduler=BrokenScheduler())
+    router.register(FakeBackend('anthropic'))
+
+    async def run():
+        try:
+            await router.complete('CTO', 'system', [], 'prompt')
+        except Exception as e:
+            return e
+
+    error = asyncio.run(run())
+    assert isinstance(error, RuntimeError) and str(error) == 'limiter bug'
+    assert router.stats['anthropic'].failures == 0
+
+
+class TrackedBackend(FakeBackend):
+    """FakeBackend that remembers whether its call was cancelled"""
+
+    cancelled = False
+
+    async def complete(self, *args, **kwargs):
+        try:
+            return await super().complete(*args, **kwargs)
+        except asyncio.CancelledError:
+            self.cancelled = True
+            raise
+
+
+def hedged_router(primary, fallback, delay=0.1):
+    router = BackendRouter(routes={'CTO': ['anthropic', 'openai']}, hedging=True)
+    router.register(primary)
+    router.register(fallback)
+    router.hedge_delay = lambda name: delay
+    return router
+
+
+def hedged_call(router, on_delta=None):
+    async def run():
+        try:
+            return await router.complete('CTO', 'system', [], 'prompt', on_delta=on_delta)
+        except Exception as e:
+            return e
+    return asyncio.run(run())
+
+
+def test_primary_answering_before_the_hedge_delay_is_not_hedged():
+    primary, fallback = TrackedBackend('anthropic', latency=0.02, reply='primary'), TrackedBackend('openai', reply='fallback')
+    router = hedged_router(primary, fallback)
+    assert hedged_call(router) == 'primary'
+    assert fallback.calls == 0 and router.hedge_stats['hedged'] == 0
+
+
+def test_hedge_wins_and_the_slow_primary_is_cancelled():
+    primary, fallback = TrackedBackend('anthropic', latency=1.0, reply='primary'), TrackedBackend('openai', latency=0.02, reply='fallback')
+    router = hedged_router(primary, fallback)
+    assert hedged_call(router) == 'fallback'
+    assert primary.cancelled and not fallback.cancelled
+    assert router.hedge_stats['hedged'] == 1 and router.hedge_stats['hedge_wins'] == 1
+
+
+def test_primary_failing_before_the_hedge_delay_launches_the_next_backend():
+    primary, fallback = TrackedBackend('anthropic', latency=0.02, error_rate=1.0), TrackedBackend('openai', latency=0.02, reply='fallback')
+    router = hedged_router(primary, fallback, delay=1.0)
+    assert hedged_call(router) == 'fallback'
+    assert fallback.calls == 1 and router.hedge_stats['hedged'] == 0
+
+
+def test_no_hedge_once_the_primary_is_streaming():
+    deltas = []
+    # First chunk after 0.05s, the whole answer after 0.25s: well past the hedge delay
+    primary = TrackedBackend('anthropic', latency=0.25, reply='streamed primary answer', chunks=5)
+    fallback = TrackedBackend('openai', latency=0.01, reply='fallback')
+    router = hedged_router(primary, fallback)
+    assert hedged_call(router, on_delta=deltas.append) == 'streamed primary answer'
+    assert fallback.calls == 0 and router.hedge_stats['hedged'] == 0
+    assert deltas[-1] == 'streamed primary answer'
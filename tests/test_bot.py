@@ -0,0 +1,108 @@
+import asyncio
+from types import SimpleNamespace
+
+import bot
+from benchmark import FakeTelegram, fake_update
+
+
+def run_command(handler, chat_id, text, args=()):
+    update = fake_update(FakeTelegram(0), 1, chat_id, text)
+    asyncio.run(handler(update, SimpleNamespace(args=list(args), bot=None)))
+
+
+def test_stop_leaves_news_mode():
+    chat_id = 424242
+    run_command(bot.news_command, chat_id, "/news")
+    assert chat_id in bot.news_handler.news_mode_chats
+
+    run_command(bot.stop, chat_id, "/stop")
+    assert chat_id not in bot.news_handler.news_mode_chats
+    assert chat_id not in bot.chat_states
+
+
+def delayed_anthropic(delay, events):
+    """ProviderClients whose Anthropic client talks to a mock API that answers after `delay` seconds"""
+    import httpx
+    from anthropic import AsyncAnthropic
+    from providers import ProviderClients
+
+    async def handler(request):
+        await asyncio.sleep(delay)
+        events.append(('anthropic answered', asyncio.get_running_loop().time()))
+        return httpx.Response(200, json={
+            'id': 'msg_test', 'type': 'message', 'role': 'assistant', 'model': 'claude-test',
+            'content': [{'type': 'text', 'text': 'CTO answer'}],
+            'stop_reason': 'end_turn', 'stop_sequence': None,
+            'usage': {'input_tokens': 10, 'output_tokens': 2},
+        })
+
+    providers = ProviderClients(anthropic_api_key='test')
+    providers._anthropic_http = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    providers._anthropic = AsyncAnthropic(api_key='test', http_client=providers._anthropic_http, max_retries=0)
+    return providers
+
+
+def test_slow_cto_call_does_not_block_other_chats(monkeypatch):
+    from backends import AnthropicBackend, BackendRouter, FakeBackend
+
+    events = []
+    router = BackendRouter(routes={'CTO': ['anthropic']}, default_route=['openai'], hedging=False)
+    router.register(AnthropicBackend(delayed_anthropic(0.5, events)))
+    router.register(FakeBackend('openai', latency=0.01))
+    monkeypatch.setattr(bot, 'router', router)
+
+    cto_chat, ceo_chat = 515151, 525252
+    monkeypatch.setitem(bot.current_dialogs, cto_chat, 'CTO')
+    telegram = FakeTelegram(0)
+    replies = {}
+
+    async def ask(chat_id, delay=0.0):
+        await asyncio.sleep(delay)
+        update = fake_update(telegram, chat_id, chat_id, "How do we scale?")
+        await bot.message_handler(update, SimpleNamespace(args=[], bot=None))
+        events.append((f"chat {chat_id} answered", asyncio.get_running_loop().time()))
+        replies[chat_id] = bot.dialog_histories[chat_id][bot.current_dialogs.get(chat_id, 'CEO')][-1]['assistant']
+
+    async def run():
+        await asyncio.gather(ask(cto_chat), ask(ceo_chat, delay=0.05))
+
+    try:
+        asyncio.run(run())
+    finally:
+        for chat_id in (cto_chat, ceo_chat):
+            bot.dialog_histories.pop(chat_id, None)
+            bot.search_indexes.pop(chat_id, None)
+
+    order = [name for name, _ in sorted(events, key=lambda event: event[1])]
+    assert replies[cto_chat] == 'CTO answer'
+    assert order.index(f"chat {ceo_chat} answered") < order.index('anthropic answered')
+
+
+def test_stopped_streaming_reply_sends_nothing(monkeypatch):
+    sent = []
+
+    class Chat:
+        chat_id = 535353
+
+        async def reply_text(self, text, **kwargs):
+            sent.append(text)
+            return self
+
+        async def edit_text(self, text, **kwargs):
+            sent.append(text)
+            return self
+
+    async def streamed_response(prompt, personality, *args, on_delta=None, **kwargs):
+        on_delta("partial answer")
+        return "full answer"
+
+    monkeypatch.setattr(bot, 'STREAM_REPLIES', True)
+    monkeypatch.setattr(bot, 'get_chatgpt_response', streamed_response)
+
+    async def run():
+        response = await bot.respond(Chat(), 'CTO', 'topic', 'en', is_active=lambda: False)
+        await asyncio.sleep(0.05)
+        return response
+
+    assert asyncio.run(run()) == "full answer"
+    assert sent == []
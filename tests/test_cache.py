@@ -0,0 +1,30 @@
+import time
+import asyncio
+
+from cache import AnalysisCache
+
+
+def rows(cache):
+    return cache._db.execute("SELECT key FROM analyses ORDER BY stored_at").fetchall()
+
+
+def test_sqlite_rows_are_capped(tmp_path):
+    cache = AnalysisCache(ttl=60, max_size=2, path=str(tmp_path / 'cache.db'), max_rows=3)
+
+    async def fill():
+        for i in range(5):
+            await cache.set(f"k{i}", f"v{i}")
+
+    asyncio.run(fill())
+    assert rows(cache) == [('k2',), ('k3',), ('k4',)]
+    cache.close()
+
+
+def test_expired_sqlite_rows_are_pruned_on_write(tmp_path):
+    path = str(tmp_path / 'cache.db')
+    cache = AnalysisCache(ttl=60, path=path)
+    cache._db.execute("INSERT INTO analyses VALUES ('old', 'stale', ?)", (time.time() - 120,))
+    assert rows(cache) == [('old',)]
+    asyncio.run(cache.set('new', 'fresh'))
+    assert rows(cache) == [('new',)]
+    cache.close()
@@ -0,0 +1,43 @@
+import re
+import asyncio
+from types import SimpleNamespace
+
+import pytest
+
+import bot
+from backends import BackendRouter, FakeBackend
+from benchmark import FakeTelegram, fake_update
+from discussions import DISCUSSION_PANEL, DISCUSSION_SEQUENTIAL
+
+MARKER = re.compile(r'#(\d+)#')
+
+
+@pytest.mark.parametrize('mode', [DISCUSSION_SEQUENTIAL, DISCUSSION_PANEL])
+def test_concurrent_discussions_stay_in_their_own_chat(monkeypatch, mode):
+    router = BackendRouter(routes={}, default_route=['fake'], hedging=False)
+    # Jitter makes the chats' replies interleave
+    router.register(FakeBackend('fake', latency=0.02, jitter=0.02))
+    monkeypatch.setattr(bot, 'router', router)
+    telegram = FakeTelegram(0)
+    chats = list(range(700000, 700020))
+
+    async def discuss(chat_id):
+        bot.discussion_modes[chat_id] = mode
+        update = fake_update(telegram, chat_id, chat_id, f"Market outlook #{chat_id}#")
+        await bot.process_chat(update, SimpleNamespace(args=[], bot=None), update.message.text)
+        await bot.chat_tasks[chat_id]
+
+    async def run():
+        await asyncio.gather(*(discuss(chat_id) for chat_id in chats))
+
+    try:
+        asyncio.run(run())
+        for chat_id in chats:
+            transcript = bot.discussions[chat_id].transcript
+            assert transcript
+            for message in transcript:
+                assert {int(marker) for marker in MARKER.findall(message['response'])} == {chat_id}
+    finally:
+        for chat_id in chats:
+            for table in (bot.discussions, bot.chat_tasks, bot.discussion_modes, bot.dialog_histories):
+                table.pop(chat_id, None)
@@ -0,0 +1,31 @@
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from history import load_histories, local_time, time_range, timestamp
+
+
+@pytest.fixture
+def berlin(monkeypatch):
+    monkeypatch.setenv('TZ', 'Europe/Berlin')
+    time.tzset()
+    yield
+    monkeypatch.undo()
+    time.tzset()
+
+
+def test_timestamps_stay_ordered_across_the_dst_change(berlin):
+    # 2025-10-26 03:00 CEST -> 02:00 CET: local wall time repeats 02:00-03:00
+    start = datetime(2025, 10, 26, 0, 0, tzinfo=timezone.utc)
+    history = [{'user': str(i), 'assistant': '', 'date': timestamp(start + timedelta(minutes=20 * i))} for i in range(6)]
+    assert [entry['date'] for entry in history] == sorted(entry['date'] for entry in history)
+    assert [local_time(entry['date'])[11:16] for entry in history] == ['02:00', '02:20', '02:40', '02:00', '02:20', '02:40']
+    # Local 02:30 before the switch is 00:30 UTC
+    window = time_range(history, timestamp(datetime(2025, 10, 26, 2, 30, fold=0)), timestamp(start + timedelta(hours=1)))
+    assert [entry['user'] for entry in window] == ['2', '3']
+
+
+def test_naive_local_timestamps_are_converted_on_load(berlin):
+    roles = load_histories({'CTO': [{'user': 'u', 'assistant': 'a', 'date': '2025-07-01T12:00:00'}, {'user': 'u', 'assistant': 'a'}]})
+    assert [entry.get('date') for entry in roles['CTO']] == ['2025-07-01T10:00:00+00:00', None]
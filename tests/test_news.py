@@ -0,0 +1,61 @@
+import json
+import asyncio
+from types import SimpleNamespace
+
+from cache import AnalysisCache
+from news import ANALYSIS_MODE_COMBINED, NewsHandler
+
+
+class FakeOpenAI:
+    """chat.completions.create stand-in: the combined request gets `combined`, per-desk ones a fixed answer"""
+
+    def __init__(self, combined):
+        self.combined = combined
+        self.requests = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self.create))
+
+    async def create(self, **kwargs):
+        combined = 'response_format' in kwargs
+        self.requests.append('combined' if combined else 'desk')
+        content = self.combined if combined else "✅ Buy: SPY"
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def analyze(combined):
+    client = FakeOpenAI(combined)
+    handler = NewsHandler(openai_client=client, mode=ANALYSIS_MODE_COMBINED, cache=AnalysisCache(path=None))
+    return asyncio.run(handler.analyze("Fed cuts rates")), client.requests
+
+
+def test_combined_answer_is_split_per_desk():
+    answer = {
+        'indices': {'buy': 'SPY, QQQ', 'sell': '', 'hedge': 'VIX'},
+        'commodities': {'buy': ['GLD', 'SLV'], 'sell': '', 'hedge': ''},
+        'forex': {'buy': '', 'sell': 'USD/JPY', 'hedge': ''},
+        'stocks': {'buy': '', 'sell': '', 'hedge': ''},
+        'crypto': {'buy': 'BTC', 'sell': '', 'hedge': ''},
+    }
+    results, requests = analyze(json.dumps(answer))
+    assert requests == ['combined']
+    assert results['indices'] == ("✅ Buy: SPY, QQQ\n🛡 Hedge: VIX", False)
+    assert results['commodities'] == ("✅ Buy: GLD, SLV", False)
+    assert results['forex'] == ("❌ Sell: USD/JPY", False)
+    assert results['stocks'] == ("", False)
+
+
+def test_malformed_answer_falls_back_to_per_desk_requests():
+    results, requests = analyze("Sure! Here is the analysis: {not json")
+    assert requests == ['combined'] + ['desk'] * 5
+    assert all(result == ("✅ Buy: SPY", False) for result in results.values())
+
+
+def test_missing_desk_counts_as_not_affected():
+    results, requests = analyze(json.dumps({'indices': {'buy': 'SPY', 'sell': '', 'hedge': ''}}))
+    assert requests == ['combined']
+    assert results['indices'] == ("✅ Buy: SPY", False)
+    assert results['crypto'] == ("", False)
+
+
+def test_non_object_desk_falls_back_to_per_desk_requests():
+    results, requests = analyze(json.dumps({'indices': "buy SPY"}))
+    assert requests == ['combined'] + ['desk'] * 5
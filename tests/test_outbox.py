@@ -0,0 +1,68 @@
+import time
+import asyncio
+
+from outbox import SendQueue
+from streaming import StreamingReply
+
+
+class FakeChat:
+    """Telegram message stand-in that records when each send or edit reached the API"""
+
+    def __init__(self, chat_id=1, calls=None):
+        self.chat_id = chat_id
+        self.calls = [] if calls is None else calls
+
+    async def reply_text(self, text, **kwargs):
+        self.calls.append(('send', text, time.monotonic()))
+        return FakeChat(self.chat_id, self.calls)
+
+    async def edit_text(self, text, **kwargs):
+        self.calls.append(('edit', text, time.monotonic()))
+        return self
+
+
+def gaps(calls):
+    times = [at for _, _, at in calls]
+    return [later - earlier for earlier, later in zip(times, times[1:])]
+
+
+def test_streaming_edits_share_the_chat_pacing():
+    chat = FakeChat()
+
+    async def run():
+        outbox = SendQueue(chat_interval=0.1, global_rate=0)
+        reply = StreamingReply(chat, interval=0.0, outbox=outbox)
+        text = ''
+        for word in range(20):
+            text += f"{word} "
+            reply.update(text)
+            await asyncio.sleep(0.02)
+        await reply.finish(text)
+
+    asyncio.run(run())
+    assert [kind for kind, _, _ in chat.calls].count('send') == 1
+    assert len(chat.calls) > 2
+    assert min(gaps(chat.calls)) >= 0.09
+    assert chat.calls[-1][1] == ' '.join(str(word) for word in range(20)) + ' '
+
+
+def test_panel_streams_share_one_chat_budget():
+    chat = FakeChat()
+
+    async def stream(outbox, role):
+        reply = StreamingReply(chat, prefix=f"{role}: ", interval=0.05, outbox=outbox)
+        text = ''
+        for word in range(15):
+            text += f"{word} "
+            reply.update(text)
+            await asyncio.sleep(0.02)
+        await reply.finish(text)
+
+    async def run():
+        outbox = SendQueue(chat_interval=0.05, global_rate=0)
+        # Each stream would edit its own message every 0.05s on its own; four of them must not add up
+        await asyncio.gather(*[stream(outbox, role) for role in ('CEO', 'CTO', 'CFO', 'CMO')])
+
+    asyncio.run(run())
+    assert min(gaps(chat.calls)) >= 0.045
+    assert [kind for kind, _, _ in chat.calls].count('send') == 4
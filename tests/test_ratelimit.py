@@ -0,0 +1,97 @@
+import time
+import asyncio
+
+import pytest
+
+from ratelimit import ProviderLimiter, QueueFull, RateLimited, RequestScheduler, TokenBucket
+
+
+def test_token_bucket_refills_at_its_rate():
+    bucket = TokenBucket(60)
+    assert bucket.wait_time(60) == 0.0
+    bucket.take(60)
+    assert bucket.wait_time(1) == pytest.approx(1.0, abs=0.05)
+    # Requests larger than a minute's budget wait for a full bucket rather than forever
+    assert bucket.wait_time(1000) == pytest.approx(60.0, abs=0.1)
+    assert TokenBucket(0).wait_time(10 ** 6) == 0.0
+
+
+def test_waiting_requests_are_served_in_arrival_order():
+    order = []
+
+    async def request(limiter, name, tokens):
+        await limiter.acquire(tokens)
+        order.append(name)
+
+    async def run():
+        limiter = ProviderLimiter(rpm=0, tpm=60000)
+        limiter.tokens.level = 0
+        # The first request needs 0.2s worth of tokens; the small ones behind it must not overtake it
+        await asyncio.gather(request(limiter, 'big', 200), request(limiter, 'small1', 1), request(limiter, 'small2', 1))
+
+    asyncio.run(run())
+    assert order == ['big', 'small1', 'small2']
+
+
+def test_full_queue_fails_fast():
+    async def run():
+        limiter = ProviderLimiter(max_queue=1)
+        limiter.pause(0.2)
+        first = asyncio.create_task(limiter.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(QueueFull):
+            await limiter.acquire()
+        await first
+        return limiter
+
+    limiter = asyncio.run(run())
+    assert limiter.rejected == 1 and limiter.waiting == 0
+
+
+def test_429_pauses_the_provider_and_retries():
+    calls = []
+
+    async def call():
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            raise RateLimited("HTTP 429", retry_after=0.1)
+        return 'ok'
+
+    scheduler = RequestScheduler(limits={'openai': {'rpm': 0, 'tpm': 0}}, retries=2)
+    assert asyncio.run(scheduler.run('openai', call)) == 'ok'
+    assert calls[1] - calls[0] >= 0.09
+    assert scheduler.report()['openai']['throttled'] == 1
+
+
+def test_429_retries_are_bounded():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise RateLimited("HTTP 429", retry_after=0.0)
+
+    scheduler = RequestScheduler(limits={'openai': {'rpm': 0, 'tpm': 0}}, retries=1)
+    with pytest.raises(RateLimited):
+        asyncio.run(scheduler.run('openai', call))
+    assert len(calls) == 2
+
+
+def test_other_errors_are_not_retried():
+    calls = []
+
+    async def call():
+        calls.append(1)
+        raise ValueError("bad request")
+
+    scheduler = RequestScheduler(limits={'openai': {'rpm': 0, 'tpm': 0}})
+    with pytest.raises(ValueError):
+        asyncio.run(scheduler.run('openai', call))
+    assert len(calls) == 1
+
+
+def test_sdk_clients_leave_retries_to_the_scheduler():
+    from providers import ProviderClients
+
+    providers = ProviderClients(openai_api_key='test', anthropic_api_key='test')
+    assert providers.openai.max_retries == 0
+    assert providers.anthropic.max_retries == 0
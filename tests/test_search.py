@@ -0,0 +1,50 @@
+from search import ChatIndex
+
+
+def entry(user, assistant=''):
+    return {'user': user, 'assistant': assistant}
+
+
+def users(results):
+    return [found['user'] for _, found in results]
+
+
+def test_entries_matching_more_words_rank_first_then_by_bm25():
+    index = ChatIndex()
+    index.add('CTO', entry('cloud costs', 'we should cut cloud spend'))
+    index.add('CFO', entry('budget review', 'costs are fine, cloud is a small line in a long budget review'))
+    index.add('CMO', entry('brand campaign', 'new campaign'))
+    index.add('CEO', entry('hiring plan', 'costs of hiring'))
+
+    results = index.search('cloud costs')
+    # Both words beat one word; among two-word matches the shorter, denser entry wins
+    assert users(results) == ['cloud costs', 'budget review', 'hiring plan']
+    assert results[0][0] == 'CTO'
+    assert index.count('cloud costs') == 3
+    assert users(index.search('cloud costs', limit=1)) == ['cloud costs']
+
+
+def test_equal_scores_prefer_the_newest_entry():
+    index = ChatIndex()
+    index.add('CTO', entry('deploy friday'))
+    index.add('CTO', entry('deploy monday'))
+    assert users(index.search('deploy')) == ['deploy monday', 'deploy friday']
+
+
+def test_evicted_entries_leave_the_postings():
+    index = ChatIndex(capacity=2)
+    index.add('CTO', entry('kubernetes migration'))
+    index.add('CTO', entry('database backup'))
+    index.add('CFO', entry('kubernetes invoice'))
+    index.add('CTO', entry('latency budget'))
+
+    # The oldest CTO entry is gone; the CFO entry with the same word stays
+    assert users(index.search('kubernetes')) == ['kubernetes invoice']
+    assert 'migration' not in index.postings
+    assert set(index.postings['kubernetes']) == {2}
+    assert len(index.docs) == 3
+    assert index.total_length == sum(length for _, _, length in index.docs.values())
+
+    index.reset('CFO')
+    assert 'kubernetes' not in index.postings and 'invoice' not in index.postings
+    assert users(index.search('kubernetes')) == []
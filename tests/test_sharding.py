@@ -0,0 +1,124 @@
+import time
+import asyncio
+from types import SimpleNamespace
+
+from sharding import ChatOrderedProcessor
+
+
+def update(chat_id):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id))
+
+
+def test_updates_of_one_chat_run_in_order_and_other_chats_run_alongside():
+    log = []
+
+    async def handle(name, delay):
+        log.append(f"start {name}")
+        await asyncio.sleep(delay)
+        log.append(f"end {name}")
+
+    async def run():
+        processor = ChatOrderedProcessor(16)
+        await asyncio.gather(
+            processor.process_update(update(1), handle('a1', 0.05)),
+            processor.process_update(update(1), handle('a2', 0.0)),
+            processor.process_update(update(2), handle('b1', 0.0)),
+        )
+        await processor.join()
+        return processor
+
+    processor = asyncio.run(run())
+    assert log.index('end a1') < log.index('start a2')
+    assert log.index('end b1') < log.index('end a1')
+    assert not processor._chats
+
+
+def test_busy_chat_does_not_take_the_slots_of_other_chats():
+    finished = {}
+
+    async def handle(name, delay, started):
+        await asyncio.sleep(delay)
+        finished[name] = time.monotonic() - started
+
+    async def run():
+        processor = ChatOrderedProcessor(4)
+        started = time.monotonic()
+        # More queued updates of one chat than there are slots; PTB runs each process_update as a task
+        tasks = [asyncio.create_task(processor.process_update(update(1), handle(f"a{i}", 0.2, started))) for i in range(6)]
+        await asyncio.sleep(0)
+        tasks.append(asyncio.create_task(processor.process_update(update(2), handle('b', 0.0, started))))
+        await asyncio.gather(*tasks)
+        await processor.join()
+
+    asyncio.run(run())
+    assert finished['b'] < 0.1
+    assert [name for name in sorted(finished, key=finished.get) if name != 'b'] == [f"a{i}" for i in range(6)]
+
+
+def forwarder_with(statuses, **kwargs):
+    """ShardForwarder whose second shard answers with the given status codes in turn"""
+    from sharding import ShardForwarder
+    import httpx
+
+    seen = []
+
+    def handler(request):
+        seen.append(request.read())
+        return httpx.Response(statuses[min(len(seen), len(statuses)) - 1])
+
+    forwarder = ShardForwarder(urls=['http://a/hook', 'http://b/hook'], index=0, **kwargs)
+    forwarder._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return forwarder, seen
+
+
+def remote_update(forwarder, update_id):
+    from sharding import shard_for
+    chat_id = next(chat for chat in range(1000) if shard_for(chat, 2) == 1)
+    return {'update_id': update_id, 'message': {'chat': {'id': chat_id}}}
+
+
+async def drain(forwarder, updates):
+    """Waits until every update was forwarded or dropped"""
+    while forwarder.stats['forwarded'] + forwarder.stats['dropped'] < updates:
+        await asyncio.sleep(0.01)
+    await forwarder.close()
+
+
+def test_rejected_update_is_dropped_without_blocking_the_shard():
+    async def run():
+        forwarder, seen = forwarder_with([403, 200])
+        await forwarder.forward(remote_update(forwarder, 1))
+        await forwarder.forward(remote_update(forwarder, 2))
+        await drain(forwarder, 2)
+        return forwarder, seen
+
+    forwarder, seen = asyncio.run(run())
+    assert len(seen) == 2
+    assert forwarder.stats['dropped'] == 1
+    assert forwarder.stats['forwarded'] == 1
+
+
+def test_server_errors_are_retried_a_limited_number_of_times():
+    async def run():
+        forwarder, seen = forwarder_with([503, 503, 200], attempts=2)
+        await forwarder.forward(remote_update(forwarder, 1))
+        await drain(forwarder, 1)
+        return forwarder, seen
+
+    forwarder, seen = asyncio.run(run())
+    assert len(seen) == 2
+    assert forwarder.stats['dropped'] == 1
+    assert forwarder.stats['forwarded'] == 0
+
+
+def test_full_shard_queue_drops_new_updates():
+    async def run():
+        forwarder, _ = forwarder_with([200], queue_size=1)
+        # The worker has not run yet, so the second update finds the queue full
+        await forwarder.forward(remote_update(forwarder, 1))
+        await forwarder.forward(remote_update(forwarder, 2))
+        dropped = forwarder.stats['dropped']
+        await drain(forwarder, 2)
+        return dropped
+
+    assert asyncio.run(run()) == 1
@@ -0,0 +1,97 @@
+import asyncio
+import threading
+
+import storage
+from history import load_histories, merge_histories, new_history
+from storage import MemoryBackend, SessionStore
+
+
+class SlowBackend(MemoryBackend):
+    """Memory backend whose writes take a while, leaving room for other tasks"""
+
+    def __init__(self, delay=0.05):
+        super().__init__()
+        self.delay = delay
+        self.loads = 0
+
+    async def load(self, chat_id):
+        self.loads += 1
+        await asyncio.sleep(self.delay)
+        return await super().load(chat_id)
+
+    async def write(self, rows):
+        await asyncio.sleep(self.delay)
+        await super().write(rows)
+
+
+def make_store(backend):
+    histories = {}
+    store = SessionStore(backend, flush_interval=3600)
+    store.register('dialog_histories', histories, load=load_histories,
+                   merge=lambda chat_id, stored, current: merge_histories(stored, current))
+    return store, histories
+
+
+def entry(text):
+    return {'user': text, 'assistant': text}
+
+
+def test_flush_encodes_in_a_worker_thread(monkeypatch):
+    threads = []
+    encode = storage.encode_value
+
+    def recording_encode(value):
+        threads.append(threading.current_thread())
+        return encode(value)
+
+    monkeypatch.setattr(storage, 'encode_value', recording_encode)
+
+    async def run():
+        store, histories = make_store(MemoryBackend())
+        await store.start()
+        histories[1] = {'CEO': new_history([entry('a')])}
+        store.mark_dirty(1)
+        await store.flush()
+        await store.close()
+
+    asyncio.run(run())
+    assert threads and threading.main_thread() not in threads
+
+
+def test_write_during_eviction_is_merged_on_next_hydration():
+    async def run():
+        backend = SlowBackend()
+        store, histories = make_store(backend)
+        await store.start()
+        await store.hydrate(1)
+        histories[1] = {'CEO': new_history([entry('old 1'), entry('old 2')])}
+
+        eviction = asyncio.create_task(store.evict(1))
+        await asyncio.sleep(0.01)
+        # A late turn arrives while the eviction is still writing
+        histories.setdefault(1, {'CEO': new_history()})['CEO'].append(entry('new'))
+        await eviction
+
+        await store.hydrate(1)
+        users = [item['user'] for item in histories[1]['CEO']]
+        await store.close()
+        return users, backend
+
+    users, backend = asyncio.run(run())
+    assert users == ['old 1', 'old 2', 'new']
+    assert '"new"' in backend.rows[1]['dialog_histories']
+
+
+def test_concurrent_hydrations_load_once():
+    async def run():
+        backend = SlowBackend()
+        backend.rows[1] = {'dialog_histories': '{"CEO": [{"user": "a", "assistant": "a"}]}'}
+        store, histories = make_store(backend)
+        await store.start()
+        await asyncio.gather(store.hydrate(1), store.hydrate(1))
+        await store.close()
+        return backend.loads, histories
+
+    loads, histories = asyncio.run(run())
+    assert loads == 1
+    assert len(histories[1]['CEO']) == 1
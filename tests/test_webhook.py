@@ -0,0 +1,82 @@
+import json
+import asyncio
+
+import pytest
+
+from webhook import SECRET_HEADER, WebhookServer
+
+
+async def request(port, raw):
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    writer.write(raw)
+    await writer.drain()
+    status_line = await reader.readline()
+    writer.close()
+    return status_line.decode()
+
+
+def post(body, secret=None):
+    headers = f"{SECRET_HEADER}: {secret}\r\n" if secret else ''
+    return (f"POST /telegram HTTP/1.1\r\nHost: x\r\nContent-Length: {len(body)}\r\n{headers}"
+            f"Connection: close\r\n\r\n").encode() + body
+
+
+def test_refuses_to_accept_updates_without_a_secret():
+    async def noop(update):
+        pass
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(WebhookServer(noop, secret_token='', port=0).start())
+
+
+def test_only_requests_with_the_secret_are_accepted():
+    updates = []
+
+    async def collect(update):
+        updates.append(update)
+
+    async def run():
+        server = WebhookServer(collect, secret_token='s3cret', host='127.0.0.1', port=0)
+        await server.start()
+        body = json.dumps({'update_id': 1}).encode()
+        try:
+            return await request(server.bound_port, post(body)), await request(server.bound_port, post(body, 's3cret'))
+        finally:
+            await server.stop()
+
+    without, with_secret = asyncio.run(run())
+    assert ' 403 ' in without
+    assert ' 200 ' in with_secret
+    assert updates == [{'update_id': 1}]
+
+
+def test_slow_client_is_cut_off():
+    async def noop(update):
+        pass
+
+    async def run():
+        server = WebhookServer(noop, secret_token='s3cret', host='127.0.0.1', port=0, read_timeout=0.2)
+        await server.start()
+        try:
+            # Headers promise a body that never arrives
+            raw = f"POST /telegram HTTP/1.1\r\nContent-Length: 100\r\n{SECRET_HEADER}: s3cret\r\n\r\n".encode()
+            return await asyncio.wait_for(request(server.bound_port, raw), 5)
+        finally:
+            await server.stop()
+
+    assert ' 408 ' in asyncio.run(run())
+
+
+def test_idle_keep_alive_connection_is_closed():
+    async def run():
+        server = WebhookServer(None, path=None, host='127.0.0.1', port=0, idle_timeout=0.2)
+        await server.start()
+        try:
+            reader, writer = await asyncio.open_connection('127.0.0.1', server.bound_port)
+            closed = await asyncio.wait_for(reader.read(), 5)
+            writer.close()
+            return closed
+        finally:
+            await server.stop()
+
+    assert asyncio.run(run()) == b''
@@ -0,0 +1,208 @@
+import os
+import hmac
+import json
+import asyncio
+import logging
+
+logger = logging.getLogger(__name__)
+
+# 'polling' (default) or 'webhook'
+BOT_MODE = os.getenv('BOT_MODE', 'polling').lower()
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/telegram')
+# Public URL registered with Telegram on startup; leave empty when the webhook is managed elsewhere
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '')
+# Telegram sends it back in X-Telegram-Bot-Api-Secret-Token; requests without it are rejected.
+# Required in webhook mode: without it anyone who reaches the port could inject updates for any chat
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET', '')
+# Parallel HTTPS connections Telegram may open to deliver updates (1-100)
+WEBHOOK_MAX_CONNECTIONS = int(os.getenv('WEBHOOK_MAX_CONNECTIONS', '40'))
+WEBHOOK_MAX_BODY = 1024 * 1024
+# Seconds a started request may take to arrive in full, and a keep-alive connection may stay idle
+WEBHOOK_READ_TIMEOUT = float(os.getenv('WEBHOOK_READ_TIMEOUT', '10'))
+WEBHOOK_IDLE_TIMEOUT = float(os.getenv('WEBHOOK_IDLE_TIMEOUT', '75'))
+HEALTH_PATH = '/health'
+SECRET_HEADER = 'x-telegram-bot-api-secret-token'
+
+REASONS = {
+    200: 'OK',
+    400: 'Bad Request',
+    403: 'Forbidden',
+    404: 'Not Found',
+    405: 'Method Not Allowed',
+    408: 'Request Timeout',
+    413: 'Payload Too Large',
+    500: 'Internal Server Error',
+}
+
+
+class WebhookServer:
+    """Minimal HTTP/1.1 endpoint for Telegram webhook deliveries.
+
+    Each valid POST is decoded and handed to `on_update`, which should only enqueue it,
+    so Telegram gets its 200 right away. GET /health answers 200 for load balancer checks;
+    `routes` maps further GET paths to callables returning a text body (e.g. /metrics).
+    """
+
+    def __init__(self, on_update, path=WEBHOOK_PATH, secret_token=WEBHOOK_SECRET,
+                 host=WEBHOOK_LISTEN, port=WEBHOOK_PORT, max_body=WEBHOOK_MAX_BODY, routes=None,
+                 read_timeout=WEBHOOK_READ_TIMEOUT, idle_timeout=WEBHOOK_IDLE_TIMEOUT):
+        self.on_update = on_update  # async callable(update_dict); None serves only GET routes
+        self.path = path
+        self.routes = routes or {}
+        self.secret_token = secret_token
+        self.host = host
+        self.port = port
+        self.max_body = max_body
+        self.read_timeout = read_timeout
+        self.idle_timeout = idle_timeout
+        self.stats = {'accepted': 0, 'rejected': 0}
+        self._server = None
+        self._connections = set()
+
+    @property
+    def bound_port(self):
+        """Actual port, useful when started with port 0"""
+        return self._server.sockets[0].getsockname()[1] if self._server else None
+
+    async def start(self):
+        if self.on_update is not None and not self.secret_token:
+            raise RuntimeError("WEBHOOK_SECRET must be set to accept updates over HTTP")
+        self._server = await asyncio.start_server(self._serve, self.host, self.port)
+        logger.info("HTTP listening on %s:%s (%s)", self.host, self.bound_port, ', '.join(filter(None, [self.path, *self.routes])))
+
+    async def stop(self):
+        if self._server is not None:
+            self._server.close()
+            # Idle keep-alive connections would otherwise hold the server open
+            for writer in list(self._connections):
+                writer.close()
+            await asyncio.sleep(0)
+            await self._server.wait_closed()
+            self._server = None
+
+    async def _read_request(self, reader):
+        """Returns (method, path, headers, body), or None when the client closed the connection or stayed idle;
+        raises asyncio.TimeoutError when a started request does not arrive within the read timeout"""
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+        except asyncio.TimeoutError:
+            return None
+        if not request_line:
+            return None
+        # Headers and body together get one deadline, so a slow client cannot hold the connection open
+        return await asyncio.wait_for(self._read_rest(request_line, reader), self.read_timeout)
+
+    async def _read_rest(self, request_line, reader):
+        parts = request_line.decode('latin-1').split()
+        if len(parts) != 3:
+            raise ValueError("Malformed request line")
+        method, target, _ = parts
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, _, value = line.decode('latin-1').partition(':')
+            headers[name.strip().lower()] = value.strip()
+        length = int(headers.get('content-length') or 0)
+        if length > self.max_body:
+            return method, target.split('?', 1)[0], headers, None
+        body = await reader.readexactly(length) if length else b''
+        return method, target.split('?', 1)[0], headers, body
+
+    def _authorized(self, headers):
+        if not self.secret_token:
+            return False
+        return hmac.compare_digest(headers.get(SECRET_HEADER, ''), self.secret_token)
+
+    async def _dispatch(self, method, path, headers, body):
+        """Returns the status, or (status, text body) for GET routes"""
+        if path == HEALTH_PATH and method == 'GET':
+            return 200
+        if path in self.routes:
+            return (200, self.routes[path]()) if method == 'GET' else 405
+        if self.on_update is None or path != self.path:
+            return 404
+        if method != 'POST':
+            return 405
+        if not self._authorized(headers):
+            return 403
+        if body is None:
+            return 413
+        try:
+            update = json.loads(body)
+        except ValueError:
+            return 400
+        if not isinstance(update, dict):
+            return 400
+        await self.on_update(update)
+        return 200
+
+    async def _serve(self, reader, writer):
+        self._connections.add(writer)
+        try:
+            while True:
+                try:
+                    request = await self._read_request(reader)
+                except (ValueError, asyncio.IncompleteReadError):
+                    self._respond(writer, 400, close=True)
+                    await writer.drain()
+                    break
+                except asyncio.TimeoutError:
+                    self._respond(writer, 408, close=True)
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                try:
+                    status = await self._dispatch(method, path, headers, body)
+                except Exception as e:
+                    logger.exception("Webhook update failed: %s", e)
+                    status = 500
+                status, text = status if isinstance(status, tuple) else (status, None)
+                if path == self.path:
+                    self.stats['accepted' if status == 200 else 'rejected'] += 1
+                # An oversized body was not read, so the connection cannot be reused
+                close = body is None or headers.get('connection', '').lower() == 'close'
+                self._respond(writer, status, close=close, text=text)
+                await writer.drain()
+                if close:
+                    break
+        except ConnectionError:
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _respond(self, writer, status, close=False, text=None):
+        body = (REASONS.get(status, '') if text is None else text).encode()
+        writer.write(
+            f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+            f"Content-Type: text/plain; charset=utf-8\r\n"
+            f"Content-Length: {len(body)}\r\n"
+            f"Connection: {'close' if close else 'keep-alive'}\r\n\r\n".encode() + body
+        )
+
+
+async def replay(path, url, secret_token=WEBHOOK_SECRET):
+    """POSTs recorded updates (one JSON object per line) to a running webhook and prints the statuses"""
+    import httpx
+    headers = {SECRET_HEADER: secret_token} if secret_token else {}
+    async with httpx.AsyncClient(timeout=10) as client:
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                response = await client.post(url, content=line.strip().encode('utf-8'),
+                                             headers={**headers, 'Content-Type': 'application/json'})
+                print(f"{json.loads(line).get('update_id')}: {response.status_code}")
+
+
+if __name__ == '__main__':
+    # python webhook.py updates.jsonl [http://127.0.0.1:8443/telegram]
+    import sys
+    target = sys.argv[2] if len(sys.argv) > 2 else f"http://127.0.0.1:{WEBHOOK_PORT}{WEBHOOK_PATH}"
+    asyncio.run(replay(sys.argv[1], target))